@@ -1,9 +1,11 @@
-from abc import ABC, abstractmethod
-import random
+from abc import ABC
+import importlib
+import itertools
 import time
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
 from util import *
+import metrics
+from retry import NotReadyError, RetryError, retryCall, pause
+from context import ConversationContext
 
 # Sample dependencies for a custom agent, this is for torch and hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4
 # Use or replace these with your imports
@@ -11,6 +13,16 @@ from util import *
 #import torch
 
 class Agent(ABC):
+
+    # Used to find a web agent's tab: a substring of its platform's chat URL, and a CSS selector for chat messages (text inside them is ignored when looking for the agent's name).
+    urlPattern = None
+    messageSelector = None
+    needsBrowser = True # False for agents that don't run in a browser tab (ie: custom agents).
+    textboxAttribute = None # the chat textbox is the textarea whose textboxAttribute contains textboxValue.
+    textboxValue = None
+    latestMessageScript = None # script returning the number of messages on the page and the latest one's HTML (see util.py).
+    maxDomNodes = None # reload the tab once the page has more elements than this, set with --maxdomnodes. None never reloads.
+
     def __init__(self, type, name, driver, window):
         self.type = type
         self.currentMessage = ""
@@ -18,6 +30,24 @@ class Agent(ABC):
         self.name = name
         self.window = window
         self.driver = driver
+        self.messageCursor = None # number of messages on the page when this agent's latest message was last consumed. None until the first read.
+        self.lastSentMessage = None
+        self.pendingInput = None # text already typed into the textbox while it was being generated, see typeStream().
+
+    # Starts any slow setup for agents of this type (ie: loading a model) in the background. Called at startup, before waiting on the user.
+    @classmethod
+    def warmUp(cls):
+        pass
+
+    # Describes an agent of this type called name to findAgentNamesScript.
+    @classmethod
+    def getWindowSearchSpec(cls, name):
+        return {"name": name, "urlPattern": cls.urlPattern, "messageSelector": cls.messageSelector}
+
+    # Switches the driver to this agent's tab. Agents with a driver of their own (window is None) have nothing to switch.
+    def focus(self):
+        if self.window is not None:
+            self.driver.switch_to.window(self.window)
 
     def setCurrentMessage(self, message):
         self.currentMessage = message
@@ -34,185 +64,198 @@ class Agent(ABC):
     def getType(self):
         return self.type
 
-    @abstractmethod
-    def getLatestMessage(self, **kwargs):
-        raise NotImplementedError("Must override getMessage()")
-    
-    @abstractmethod
-    def sendMessage(self, message, **kwargs):
-        raise NotImplementedError("Must override sendMessage()")
+    # What a resumed conversation needs to carry on with this agent (see Conversation.getState()), as JSON-compatible data.
+    def getState(self):
+        return {"currentMessage": self.currentMessage, "messageCursor": self.messageCursor, "lastSentMessage": self.lastSentMessage}
 
-class characteraiAgent(Agent):
-    def __init__(self, name, driver, window):
-        super().__init__("character.ai", name, driver, window)
-    
-    def getLatestMessage(self, retries = 5, timeToWaitBetweenRetries = 5, randomOffset = 1):
-
-        self.driver.switch_to.window(self.window)
-        latestMessage = None
-
-        for i in range(0, retries + 1):
-
-            if i > 0:
-                sleepTime = timeToWaitBetweenRetries + random.uniform(0, randomOffset)
-                log_print(f"getLatestMessage() for {self.type} agent {self.name}: Retry {i}. Waiting {sleepTime} seconds.")
-                time.sleep(sleepTime)
-            
-            messageFound = True
-            try:
-                messages = self.driver.find_elements(By.TAG_NAME, 'p')
-                latest = retrieveTargetElement(messages, 'node', '[object Object]', siblings = True)
-
-                if isinstance(latest, list):
-                    temp = ""
-                    for j in latest:
-                        temp += j.get_attribute('innerHTML') + " "
-                    latestMessage = temp
-        
-                else:
-                    latestMessage = latest.get_attribute('innerHTML')
+    def setState(self, state):
+        self.currentMessage = state["currentMessage"]
+        self.messageCursor = state["messageCursor"]
+        self.lastSentMessage = state["lastSentMessage"]
 
-            except:
-                log_print(f"getLatestMessage() for {self.type} agent {self.name}: Exception encountered when retrieving latest message.")
-                messageFound = False
+    # Web agents get the methods below as they are and only declare the attributes above and latestMessageScript. Other agents (ie: custom agents)
+    # override getLatestMessage() and sendMessage().
+    @metrics.traced("getLatestMessage")
+    def getLatestMessage(self, retryPolicy = None):
 
-            if latestMessage == self.currentMessage:
-                log_print(f"getLatestMessage() for {self.type} agent {self.name}: Latest message is not available.")
-                messageFound = False
+        self.focus()
+        scraped = []
 
-            if messageFound:
-                break
+        # Retried until a message we haven't consumed yet shows up.
+        def readUnread():
+            count, message = self.scrapeLatestMessage()
+            scraped[:] = [count, message]
 
-        if latestMessage is None:
-            raise Exception(f"getLatestMessage() for {self.type} agent {self.name}: Latest message not retrieved and max retries exceeded {retries}.")
-        
-        return latestMessage
+            if not self.isNewMessage(count, message):
+                raise NotReadyError("Latest message is not available.")
 
-    def sendMessage(self, message, retries = 5, timeToWaitBetweenRetries = 5, randomOffset = 1):
+            return count, message
 
-        self.driver.switch_to.window(self.window)
-        textboxes = None
-        agent_textbox = None
+        try:
+            count, latestMessage = retryCall(readUnread, "getLatestMessage", self.type, self.name, retryPolicy)
 
-        for i in range(0, retries + 1):
+        except RetryError:
+            # As before, if the page could be read but no new message appeared, carry on with the latest one.
+            if len(scraped) == 0:
+                raise
+            count, latestMessage = scraped
 
-            if i > 0:
-                sleepTime = timeToWaitBetweenRetries + random.uniform(0, randomOffset)
-                log_print(f"sendMessage() for {self.type} agent {self.name} (textbox finding stage): Retry {i}. Waiting {sleepTime} seconds.")
-                time.sleep(sleepTime)
+        self.messageCursor = count
+        self.trimPage(retryPolicy)
+        return latestMessage
 
-            textboxes = self.driver.find_elements(By.TAG_NAME, 'textarea')
-            agent_textbox = retrieveTargetElement(textboxes, 'placeholder', 'Message')
-        
-            if agent_textbox is None:
-                log_print(f"sendMessage() for {self.type} agent {self.name} (textbox finding stage): Could not find textbox.")
+    # Reads (message count, latest message) from the page without retrying. Assumes the driver is already on this agent's tab.
+    @metrics.traced("scrapeLatestMessage")
+    def scrapeLatestMessage(self):
+        return extractLatestMessage(self.driver, self.latestMessageScript)
 
-            else:
-                break
-    
-        if agent_textbox is None:
-            raise Exception(f"sendMessage() for {self.type} agent {self.name} (textbox finding stage): Could not find textbox and max retries exceeded {retries}.")
+    @metrics.traced("sendMessage")
+    def sendMessage(self, message, retryPolicy = None):
+
+        from selenium.webdriver.common.keys import Keys # only web agents get here, see agent_types.
+
+        self.focus()
+
+        agent_textbox = self.findTextbox("sendMessage", retryPolicy)
         
-        # Write message into text box and validate.
-        fillTextBox(agent_textbox, message)
-    
-        if agent_textbox.get_attribute('innerHTML') != message:
-            log_print(f"sendMessage() for {self.type} agent {self.name} (text entering stage): Could not enter message into textbox. Expected: {message}, Actual: {agent_textbox.get_attribute('innerHTML')}")
+        # Remember what was sent so our own message showing up in the chat isn't mistaken for the reply.
+        self.lastSentMessage = message
 
-            if agent_textbox.get_attribute('innerHTML') == "":
-                raise Exception("Entered message is blank. Something has gone horribly wrong, exiting.")
-            
-            else:
-                log_print(f"sendMessage() for {self.type} agent {self.name} (text entering stage): Input is not blank, ignoring discrepancy, likely due to HTML tags in message being incorrectly parsed. TODO: add regex or something to prune these.")
+        # Write message into text box and validate. If it was typed in while it was being generated (see typeStream()), it is already there.
+        self.enterMessage(agent_textbox, message)
         
         # Send chat by pressing enter in the textbox.
         agent_textbox.send_keys(Keys.ENTER)
 
-class replikaAgent(Agent):
-    def __init__(self, name, driver, window):
-        super().__init__("Replika", name, driver, window)
-    
-    def getLatestMessage(self, retries = 5, timeToWaitBetweenRetries = 5, randomOffset = 1):
-
-        self.driver.switch_to.window(self.window)
-        latestMessage = None
-
-        for i in range(0, retries + 1):
+    # A scraped message is new if more messages are on the page than when we last read and it isn't the message we just sent ourselves.
+    # Before the first read, whatever is on the page (ie: the greeting) counts as new.
+    def isNewMessage(self, count, message):
+        if self.messageCursor is None:
+            return True
+        return count > self.messageCursor and not sameMessage(message, self.lastSentMessage)
+
+    # Returns the latest message on the page if it hasn't been consumed yet, otherwise None.
+    def scrapeUnreadMessage(self):
+        count, message = self.scrapeLatestMessage()
+        return message if self.isNewMessage(count, message) else None
+
+    # Reloads the tab once the page has more than maxDomNodes elements, so a long chat doesn't keep growing the browser's memory. Sites only load the
+    # recent part of the chat on a reload. Only called right after the latest message has been consumed, so every message on the reloaded page counts as read.
+    def trimPage(self, retryPolicy = None):
+        if (self.maxDomNodes is None) or (self.driver.execute_script(domNodeCountScript) <= self.maxDomNodes):
+            return
+
+        log_print(f"trimPage() for {self.type} agent {self.name}: Page has more than {self.maxDomNodes} elements, reloading.")
+        metrics.increment("page_reloads", platform = self.type)
+        self.driver.refresh()
+        self.messageCursor, _ = self.scrapeSettledPage("trimPage", retryPolicy)
+
+    # Reads (message count, latest message) from a page that was just loaded, once the count has stayed the same for settleTime seconds (or timeout
+    # seconds have passed), since the chat may only be partly rendered at first and a count read too early would make consumed messages look new.
+    def scrapeSettledPage(self, method, retryPolicy = None, settleTime = 2, pollInterval = 0.5, timeout = 30):
+        deadline = time.monotonic() + timeout
+        count = None
+
+        while True:
+            latest = retryCall(self.scrapeLatestMessage, method, self.type, self.name, retryPolicy)
+
+            if (count is None) or (latest[0] != count[0]):
+                count = latest
+                changedAt = time.monotonic()
+
+            elif (time.monotonic() - changedAt >= settleTime) or (time.monotonic() >= deadline):
+                return latest
+
+            pause(pollInterval)
+
+    # Sets the cursor from a freshly loaded tab (ie: after a restart that couldn't reattach to the old browser), where a checkpointed cursor means nothing since
+    # sites only load the recent part of the chat. The latest message on the page still counts as unread, unless it is the one this agent last relayed or was sent.
+    def resyncCursor(self, retryPolicy = None):
+        self.focus()
+        count, message = self.scrapeSettledPage("resyncCursor", retryPolicy)
+        consumed = sameMessage(message, self.currentMessage) or sameMessage(message, self.lastSentMessage)
+        self.messageCursor = count if consumed else count - 1
+
+    # Finds the chat textbox, retrying while it isn't there. Assumes the driver is already on this agent's tab.
+    def findTextbox(self, method, retryPolicy = None):
+
+        from selenium.webdriver.common.by import By # only web agents get here, see agent_types.
+
+        def find():
+            textboxes = self.driver.find_elements(By.TAG_NAME, 'textarea')
+            agent_textbox = retrieveTargetElement(textboxes, self.textboxAttribute, self.textboxValue)
 
-            if i > 0:
-                sleepTime = timeToWaitBetweenRetries + random.uniform(0, randomOffset)
-                log_print(f"getLatestMessage() for {self.type} agent {self.name}: Retry {i}. Waiting {sleepTime} seconds.")
-                time.sleep(sleepTime)
-            
-            messageFound = True
-            try:
-                messages = self.driver.find_elements(By.CSS_SELECTOR, "div[data-testid='chat-message-text']")
-                latestDiv = messages[-1]
-                latest = latestDiv.find_element(By.XPATH, ".//span")
-                latest = latest.find_element(By.XPATH, ".//span")
-                latestMessage = latest.get_attribute('innerHTML')
+            if agent_textbox is None:
+                raise NotReadyError("Could not find textbox.")
 
+            return agent_textbox
 
-            except Exception:
-                log_print(f"getLatestMessage() for {self.type} agent {self.name}: Exception encountered when retrieving latest message.")
-                messageFound = False
+        return retryCall(find, method, self.type, self.name, retryPolicy)
 
-            if latestMessage == self.currentMessage:
-                log_print(f"getLatestMessage() for {self.type} agent {self.name}: Latest message is not available.")
-                messageFound = False
+    # Types a message into the textbox a chunk at a time as it is being generated, without sending it. sendMessage() then only has to press Enter
+    # if it is given the same message. The orchestrator calls startStreamedInput() and typeChunk() itself so it can let go of the driver in between.
+    def typeStream(self, chunks):
+        self.startStreamedInput()
+        for chunk in chunks:
+            self.typeChunk(chunk)
 
-            if messageFound:
-                break
+    def startStreamedInput(self):
+        self.focus()
+        self.streamTextbox = self.findTextbox("typeStream")
+        injectText(self.driver, self.streamTextbox, "")
+        self.pendingInput = ""
 
-        if latestMessage is None:
-            raise Exception(f"getLatestMessage() for {self.type} agent {self.name}: Latest message not retrieved and max retries exceeded {retries}.")
-        
-        return latestMessage
+    def typeChunk(self, chunk):
+        self.focus()
+        self.pendingInput = injectText(self.driver, self.streamTextbox, chunk, append = True)
 
-    def sendMessage(self, message, retries = 5, timeToWaitBetweenRetries = 5, randomOffset = 1):
+    # Puts message in the textbox in one script call (see injectTextScript), so entering it takes the same time however long it is, and checks it with the
+    # text the script read back. If the site didn't take the text that way, it is typed in one keystroke at a time instead. Nothing is entered if it was
+    # already typed in while it was generated.
+    def enterMessage(self, textbox, message):
+        entered = self.pendingInput
+        self.pendingInput = None
 
-        self.driver.switch_to.window(self.window)
-        textboxes = None
-        agent_textbox = None
+        if entered == message:
+            return
 
-        for i in range(0, retries + 1):
+        with metrics.span("fillTextBox", platform = self.type):
+            entered = injectText(self.driver, textbox, message)
 
-            if i > 0:
-                sleepTime = timeToWaitBetweenRetries + random.uniform(0, randomOffset)
-                log_print(f"sendMessage() for {self.type} agent {self.name} (textbox finding stage): Retry {i}. Waiting {sleepTime} seconds.")
-                time.sleep(sleepTime)
+            if entered != message:
+                log_print(f"enterMessage() for {self.type} agent {self.name}: Could not set the textbox text with a script, typing it in instead. Expected: {message}, Actual: {entered}")
+                fillTextBox(textbox, message.replace("\n", " "))
+                entered = textbox.get_attribute("value")
 
-            textboxes = self.driver.find_elements(By.TAG_NAME, 'textarea')
-            agent_textbox = retrieveTargetElement(textboxes, 'id', 'send-message-textarea')
-        
-            if agent_textbox is None:
-                log_print(f"sendMessage() for {self.type} agent {self.name} (textbox finding stage): Could not find textbox.")
+        if entered != message:
+            log_print(f"sendMessage() for {self.type} agent {self.name} (text entering stage): Could not enter message into textbox. Expected: {message}, Actual: {entered}")
 
-            else:
-                break
-    
-        if agent_textbox is None:
-            raise Exception(f"sendMessage() for {self.type} agent {self.name} (textbox finding stage): Could not find textbox and max retries exceeded {retries}.")
-        
-        # Write message into text box and validate.
-        fillTextBox(agent_textbox, message)
-    
-        if agent_textbox.get_attribute('innerHTML') != message:
-            log_print(f"sendMessage() for {self.type} agent {self.name} (text entering stage): Could not enter message into textbox. Expected: {message}, Actual: {agent_textbox.get_attribute('innerHTML')}")
-
-            if agent_textbox.get_attribute('innerHTML') == "":
+            if not entered:
                 raise Exception("Entered message is blank. Something has gone horribly wrong, exiting.")
-            
+
             else:
                 log_print(f"sendMessage() for {self.type} agent {self.name} (text entering stage): Input is not blank, ignoring discrepancy, likely due to HTML tags in message being incorrectly parsed. TODO: add regex or something to prune these.")
-        
-        # Replika chat is sent by pressing enter in the textbox.
-        agent_textbox.send_keys(Keys.ENTER)
+
+    # Blocks until the reply to the last sent message has finished arriving. Returns False if timeout seconds pass first.
+    # Agents whose sendMessage() already blocks until the response is received (ie: custom agents) have nothing to wait for.
+    @metrics.traced("waitForResponse")
+    def waitForResponse(self, timeout = 60, pollInterval = 0.5, settleTime = 2):
+        if self.hasReply():
+            return True
+
+        self.focus()
+        return waitForStableText(self.scrapeUnreadMessage, [self.lastSentMessage], timeout = timeout, pollInterval = pollInterval, settleTime = settleTime)
+
+    # True if the reply to the last sent message is already there once sendMessage() returns, so there is no need to wait for it.
+    def hasReply(self):
+        return not self.needsBrowser
 
 # This is a starter class for a custom agent should you wish to implement one.
 # It is made assuming that the agent will have some API call where you send it a message and an object is returned containing the response.
 # As an example, I have included the code needed to use an INT4 quantized Llama-3.1-8B agent.
 class customAgent(Agent):
+    needsBrowser = False
+    contextTokens = 2048 # token budget for the conversation history sent to the model.
 
     # some fields relating to the model object should be added here.
     def __init__(self, name, driver, window):
@@ -231,6 +274,9 @@ class customAgent(Agent):
         """
 
         super().__init__("custom", name, None, None)
+
+        # The conversation so far from this agent's side, kept within a token budget (see context.py).
+        self.context = ConversationContext(budget = self.contextTokens)
     
     def getLatestMessage(self, **kwargs):
 
@@ -239,6 +285,13 @@ class customAgent(Agent):
             self.currentMessage = f"Hello, I am {self.name}."
 
         return self.currentMessage
+
+    def getState(self):
+        return dict(super().getState(), context = self.context.getState())
+
+    def setState(self, state):
+        super().setState(state)
+        self.context.setState(state["context"])
     """
     API call goes in this method. We are making the following assumptions:
 
@@ -247,13 +300,15 @@ class customAgent(Agent):
      3. It is user's responsibility to decide how to handle timeouts and the like.
      4. It is the user's responsibility to parse the output into a string.
     """
+    @metrics.traced("sendMessage")
     def sendMessage(self, message, **kwargs):
 
         # Use or replace this section with your code
         """
         # TODO: Find way to integrate system role, ie: for Llama it would be by adding to prompt dict: {"role": "system", "content": "You are a helpful assistant that responds as a pirate."},
         # This kind of parameter is the likely source of the character configurations in character.ai, should research this more.
-        prompt = [{"role": "user", "content": message}]
+        self.context.add("user", message)
+        prompt = self.context.messages()
 
         inputs = self.tokenizer.apply_chat_template(
             prompt,
@@ -270,9 +325,114 @@ class customAgent(Agent):
         # If the message is truncated, the eot_id tag won't be present at the end of the output, so we leave it and run the output through the HTML tag regex to remove it if it happens to be there.
         outMessage = stripHtmlTags(outMessage[outMessage.rfind('<|end_header_id|>') + len('<|end_header_id|>'):outMessage.rfind("<|")].replace("\n\n", " ").replace("\n", " "))
         
+        self.context.add("assistant", outMessage)
         self.currentMessage = outMessage
         """
 
+    # Yields the reply to message a piece at a time while it is generated, and updates self.currentMessage with what was yielded once done.
+    # The caller may stop early (see Conversation.streamReply()). Agents that can't stream yield the whole reply at once.
+    def streamMessage(self, message, **kwargs):
+        self.sendMessage(message, **kwargs)
+        yield self.currentMessage
+
+# Raised by a replay agent once its log has no more messages for it.
+class ReplayFinished(Exception):
+    pass
+
+# Plays back one side of a recorded conversation: each reply is the next message its name spoke in the log (see loganalyzer.py), whatever it was sent.
+# A log that was rotated is played back from its first part (see logwriter.rotatedParts()).
+# Needs no browser or model, so regression runs and benchmarks of the relay itself finish in seconds.
+class replayAgent(Agent):
+    needsBrowser = False
+    logFile = None # log to play back, set with --replay.
+
+    def __init__(self, name, driver, window):
+        super().__init__("replay", name, driver, window)
+        self.log = None
+        self.messages = None
+        self.position = 0 # number of messages played back so far.
+
+    # Plays back path instead of logFile.
+    def setLog(self, path):
+        self.log = path
+        self.messages = None
+
+    def getLatestMessage(self, **kwargs):
+        if self.messages is None:
+            path = self.log or self.logFile
+            if path is None:
+                raise ValueError(f"No log to replay for {self.name}, use --replay.")
+
+            from loganalyzer import iterEntries
+            from logwriter import rotatedParts
+
+            entries = itertools.chain.from_iterable(iterEntries(part) for part in rotatedParts(path))
+            self.messages = itertools.islice((text for timestamp, speaker, text in entries if speaker == self.name), self.position, None)
+
+        message = next(self.messages, None)
+        if message is None:
+            raise ReplayFinished(f"{self.name} has no more messages in the log.")
+
+        self.position += 1
+        self.currentMessage = message
+        return message
+
+    def getState(self):
+        return dict(super().getState(), position = self.position)
+
+    def setState(self, state):
+        super().setState(state)
+        self.position = state["position"]
+        self.messages = None
+
+    def sendMessage(self, message, **kwargs):
+        pass
+
+    # Replies don't depend on the message, so there is nothing to stream: the reply is typed in full on the next turn.
+    def streamMessage(self, message, **kwargs):
+        yield from ()
+
+# Agent name -> class mapping whose web agent types (see webagents.py) and model agent types (see modelagents.py) are only imported the first time
+# they are looked up, so each run only loads what the agents it uses need (ie: Selenium for web agents, inference.py for served agents). Behaves like a dict of every type otherwise.
+class AgentTypes(dict):
+    def __init__(self, types, lazyTypes):
+        super().__init__(types)
+        self.lazyTypes = lazyTypes # agent name -> (module, class name), for types not imported yet.
+        self.settings = {} # agent name -> {attribute: value} to set on the class once it is imported, see configure().
+
+    # Imports the module of a lazy type, adding all the types it provides with their settings.
+    def __missing__(self, name):
+        if name not in self.lazyTypes:
+            raise KeyError(name)
+
+        module = self.lazyTypes[name][0]
+        for typeName, (typeModule, className) in list(self.lazyTypes.items()):
+            if typeModule == module:
+                del self.lazyTypes[typeName]
+                self[typeName] = getattr(importlib.import_module(module), className)
+                self.configure(typeName, **self.settings.pop(typeName, {}))
+
+        return self[name]
+
+    def __contains__(self, name):
+        return super().__contains__(name) or (name in self.lazyTypes)
+
+    def names(self):
+        return list(self.keys()) + list(self.lazyTypes)
+
+    # Sets class attributes of an agent type (ie: from command line arguments): right away if it is imported, otherwise once it is, so it isn't imported just to be configured.
+    def configure(self, name, **attributes):
+        if name in self.lazyTypes:
+            self.settings.setdefault(name, {}).update(attributes)
+            return
+
+        for attribute, value in attributes.items():
+            setattr(self[name], attribute, value)
+
+    def __repr__(self):
+        return repr(self.names())
 
 # provides agent name -> object mapping to be used in main.py
-agent_types = {"character.ai": characteraiAgent, "Replika": replikaAgent, "custom": customAgent}
\ No newline at end of file
+agent_types = AgentTypes({"custom": customAgent, "replay": replayAgent},
+                         {"served": ("modelagents", "servedAgent"), "cpu": ("modelagents", "cpuAgent"), "remote": ("modelagents", "remoteAgent"),
+                          "character.ai": ("webagents", "characteraiAgent"), "Replika": ("webagents", "replikaAgent")})
@@ -0,0 +1,117 @@
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import inference
+from context import ConversationContext
+
+"""
+Benchmark of the shared inference server (inference.py) with many conversations sending prompts at once, on CPU and without a model.
+Uses the deterministic stub backend by default, or a real model with --model.
+
+    python benchmark/bench_inference.py --conversations 16 --requests 5 --maxbatch 1 16
+
+For each --maxbatch value, starts a server, has --conversations threads each send --requests prompts through the pooled client and reports
+tokens per second, queue wait and request latency. A maxbatch of 1 is the one-request-at-a-time baseline.
+
+    python benchmark/bench_inference.py --turns 200 --budget 1024
+
+Runs one long conversation between two agents that send their whole history (see context.py) every turn, with and without the prefix cache,
+and compares the time of the first and last turns. With the cache and the budget, late turns should take about as long as early ones.
+"""
+
+def summarize(label, samples, unit = "ms", scale = 1000):
+    if len(samples) == 0:
+        print(f"{label}: no samples")
+        return
+
+    values = sorted(j * scale for j in samples)
+    p95 = values[min(len(values) - 1, int(0.95 * len(values)))]
+    print(f"{label}: mean {statistics.mean(values):.1f} {unit}, median {statistics.median(values):.1f} {unit}, p95 {p95:.1f} {unit}, n={len(values)}")
+
+def runConversation(client, index, requests, maxNewTokens, latencies):
+    for i in range(requests):
+        prompt = [{"role": "user", "content": f"Conversation {index} message {i}: tell me about trains."}]
+        start = time.perf_counter()
+        client.generate(prompt, maxNewTokens)
+        latencies.append(time.perf_counter() - start)
+
+def bench(backend, maxBatch, conversations, requests, maxNewTokens):
+    engine = inference.InferenceEngine(backend, maxBatch = maxBatch)
+    server = inference.startServer(engine, port = 0)
+    client = inference.InferenceClient(*server.server_address, poolSize = conversations)
+    latencies = []
+
+    threads = [threading.Thread(target = runConversation, args = (client, j, requests, maxNewTokens, latencies)) for j in range(conversations)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = client.stats()
+    server.shutdown()
+
+    print(f"maxbatch {maxBatch}: {stats['tokens'] / elapsed:.1f} tokens/s wall clock, {stats['tokensPerSecond']:.1f} tokens/s while generating, mean batch {stats['meanBatchSize']:.1f}")
+    print(f"maxbatch {maxBatch}: mean queue wait {1000 * stats['meanQueueWait']:.1f} ms, max queue wait {1000 * stats['maxQueueWait']:.1f} ms")
+    summarize(f"maxbatch {maxBatch}: request latency", latencies)
+
+# Two agents replying to each other for turns turns. Returns the seconds each turn took.
+def runLongConversation(client, turns, budget, maxNewTokens, useSessions):
+    contexts = [ConversationContext(budget = budget), ConversationContext(budget = budget)]
+    message = "Hello, let's talk about trains."
+    times = []
+
+    for turn in range(turns):
+        context = contexts[turn % 2]
+        context.add("user", message)
+        start = time.perf_counter()
+        message = client.generate(context.messages(), maxNewTokens, f"agent{turn % 2}" if useSessions else None)
+        times.append(time.perf_counter() - start)
+        context.add("assistant", message)
+
+    return times
+
+def benchContext(createBackend, turns, budget, maxNewTokens):
+    tenth = max(1, turns // 10)
+
+    for label, turnBudget, useSessions in [("no budget, no prefix cache", 10 ** 9, False), ("budget, no prefix cache", budget, False), ("budget and prefix cache", budget, True)]:
+        engine = inference.InferenceEngine(createBackend())
+        server = inference.startServer(engine, port = 0)
+        client = inference.InferenceClient(*server.server_address)
+
+        times = runLongConversation(client, turns, turnBudget, maxNewTokens, useSessions)
+        summarize(f"{label}: first {tenth} turns", times[:tenth])
+        summarize(f"{label}: last {tenth} turns", times[-tenth:])
+        print(f"{label}: {100 * client.stats()['prefixReuse']:.0f}% of prompt tokens taken from the prefix cache")
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--conversations", type=int, help="Number of conversations sending prompts at once. Default is 16.", default=16, action="store")
+    parser.add_argument("-r", "--requests", type=int, help="Prompts sent by each conversation. Default is 5.", default=5, action="store")
+    parser.add_argument("-n", "--maxbatch", type=int, nargs="+", help="Batch sizes to compare. Default is 1 16.", default=[1, 16], action="store")
+    parser.add_argument("-t", "--tokens", type=int, help="Maximum new tokens per reply. Default is 64.", default=64, action="store")
+    parser.add_argument("-u", "--turns", type=int, help="Run the long conversation benchmark with this many turns instead.", action="store")
+    parser.add_argument("-b", "--budget", type=int, help="Token budget of the conversation history for --turns. Default is 1024.", default=1024, action="store")
+    parser.add_argument("-m", "--model", type=str, help="Hugging Face model to use instead of the stub backend, ie: a tiny one for CPU.", action="store")
+    args = parser.parse_args()
+
+    backend = inference.TransformersBackend(args.model) if args.model is not None else inference.StubBackend()
+
+    if args.turns is not None:
+        # The stub's prompt cost is raised and its per-token cost lowered, so the time spent on the prompt shows.
+        benchContext(lambda: backend if args.model is not None else inference.StubBackend(stepTime = 0.002, tokenTime = 0, prefillTime = 0.0005), args.turns, args.budget, args.tokens)
+        return
+
+    for maxBatch in args.maxbatch:
+        bench(backend, maxBatch, args.conversations, args.requests, args.tokens)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from selenium import webdriver
+
+from webagents import characteraiAgent, replikaAgent
+from conversation import Conversation
+import main as relay
+from mockchat import startServer
+
+"""
+End-to-end benchmark of the relay loop against the local mock chat server (mockchat.py), in headless Chrome, with no network or accounts needed.
+
+    python benchmark/bench_relay.py --turns 10 --delay 1 --history 0 200 1000
+
+Reports:
+  tab discovery   time for main.findWindows() to match both tabs.
+  scrape latency  time for one scrapeLatestMessage() call, for each chat history length in --history (should stay flat as history grows).
+  per-turn        wall time of each Conversation.relayTurn() (the body of main.py's loop) and the overhead on top of the mock's own reply time.
+  throughput      turns per minute.
+"""
+
+def createHeadlessDriver(chromedriver = None):
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-gpu")
+
+    if chromedriver is not None:
+        return webdriver.Chrome(service = webdriver.ChromeService(executable_path = chromedriver), options = options)
+
+    # Let Selenium Manager find a chromedriver.
+    return webdriver.Chrome(options = options)
+
+def summarize(label, samples, unit = "ms", scale = 1000):
+    if len(samples) == 0:
+        print(f"{label}: no samples")
+        return
+
+    values = sorted(j * scale for j in samples)
+    p95 = values[min(len(values) - 1, int(0.95 * len(values)))]
+    print(f"{label}: mean {statistics.mean(values):.1f} {unit}, median {statistics.median(values):.1f} {unit}, p95 {p95:.1f} {unit}, n={len(values)}")
+
+# Opens the two mock chats in two tabs of one driver (closing any other tabs) and returns their handles.
+def openChats(driver, baseUrl, query, history):
+    for handle in driver.window_handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+
+    driver.switch_to.window(driver.window_handles[0])
+    first = driver.current_window_handle
+    driver.get(f"{baseUrl}/character.ai/MockCharacter?{query}&history={history}")
+    driver.switch_to.new_window("tab")
+    driver.get(f"{baseUrl}/replika/MockReplika?{query}&history={history}")
+    return first, driver.current_window_handle
+
+# Times repeated scrapes of each mock chat prefilled with history messages. Returns platform -> list of seconds.
+def benchScrape(driver, baseUrl, query, history, repeats):
+    characteraiWindow, replikaWindow = openChats(driver, baseUrl, query, history)
+    results = {}
+
+    for agent in [characteraiAgent("MockCharacter", driver, characteraiWindow), replikaAgent("MockReplika", driver, replikaWindow)]:
+        agent.focus()
+        samples = []
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+            agent.scrapeLatestMessage()
+            samples.append(time.perf_counter() - start)
+
+        results[agent.getType()] = samples
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--turns", type=int, help="Number of turns to relay. Default is 10.", default=10, action="store")
+    parser.add_argument("-d", "--delay", type=float, help="Seconds the mock waits before replying. Default is 1.", default=1.0, action="store")
+    parser.add_argument("-c", "--chunks", type=int, help="Number of chunks each reply is streamed in. Default is 5.", default=5, action="store")
+    parser.add_argument("-m", "--chunkms", type=int, help="Milliseconds between streamed chunks. Default is 100.", default=100, action="store")
+    parser.add_argument("-w", "--words", type=int, help="Words per mock reply. Default is 40.", default=40, action="store")
+    parser.add_argument("-y", "--history", type=int, nargs="+", help="Chat history lengths to measure scrape latency at. Default is 0 200 1000.", default=[0, 200, 1000], action="store")
+    parser.add_argument("-r", "--repeats", type=int, help="Scrapes per history length. Default is 50.", default=50, action="store")
+    parser.add_argument("-x", "--chromedriver", type=str, help="Path to chromedriver. Default lets Selenium find one.", action="store")
+    args = parser.parse_args()
+
+    server = startServer()
+    baseUrl = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    query = f"delay={args.delay}&chunks={args.chunks}&chunkms={args.chunkms}&words={args.words}"
+    driver = createHeadlessDriver(args.chromedriver)
+
+    try:
+        # Scrape latency against chat length.
+        for history in args.history:
+            for platform, samples in benchScrape(driver, baseUrl, query, history, args.repeats).items():
+                summarize(f"scrape latency, {platform}, history {history}", samples)
+
+        # Tab discovery.
+        openChats(driver, baseUrl, query, 0)
+        start = time.perf_counter()
+        windows = relay.findWindows(driver, [("MockCharacter", "character.ai"), ("MockReplika", "Replika")], cachePath = os.devnull)
+        summarize("tab discovery", [time.perf_counter() - start])
+
+        if None in windows:
+            print(f"Error: could not find both mock tabs: {windows}")
+            return
+
+        # The relay loop itself.
+        agents = [characteraiAgent("MockCharacter", driver, windows[0]), replikaAgent("MockReplika", driver, windows[1])]
+        conversation = Conversation(agents, "trains", lambda inString, **fields: None)
+        replyTime = args.delay + (args.chunks - 1) * args.chunkms / 1000
+
+        turnTimes = []
+        start = time.perf_counter()
+        for _ in range(args.turns):
+            turnStart = time.perf_counter()
+            conversation.relayTurn()
+            turnTimes.append(time.perf_counter() - turnStart)
+        elapsed = time.perf_counter() - start
+
+        summarize("per-turn wall time", turnTimes)
+        summarize("per-turn overhead (wall time minus mock reply time)", [j - replyTime for j in turnTimes])
+        print(f"throughput: {60 * args.turns / elapsed:.1f} turns per minute")
+
+    finally:
+        driver.quit()
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import compileall
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+"""
+Benchmark of how long the relay takes to start, and of what it loads, for runs with only model agents and for runs with web agents.
+
+    python benchmark/bench_startup.py --runs 20
+
+Each run is a fresh interpreter that imports main.py and looks up the agent types of the scenario, the way main() does before creating the agents.
+Web agents also import Selenium's webdriver, as createDriver() does. Reports:
+  import time     time for the imports and lookups, measured inside the interpreter.
+  process time    wall time of the whole interpreter, including its own startup.
+  loaded          which of the heavy dependencies ended up in sys.modules. A model-only run should load none of the browser stack (Selenium, pytz).
+
+The same is measured for the baseline, the tree at --baseline (by default the first commit, before any of the startup work), so the figures can be
+compared on the same machine. Agent types the baseline doesn't have are left out of its lookups. Both trees are compiled first, so neither is timed compiling.
+
+With --importtime, also prints the slowest imports of each scenario (python -X importtime).
+"""
+
+# Dependencies a model-only run shouldn't need. Selenium brings urllib3, certifi and websocket with it.
+watchedModules = ["selenium", "urllib3", "certifi", "websocket", "pytz", "numpy", "torch", "transformers"]
+
+# Scenario -> (agent types looked up, whether it starts a browser).
+scenarios = {
+    "model-only": (["custom", "replay"], False),
+    "served": (["served", "remote"], False),
+    "web": (["character.ai", "Replika"], True),
+}
+
+# Run in the child interpreter: imports main, looks up the agent types and prints the time taken and the watched modules it loaded (not counting any
+# the interpreter loaded at startup, ie: from a .pth file).
+childScript = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import main
+types = [j for j in {types!r} if j in main.agent_types]
+for agentType in types:
+    main.agent_types[agentType]
+if {web!r}:
+    from selenium import webdriver
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [j for j in {watched!r} if (j in sys.modules) and (j not in before)], "missing": [j for j in {types!r} if j not in types]}}))
+"""
+
+def runChild(tree, types, web, importTime = False):
+    command = [sys.executable] + (["-X", "importtime"] if importTime else []) + ["-c", childScript.format(types = types, web = web, watched = watchedModules)]
+
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd = tree, capture_output = True, text = True, check = True)
+    wall = time.perf_counter() - start
+
+    return json.loads(result.stdout.strip().splitlines()[-1]), wall, result.stderr
+
+# Prints the slowest imports of one run from python -X importtime's output: the modules imported directly by main.py, Agent.py, etc. (cumulative, so
+# including what they import in turn), leaving out the interpreter's own startup (site).
+def printSlowestImports(stderr, count):
+    rows = []
+    pending = []
+
+    # Each module is listed after the modules it imports, indented two spaces per level.
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        if depth == 1:
+            pending.append((int(cumulative), name.strip()))
+        elif depth == 0:
+            if name.strip() != "site":
+                rows.extend(pending + [(int(cumulative), name.strip())])
+            pending = []
+
+    for cumulative, name in sorted(rows, reverse = True)[:count]:
+        print(f"    {cumulative / 1000:7.1f} ms  {name}")
+
+def summarize(label, samples):
+    values = sorted(j * 1000 for j in samples)
+    print(f"  {label}: median {statistics.median(values):.1f} ms, min {values[0]:.1f} ms, max {values[-1]:.1f} ms")
+
+# Extracts the tree at ref (a commit) into directory.
+def extractTree(ref, directory):
+    archive = subprocess.run(["git", "archive", "--format=tar", ref], cwd = root, capture_output = True, check = True).stdout
+    with tarfile.open(fileobj = io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+
+def firstCommit():
+    return subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd = root, capture_output = True, text = True, check = True).stdout.split()[-1]
+
+def benchTree(label, tree, types, web, runs, importTime):
+    elapsed = []
+    walls = []
+    loaded = set()
+
+    for _ in range(runs):
+        child, wall, _ = runChild(tree, types, web)
+        elapsed.append(child["elapsed"])
+        walls.append(wall)
+        loaded.update(child["loaded"])
+
+    print(f"  {label}{' (without ' + ', '.join(child['missing']) + ')' if child['missing'] else ''}:")
+    summarize("  import time", elapsed)
+    summarize("  process time", walls)
+    print(f"    loaded: {', '.join(sorted(loaded)) if loaded else 'none of ' + ', '.join(watchedModules)}")
+
+    if importTime:
+        _, _, stderr = runChild(tree, types, web, importTime = True)
+        print("    slowest imports:")
+        printSlowestImports(stderr, 8)
+
+def bench(name, trees, runs, importTime):
+    types, web = scenarios[name]
+    print(f"{name} ({', '.join(types)}):")
+
+    for label, tree in trees:
+        benchTree(label, tree, types, web, runs, importTime)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--runs", type=int, help="Interpreters started per scenario. Default is 10.", default=10, action="store")
+    parser.add_argument("-s", "--scenarios", type=str, nargs="+", help=f"Scenarios to run. Default is all of them: {list(scenarios)}.", choices=list(scenarios), default=list(scenarios), action="store")
+    parser.add_argument("-i", "--importtime", help="Add this to also print the slowest imports of each scenario.", action="store_true")
+    parser.add_argument("-b", "--baseline", type=str, help="Commit to compare with. Default is the first commit of the repository.", action="store")
+    parser.add_argument("-n", "--nobaseline", help="Add this to only measure this tree.", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as baselineTree:
+        trees = [("this tree", root)]
+
+        if not args.nobaseline:
+            baseline = args.baseline or firstCommit()
+            extractTree(baseline, baselineTree)
+            trees.append((f"baseline {baseline[:7]}", baselineTree))
+
+        for label, tree in trees:
+            compileall.compile_dir(tree, quiet = 1)
+
+        for name in args.scenarios:
+            bench(name, trees, args.runs, args.importtime)
+
+if __name__ == "__main__":
+    main()
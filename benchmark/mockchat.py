@@ -0,0 +1,182 @@
+import argparse
+import html
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+"""
+Local stand-in for the character.ai and Replika chat pages, with the DOM structure the scrapers in webagents.py (and their scripts in util.py) expect:
+
+  /character.ai/<name>  p elements with node="[object Object]" for the bot's paragraphs (newest message first), and a textarea with placeholder "Message".
+  /replika/<name>       div[data-testid='chat-message-text'] > span > span for every message (newest last), and textarea#send-message-textarea.
+
+Pressing Enter in the textarea posts the message and the bot replies after a delay, streaming its reply in a chunk at a time. Query parameters:
+
+  delay    seconds before the reply starts (default 1)
+  chunks   number of chunks the reply is streamed in (default 5)
+  chunkms  milliseconds between chunks (default 100)
+  words    words per reply (default 40)
+  history  number of old messages to prefill the chat with, to check how scraping scales with chat length (default 0)
+
+Run on its own with "python benchmark/mockchat.py --port 8000", or use startServer() (see bench_relay.py).
+"""
+
+pageTemplate = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>__TITLE__</title></head>
+<body>
+<div id="header"><span>__NAME__</span></div>
+<div id="messages"></div>
+__TEXTBOX__
+<script>
+var platform = __PLATFORM__;
+var settings = __SETTINGS__;
+var botName = __NAMEJSON__;
+var messages = document.getElementById("messages");
+var textbox = document.getElementsByTagName("textarea")[0];
+var replies = 0;
+
+// Words for generated replies.
+var vocabulary = ["the", "train", "goes", "fast", "and", "we", "love", "it", "very", "much", "track", "station", "ticket", "journey", "together", "always"];
+
+function makeText(seed, words) {
+    var out = [];
+    for (var i = 0; i < words; i++) {
+        out.push(vocabulary[(seed * 7 + i * 3) % vocabulary.length]);
+    }
+    return out.join(" ");
+}
+
+// Adds a message and returns the element whose text should be filled in.
+function addMessage(fromBot, text) {
+    var container = document.createElement("div");
+    var target;
+
+    if (platform === "character.ai") {
+        var p = document.createElement("p");
+        if (fromBot) {
+            p.setAttribute("node", "[object Object]");
+        }
+        p.textContent = text;
+        container.appendChild(p);
+        messages.insertBefore(container, messages.firstChild);
+        target = p;
+    } else {
+        var div = document.createElement("div");
+        div.setAttribute("data-testid", "chat-message-text");
+        var outer = document.createElement("span");
+        var inner = document.createElement("span");
+        inner.textContent = text;
+        outer.appendChild(inner);
+        div.appendChild(outer);
+        container.appendChild(div);
+        messages.appendChild(container);
+        target = inner;
+    }
+    return target;
+}
+
+// Streams a reply into a new bot message.
+function reply() {
+    replies++;
+    var text = makeText(replies, settings.words);
+    var target = null;
+    var chunk = 0;
+
+    function nextChunk() {
+        chunk++;
+        var shown = text.slice(0, Math.ceil(text.length * chunk / settings.chunks));
+        if (target === null) {
+            target = addMessage(true, shown);
+        } else {
+            target.textContent = shown;
+        }
+        if (chunk < settings.chunks) {
+            setTimeout(nextChunk, settings.chunkms);
+        }
+    }
+    setTimeout(nextChunk, settings.delay * 1000);
+}
+
+for (var i = 0; i < settings.history; i++) {
+    addMessage(i % 2 === 1, makeText(i, settings.words));
+}
+addMessage(true, "Hello, I am " + botName + ".");
+
+textbox.addEventListener("keydown", function (event) {
+    if (event.key !== "Enter") {
+        return;
+    }
+    event.preventDefault();
+    if (textbox.value.trim() === "") {
+        return;
+    }
+    addMessage(false, textbox.value);
+    textbox.value = "";
+    reply();
+});
+</script>
+</body>
+</html>
+"""
+
+textboxes = {
+    "character.ai": '<textarea placeholder="Message"></textarea>',
+    "replika": '<textarea id="send-message-textarea" placeholder="Type your message"></textarea>',
+}
+
+defaultSettings = {"delay": 1.0, "chunks": 5, "chunkms": 100, "words": 40, "history": 0}
+
+def renderPage(platform, name, settings):
+    page = pageTemplate.replace("__TITLE__", html.escape(f"{name} - {platform}"))
+    page = page.replace("__NAME__", html.escape(name))
+    page = page.replace("__TEXTBOX__", textboxes[platform])
+    page = page.replace("__PLATFORM__", json.dumps(platform))
+    page = page.replace("__SETTINGS__", json.dumps(settings))
+    page = page.replace("__NAMEJSON__", json.dumps(name))
+    return page
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [j for j in url.path.split("/") if j]
+
+        if len(parts) != 2 or parts[0] not in textboxes:
+            self.send_error(404, "Expected /character.ai/<name> or /replika/<name>")
+            return
+
+        query = parse_qs(url.query)
+        settings = dict(defaultSettings)
+        for key, default in defaultSettings.items():
+            if key in query:
+                settings[key] = type(default)(query[key][0])
+
+        body = renderPage(parts[0], parts[1], settings).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep benchmark output clean.
+    def log_message(self, format, *args):
+        pass
+
+# Starts the server in a background thread and returns it. port 0 picks a free port (see server.server_address).
+def startServer(host = "127.0.0.1", port = 0):
+    server = ThreadingHTTPServer((host, port), MockChatHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, help="Port to listen on. Default is 8000.", default=8000, action="store")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), MockChatHandler)
+    print(f"Mock chat server on http://127.0.0.1:{args.port}/character.ai/<name> and http://127.0.0.1:{args.port}/replika/<name>")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import json
+import os
+from pathlib import Path
+
+from util import *
+
+"""
+Checkpoints of a conversation's state (see Conversation.getState()), so a conversation that crashed carries on from its last acknowledged message
+instead of starting over with introductions.
+
+A checkpoint is written after every sent message and every finished turn. It is written to a temporary file, flushed to disk and renamed over the
+previous one, so a crash while writing leaves the previous checkpoint intact.
+"""
+
+# The checkpoint file of the conversation called name in directory.
+def checkpointPath(directory, name):
+    return str(Path(directory) / f"{name.replace('.', '').replace(' ', '_')}.json")
+
+def writeCheckpoint(path, state):
+    temporary = f"{path}.{os.getpid()}.tmp"
+
+    with open(temporary, "w", encoding = "utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary, path)
+
+# Returns the state saved at path, or None if there is no readable checkpoint there.
+def readCheckpoint(path):
+    try:
+        with open(path, encoding = "utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log_print(f"readCheckpoint(): Could not read {path}, starting over: {e}")
+        return None
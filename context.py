@@ -0,0 +1,90 @@
+import re
+
+"""
+Conversation history for custom agents, kept within a token budget so the prompt (and the time and memory a turn takes) stops growing once the
+conversation is long enough.
+
+Each message's token count is worked out once, when it is added, and the total is kept up to date. When the history goes over budget, the oldest
+turns are dropped down to lowWater of the budget in one go rather than one message per turn: between truncations every prompt starts with the
+previous prompt, so a model server with a prefix cache (see inference.py) only has to run the newest messages. Dropped turns can be folded into a short
+summary that stays at the start of the history.
+"""
+
+# Rough token count for when no tokenizer is at hand: about 4 characters per token for English text.
+def approximateTokens(text):
+    return len(text) // 4 + 1
+
+# Keeps the first sentence of each message after the earlier summary, if any, dropping the oldest parts to stay within maxTokens.
+def extractiveSummary(messages, maxTokens, countTokens = approximateTokens, earlier = None):
+    sentences = [] if earlier is None else [earlier]
+    for message in messages:
+        first = re.split(r"(?<=[.!?])\s", message["content"].strip(), maxsplit = 1)[0]
+        if first:
+            sentences.append(first)
+
+    summary = " ".join(sentences)
+    while (countTokens(summary) > maxTokens) and (len(sentences) > 1):
+        sentences.pop(0)
+        summary = " ".join(sentences)
+
+    return summary
+
+class ConversationContext:
+    def __init__(self, budget = 2048, lowWater = 0.6, system = None, summarize = True, summaryTokens = 128, countTokens = approximateTokens):
+        self.budget = budget
+        self.lowWater = lowWater
+        self.summarize = summarize
+        self.summaryTokens = summaryTokens
+        self.countTokens = countTokens
+        self.system = system
+        self.summary = None
+        self.summaryCount = 0
+        self.history = [] # [message, tokens] pairs.
+        self.total = 0 if system is None else countTokens(system)
+
+    def add(self, role, content):
+        tokens = self.countTokens(content)
+        self.history.append([{"role": role, "content": content}, tokens])
+        self.total += tokens
+
+    def removeLast(self):
+        message, tokens = self.history.pop()
+        self.total -= tokens
+
+    # Drops the oldest turns until the total is below lowWater of the budget. The history keeps starting on a user message, as chat templates expect.
+    def truncate(self):
+        target = self.budget * self.lowWater
+        dropped = []
+
+        while (len(self.history) > 1) and ((self.total > target) or (self.history[0][0]["role"] != "user")):
+            message, tokens = self.history.pop(0)
+            dropped.append(message)
+            self.total -= tokens
+
+        if self.summarize and len(dropped) > 0:
+            self.total -= self.summaryCount
+            self.summary = extractiveSummary(dropped, self.summaryTokens, self.countTokens, self.summary)
+            self.summaryCount = self.countTokens(self.summary)
+            self.total += self.summaryCount
+
+    # The messages to send to the model, within the budget. The summary goes in the system message, since chat templates expect at most one.
+    def messages(self):
+        if self.total > self.budget:
+            self.truncate()
+
+        system = [j for j in [self.system, None if self.summary is None else f"Earlier in the conversation: {self.summary}"] if j is not None]
+        head = [] if len(system) == 0 else [{"role": "system", "content": "\n\n".join(system)}]
+        return head + [j[0] for j in self.history]
+
+    def getState(self):
+        return {"summary": self.summary, "history": [j[0] for j in self.history]}
+
+    # Token counts are worked out again, in case the checkpoint was written with a different countTokens.
+    def setState(self, state):
+        self.summary = state["summary"]
+        self.summaryCount = 0 if self.summary is None else self.countTokens(self.summary)
+        self.history = [[message, self.countTokens(message["content"])] for message in state["history"]]
+        self.total = (0 if self.system is None else self.countTokens(self.system)) + self.summaryCount + sum(j[1] for j in self.history)
+
+    def __len__(self):
+        return len(self.history)
@@ -0,0 +1,317 @@
+import re
+import time
+import unicodedata
+
+from util import *
+import metrics
+from retry import RetryError
+from checkpoint import readCheckpoint, writeCheckpoint
+
+sentenceEnd = re.compile(r'[.!?]["\')\]]*\s*$')
+
+# Passes the pieces of a streamed reply through. Once maxChars characters have gone by, stops after the next piece that ends a sentence,
+# or at twice maxChars if no sentence ends, and closes the stream so generation stops too.
+def limitStream(pieces, maxChars = None):
+    length = 0
+
+    try:
+        for piece in pieces:
+            length += len(piece)
+            yield piece
+
+            if (maxChars is not None) and (length >= maxChars) and ((sentenceEnd.search(piece) is not None) or (length >= 2 * maxChars)):
+                return
+
+    finally:
+        pieces.close()
+
+# Holds the state of a single conversation (its agents, whose turn it is, the deadlock avoidance counter) and the logic for relaying one message.
+# The state can be checkpointed after every message and restored after a crash, see checkpoint.py.
+# Used by the blocking loop in main.py as well as the asyncio orchestrator, which runs the same stages but overlaps the waits of many conversations.
+class Conversation:
+    def __init__(self, agents, topic, addlog, deadlockAvoidance = False, deadLockLimit = 25, deadlockPrompt = "Let's talk about something else.", responseTimeout = 60, deadlockDetector = None, stream = False, maxChars = None, checkpointPath = None):
+        self.agents = agents
+        self.topic = topic
+        self.addlog = addlog
+        self.deadlockAvoidance = deadlockAvoidance or (deadlockDetector is not None) # a detector turns deadlock avoidance on by itself.
+        self.deadLockLimit = deadLockLimit
+        self.deadlockPrompt = deadlockPrompt
+        self.responseTimeout = responseTimeout
+        self.deadlockDetector = deadlockDetector # if set (see deadlock.py), deadlock avoidance triggers on repetition instead of after deadLockLimit messages.
+        self.stream = stream # relay custom agents' replies while they are generated, see streamReply().
+        self.maxChars = maxChars # when streaming, end replies at the first sentence end after this many characters.
+        self.messageCounter = 0 # counts messages, resets after deadlock avoidance triggered.
+        self.turn = 0 # index of the agent whose latest message is relayed next.
+        self.turnCount = 0 # total number of turns relayed, for the structured log.
+        self.sentAt = {} # agent name -> time.monotonic() when it was last sent a message, to log how long its reply took.
+        self.checkpointPath = checkpointPath # if set, the state is saved here after every sent message and every turn (see checkpoint.py).
+        self.stage = None # "prepared" once this turn's message has been read and logged, "sent" once it has been sent, so a retried or resumed turn doesn't repeat either.
+        self.preparedMessage = None # this turn's message while it is "prepared".
+
+    def getName(self):
+        return "_".join(agent.getName() for agent in self.agents)
+
+    # Everything needed to carry on the conversation from where it is, as JSON-compatible data.
+    def getState(self):
+        return {
+            "name": self.getName(),
+            "turn": self.turn,
+            "turnCount": self.turnCount,
+            "messageCounter": self.messageCounter,
+            "stage": self.stage,
+            "preparedMessage": self.preparedMessage,
+            "agents": [agent.getState() for agent in self.agents],
+            "deadlock": None if self.deadlockDetector is None else self.deadlockDetector.getState()
+        }
+
+    def setState(self, state):
+        if state["name"] != self.getName():
+            raise ValueError(f"Checkpoint is of conversation {state['name']}, not {self.getName()}.")
+
+        self.turn = state["turn"]
+        self.turnCount = state["turnCount"]
+        self.messageCounter = state["messageCounter"]
+        self.stage = state["stage"]
+        self.preparedMessage = state.get("preparedMessage")
+
+        for agent, agentState in zip(self.agents, state["agents"]):
+            agent.setState(agentState)
+
+        if (self.deadlockDetector is not None) and (state["deadlock"] is not None):
+            self.deadlockDetector.setState(state["deadlock"])
+
+    def saveCheckpoint(self):
+        if self.checkpointPath is None:
+            return
+
+        with metrics.span("checkpoint"):
+            writeCheckpoint(self.checkpointPath, self.getState())
+
+    # Carries on from the checkpoint at checkpointPath, if there is one. Returns True if it did. Unless reattached is set (the web agents' tabs are the ones
+    # the checkpoint was taken in, left open in the browser), the web agents' cursors are read from their freshly loaded pages instead of the checkpoint.
+    def resume(self, reattached = False):
+        state = None if self.checkpointPath is None else readCheckpoint(self.checkpointPath)
+        if state is None:
+            return False
+
+        self.setState(state)
+
+        if not reattached:
+            for agent in self.agents:
+                if agent.needsBrowser:
+                    agent.resyncCursor()
+        log_print(f"Resuming conversation {self.getName()} at turn {self.turnCount}{'' if self.stage is None else f' after the message was {self.stage}'}.")
+        self.addlog(f"--SYSTEM-- RESUMED AT TURN {self.turnCount}", event = "resume", turn = self.turnCount)
+        return True
+
+    # Returns (speaker, listener) for the current turn: the speaker's latest message is relayed to the listener.
+    def currentPair(self):
+        speaker = self.agents[self.turn]
+        listener = self.agents[(self.turn + 1) % len(self.agents)]
+        return speaker, listener
+
+    # The listener of the next turn, who will be sent the reply of this turn's listener.
+    def nextListener(self):
+        return self.agents[(self.turn + 2) % len(self.agents)]
+
+    # Turns a raw message retrieved from the speaker into the message that will be sent to the listener, and logs it. listener is None when the message goes to a whole group.
+    def prepareMessage(self, speaker, listener, latestOutput):
+
+        # The regex invoked by stripHtmlTags should clear most HTML tags from the chat. Scraped messages are innerHTML, so entities (ie: &amp;) are decoded as well.
+        with metrics.span("stripHtmlTags"):
+            latestOutput = messageText(latestOutput)
+
+        # this converts unicode chars to UTF-8. Replika once added an emoji into the text body that broke the program because the emoji was unicode.
+        with metrics.span("normalize"):
+            latestOutput = unicodedata.normalize('NFKD', latestOutput).encode('utf-8', 'ignore').decode('utf-8')
+
+        # I found that the AIs sometimes wouldn't know who the other was (ie: if they didn't mention it during greeting), so agent name seeded during first greeting.
+        # Also add topic prompt.
+        if speaker.getCurrentMessage() == "":
+            log_print(f"In introduction stage, seeding greeting with agent name {speaker} and topic prompt.")
+            latestOutput += f". I am {speaker.getName()}. Let's talk about {self.topic}."
+
+        # I found that multiple character.ai AIs could get "deadlocked" (talking about the same thing over and over) after a certain amount of time, so we can seed conversation with prompt after certain number of messages.
+        if self.deadlockAvoidance:
+            if self.deadlockDetector is not None:
+                deadlocked = self.deadlockDetector.isDeadlocked(latestOutput)
+                log_print(f"Deadlock similarity score: {self.deadlockDetector.lastScore:.3f} (threshold {self.deadlockDetector.threshold}).")
+            else:
+                deadlocked = self.messageCounter >= self.deadLockLimit
+
+            if deadlocked:
+                log_print(f"Automated deadlock avoidance activated, resetting message counter and seeding prompt.")
+                latestOutput = f"{self.deadlockPrompt}"
+                self.messageCounter = 0
+                self.addlog("--SYSTEM-- DEADLOCK AVOIDANCE ACTIVATED", event = "deadlock", turn = self.turnCount)
+
+                if self.deadlockDetector is not None:
+                    self.deadlockDetector.reset()
+
+        log_print(f"Updating {speaker.getName()}'s latest message and relaying to {'the group' if listener is None else listener.getName()}...")
+
+        # if a response gets flagged and isn't entered (happened when Donald Trump was talking about the wall, lol), we switch to deadlock avoidance messages.
+        if (listener is not None) and (listener.getCurrentMessage() == latestOutput):
+            log_print(f"Error, response was not created, seeding with topic  prompt")
+            latestOutput = f"I am {speaker.getName()}. Let's talk about {self.topic}."
+
+        speaker.setCurrentMessage(latestOutput)
+        print(f"{speaker.getName()} entered message: '{latestOutput}'")
+        sentAt = self.sentAt.get(speaker.getName())
+        latency = None if sentAt is None else round(time.monotonic() - sentAt, 3)
+        self.addlog(f"{speaker.getName()}: {latestOutput}", event = "message", turn = self.turnCount, agent = speaker.getName(), platform = speaker.getType(), latency = latency)
+
+        return latestOutput
+
+    # Called right before a message is sent to the listener, so the logged latency covers sending plus the reply.
+    def markSent(self, listener):
+        self.sentAt[listener.getName()] = time.monotonic()
+
+    # Called once this turn's message has been read from the speaker and prepared, so that if sending it fails only the send is tried again.
+    def holdPrepared(self, message):
+        self.stage = "prepared"
+        self.preparedMessage = message
+        self.saveCheckpoint()
+
+    # Called once the listener has been sent the message.
+    def acknowledgeSent(self):
+        self.stage = "sent"
+        self.preparedMessage = None
+        self.saveCheckpoint()
+
+    # Called once the message has been sent and the listener has replied: moves on to the next speaker.
+    def finishTurn(self):
+        if self.deadlockAvoidance:
+            self.messageCounter += 1
+            log_print(f"{self.messageCounter} messages sent. {self.deadLockLimit - self.messageCounter} until we seed conversation to try to avoid deadlock.")
+
+        self.turn = (self.turn + 1) % len(self.agents)
+        self.turnCount += 1
+        self.stage = None
+        self.preparedMessage = None
+        self.saveCheckpoint()
+
+    # Sends message to a custom agent and, while it generates its reply, types the reply into the next listener's textbox, so the next turn only has to
+    # press Enter. The reply stops early at maxChars (see limitStream()). If the next listener is a custom agent too, there is nothing to type into.
+    def streamReply(self, listener, message):
+        pieces = limitStream(listener.streamMessage(message), self.maxChars)
+        target = self.nextListener()
+
+        try:
+            if target.needsBrowser:
+                target.typeStream(pieces)
+            else:
+                for _ in pieces:
+                    pass
+        finally:
+            pieces.close()
+
+    # Blocking version of a turn: retrieve the speaker's latest message, send it to the listener and wait for the listener's reply.
+    def relayTurn(self):
+        with metrics.span("turn", conversation = self.getName()):
+            try:
+                self.relayTurnStages()
+            except RetryError as e:
+                self.pauseTurn(e)
+
+    # A turn whose agent calls ran out of retries is dropped rather than ending the conversation. The turn isn't finished, so the next call
+    # to relayTurn() tries it again from its stage, after the platform's circuit breaker (see retry.py) has paused if the failures keep coming.
+    def pauseTurn(self, error):
+        error.recordFailure()
+        log_print(f"{error}")
+        self.addlog(f"--SYSTEM-- TURN PAUSED: {error}", event = "pause", turn = self.turnCount)
+
+    def relayTurnStages(self):
+        speaker, listener = self.currentPair()
+
+        # A turn retried or resumed after its message was prepared only sends it, and one resumed after it was sent only has the reply left to wait for.
+        if self.stage is None:
+            self.holdPrepared(self.prepareMessage(speaker, listener, speaker.getLatestMessage()))
+
+        if self.stage == "prepared":
+            self.markSent(listener)
+
+            if self.stream and not listener.needsBrowser:
+                self.streamReply(listener, self.preparedMessage)
+            else:
+                listener.sendMessage(self.preparedMessage)
+
+            self.acknowledgeSent()
+
+        """
+        If we are running a custom agent, there is no need to wait for a web response as we are assuming either:
+           1. The custom agent is being run locally and will block until a response is received
+           2. The custom agent is being run remotely but its code is designed to block until a response is received and will handle timeouts, etc. on its own.
+
+        Consequently, we only wait between message sending if the agent is run in the browser through selenium. Rather than a fixed timer, the web agents watch
+        their chat and return as soon as the reply has stopped growing.
+        """
+        if not listener.hasReply():
+            print(f"Message sent. Waiting up to {self.responseTimeout} seconds for response...")
+            if not listener.waitForResponse(timeout = self.responseTimeout):
+                log_print(f"{listener.getName()} did not finish replying within {self.responseTimeout} seconds, continuing anyway.")
+
+        self.finishTurn()
+
+# A conversation between any number of agents. Every message is relayed to all the other agents, and the next speaker is whichever agent's reply
+# is ready first rather than the next in line (see ConversationOrchestrator.runGroup()). Messages are prefixed with the speaker's name so the listeners
+# can tell who said what. An agent that is still replying when others speak is sent everything it missed in one message once its own reply has been relayed.
+class GroupConversation(Conversation):
+    def __init__(self, agents, topic, addlog, prefixNames = True, **kwargs):
+        super().__init__(agents, topic, addlog, **kwargs)
+        self.prefixNames = prefixNames
+        self.inbox = [[] for agent in agents] # per agent, the messages it hasn't been sent yet.
+        self.busy = set() # indices of agents that have been sent a message and haven't had their reply relayed yet.
+        self.pending = [None for agent in agents] # per agent, the message taken from its inbox until it has been sent, so a resumed conversation sends it again.
+
+    def getState(self):
+        return dict(super().getState(), inbox = self.inbox, busy = sorted(self.busy), pending = self.pending)
+
+    def setState(self, state):
+        super().setState(state)
+        self.inbox = state["inbox"]
+        self.busy = set(state["busy"])
+        self.pending = state.get("pending", [None for agent in self.agents])
+
+    # Adds the speaker's message to every other agent's inbox. Returns the agents that can be sent their inbox now.
+    def broadcast(self, speaker, message):
+        text = f"{speaker.getName()}: {message}" if self.prefixNames else message
+
+        for i, agent in enumerate(self.agents):
+            if agent is not speaker:
+                self.inbox[i].append(text)
+
+        return self.waitingAgents()
+
+    # Empties agent's inbox into one message, and marks the agent busy until its reply has been relayed. The message is pending until acknowledgeDelivery().
+    def takeInbox(self, agent):
+        i = self.agents.index(agent)
+        message = " ".join(self.inbox[i])
+        self.inbox[i] = []
+        self.busy.add(i)
+        self.pending[i] = message
+        return message
+
+    # Called once agent has been sent its pending message.
+    def acknowledgeDelivery(self, agent):
+        self.pending[self.agents.index(agent)] = None
+        self.saveCheckpoint()
+
+    # Called once speaker's reply has been relayed to the others. Returns True if messages came in for it meanwhile.
+    def finishReply(self, speaker):
+        i = self.agents.index(speaker)
+        self.busy.discard(i)
+        self.finishTurn()
+        return len(self.inbox[i]) > 0
+
+    # The agents to wait on after a restart: the ones that were sent a message but whose reply wasn't relayed yet.
+    def busyAgents(self):
+        return [self.agents[i] for i in sorted(self.busy) if self.pending[i] is None]
+
+    # (agent, message) for the agents to send their message again after a restart: the ones whose message was taken from their inbox but not sent.
+    def pendingDeliveries(self):
+        return [(self.agents[i], self.pending[i]) for i in sorted(self.busy) if self.pending[i] is not None]
+
+    # The agents with messages in their inbox that haven't been sent them yet.
+    def waitingAgents(self):
+        return [agent for i, agent in enumerate(self.agents) if (i not in self.busy) and (len(self.inbox[i]) > 0)]
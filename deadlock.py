@@ -0,0 +1,128 @@
+import argparse
+import time
+from collections import deque
+
+import numpy as np
+
+"""
+Similarity based deadlock detection (see research_notes.md), without downloading a model.
+
+Each message is turned into a sketch: counts of its character n-grams hashed into a fixed number of buckets, normalized to unit length.
+The sketches of the last window messages are kept as rows of a NumPy matrix, so scoring a new message is a single matrix-vector product
+against the window (cosine similarity) and updating is overwriting one row. Deadlock avoidance triggers when the mean similarity of a new message
+to the messages in the window reaches the threshold. This takes tens of microseconds per message, well under a millisecond.
+
+Can be tried offline against existing logs, ie:
+
+    python deadlock.py sample_logs/characterai_characterai_DonaldTrump_and_DaenerysTargaryen_talk-about_trains.txt --threshold 0.5
+"""
+
+# Multipliers for the rolling n-gram hash.
+hashPrimes = np.array([2654435761, 2246822519, 3266489917, 668265263, 374761393], dtype = np.uint64)
+
+class DeadlockDetector:
+    def __init__(self, threshold = 0.5, window = 6, ngram = 4, buckets = 4096, minMessages = 4):
+        self.threshold = threshold
+        self.window = window
+        self.ngram = min(ngram, len(hashPrimes))
+        self.buckets = buckets
+        self.minMessages = minMessages # don't trigger until the window holds at least this many messages.
+        self.matrix = np.zeros((window, buckets), dtype = np.float32)
+        self.filled = 0
+        self.next = 0
+        self.lastScore = 0.0
+        self.recent = deque(maxlen = window) # the messages in the window, to save the window as text (see getState()).
+
+    # Hashed character n-gram sketch of a message, as a unit vector.
+    def sketch(self, text):
+        data = np.frombuffer(" ".join(text.lower().split()).encode("utf-8"), dtype = np.uint8).astype(np.uint64)
+        vector = np.zeros(self.buckets, dtype = np.float32)
+
+        if len(data) < self.ngram:
+            return vector
+
+        count = len(data) - self.ngram + 1
+        hashes = np.zeros(count, dtype = np.uint64)
+        for i in range(self.ngram):
+            hashes += data[i:i + count] * hashPrimes[i]
+
+        vector += np.bincount((hashes % self.buckets).astype(np.int64), minlength = self.buckets).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    # Scores a new message against the window, then adds it to the window. Returns the mean cosine similarity (0 to 1) to the previous messages.
+    def update(self, text):
+        vector = self.sketch(text)
+
+        if self.filled > 0:
+            self.lastScore = float((self.matrix[:self.filled] @ vector).mean())
+        else:
+            self.lastScore = 0.0
+
+        self.matrix[self.next] = vector
+        self.recent.append(text)
+        self.next = (self.next + 1) % self.window
+        self.filled = min(self.filled + 1, self.window)
+
+        return self.lastScore
+
+    # Adds a message and returns True if the conversation looks deadlocked.
+    def isDeadlocked(self, text):
+        enoughHistory = self.filled >= self.minMessages
+        return (self.update(text) >= self.threshold) and enoughHistory
+
+    # Forget the window, ie: after deadlock avoidance has been triggered.
+    def reset(self):
+        self.matrix[:] = 0
+        self.filled = 0
+        self.next = 0
+        self.lastScore = 0.0
+        self.recent.clear()
+
+    # The window is saved as its messages rather than the matrix, which is much larger, and rebuilt from them.
+    def getState(self):
+        return list(self.recent)
+
+    def setState(self, state):
+        self.reset()
+        for text in state:
+            self.update(text)
+
+# Replays the messages of a log through a detector and prints where deadlock avoidance would have triggered.
+def main():
+    from loganalyzer import iterEntries
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logs", nargs="+", help="Conversation logs to replay.")
+    parser.add_argument("-s", "--threshold", type=float, help="Mean similarity at which deadlock avoidance triggers. Default is 0.5.", default=0.5, action="store")
+    parser.add_argument("-w", "--window", type=int, help="Number of recent messages compared against. Default is 6.", default=6, action="store")
+    parser.add_argument("-v", "--verbose", help="Add this to print the score of every message.", action="store_true")
+    args = parser.parse_args()
+
+    for path in args.logs:
+        detector = DeadlockDetector(threshold = args.threshold, window = args.window)
+        messages = 0
+        triggers = 0
+        elapsed = 0.0
+
+        for _, speaker, text in iterEntries(path):
+            if speaker is None:
+                continue
+
+            start = time.perf_counter()
+            deadlocked = detector.isDeadlocked(text)
+            elapsed += time.perf_counter() - start
+            messages += 1
+
+            if args.verbose or deadlocked:
+                print(f"{path} message {messages} ({speaker}): score {detector.lastScore:.3f}{' DEADLOCK' if deadlocked else ''}")
+
+            if deadlocked:
+                triggers += 1
+                detector.reset()
+
+        perMessage = 1e6 * elapsed / messages if messages else 0.0
+        print(f"{path}: {messages} messages, {triggers} triggers, {perMessage:.1f} microseconds per message.")
+
+if __name__ == "__main__":
+    main()
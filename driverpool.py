@@ -0,0 +1,193 @@
+import argparse
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import util
+from util import *
+from Agent import *
+from conversation import Conversation
+from logwriter import isValidTimezone
+import metrics
+import main as relay
+
+"""
+Runs each conversation in a worker process of its own. Every web agent gets its own Chrome instance started from a persistent profile directory,
+so it is already logged in (no human needed at startup) and never has to switch tabs. A browser that crashes only takes down its own conversation,
+which is restarted up to --restarts times while the others keep going.
+
+Pairings file format: a JSON list with one object per conversation. Web agents also need the URL of their chat, ie:
+
+    [{"name1": "Jack", "type1": "character.ai", "url1": "https://character.ai/chat/...",
+      "name2": "Jill", "type2": "Replika", "url2": "https://my.replika.com/", "topic": "trains"}, ...]
+
+topic is optional. "replay" agents need the log they play back as "replay" (see Agent.py). profile1/profile2 optionally set the profile directory, which defaults to
+profiles/<n>_<i>_<type>_<name> for agent i of the n-th pairing, so no two agents share one (a profile can only be open in one Chrome at a time).
+Each profile is logged in once with --setup, after which the pool starts without any interaction.
+"""
+
+profileRoot = "profiles" # default parent directory of the Chrome profiles.
+
+# Returns the profile directory for agent i (1 or 2) of the pairing at position index in the pairings file.
+def getProfileDir(pairing, index, i):
+    if f"profile{i}" in pairing:
+        return pairing[f"profile{i}"]
+    return str(Path(profileRoot) / f"{index}_{i}_{pairing[f'type{i}']}_{pairing[f'name{i}']}".replace(".", "").replace(" ", "_"))
+
+# Returns an error message if two web agents would use the same profile directory, otherwise None.
+def checkProfileDirs(pairings):
+    seen = {}
+    for index, pairing in enumerate(pairings):
+        for i in [1, 2]:
+            if not agent_types[pairing[f"type{i}"]].needsBrowser:
+                continue
+
+            profileDir = Path(getProfileDir(pairing, index, i)).resolve()
+            if profileDir in seen:
+                return f"Error: {pairing[f'name{i}']} and {seen[profileDir]} use the same profile directory {profileDir}, which can only be open in one Chrome at a time."
+            seen[profileDir] = pairing[f"name{i}"]
+
+    return None
+
+# Opens each web agent's profile in turn so a human can log in once. The cookies are kept in the profile for later runs.
+def setupProfiles(pairings):
+    for index, pairing in enumerate(pairings):
+        for i in [1, 2]:
+            if not agent_types[pairing[f"type{i}"]].needsBrowser:
+                continue
+
+            driver = relay.createDriver(getProfileDir(pairing, index, i))
+            driver.get(pairing[f"url{i}"])
+            _ = input(f"Press Enter when you have authenticated into your {pairing[f'type{i}']} account and can see the chat for {pairing[f'name{i}']}")
+            driver.quit()
+
+# Worker process entry point: starts the agents' browsers, then relays turns until maxTurns is reached (forever if None).
+def runWorker(pairing, index, settings, maxTurns = None):
+    util.verbosity = settings["verbose"]
+
+    # Each worker has its own registry. Only a trace file makes sense here, written per process as <tracefile>.<pid>.json.
+    if settings["tracefile"] is not None:
+        metrics.configure(traceFile = f"{settings['tracefile']}.{os.getpid()}.json")
+
+    relay.configureCustomAgents(settings)
+    relay.configureWebAgents(settings)
+    relay.warmUpAgents([pairing["type1"], pairing["type2"]])
+
+    cache = relay.createResponseCache(settings["cache"], settings["cachesize"])
+    drivers = []
+
+    try:
+        agents = []
+        for i in [1, 2]:
+            agentType = pairing[f"type{i}"]
+            driver = None
+
+            if agent_types[agentType].needsBrowser:
+                driver = relay.createDriver(getProfileDir(pairing, index, i), headless = settings["headless"], blockResources = settings["blockresources"])
+                driver.get(pairing[f"url{i}"])
+                drivers.append(driver)
+
+            # No window handle: the agent owns the driver, so there are no tabs to switch between.
+            agents.append(relay.createAgent(agentType, pairing[f"name{i}"], driver, None, cache, pairing.get("replay")))
+
+        addlog = relay.createLogger([pairing["name1"], pairing["name2"]], settings["timezone"], settings["logmaxsize"])
+        conversation = Conversation(agents, pairing.get("topic", relay.topic), addlog, deadlockAvoidance = settings["deadlockavoidance"], deadLockLimit = settings["deadlockthreshold"], deadlockPrompt = relay.deadlock_avoidance_prompt, responseTimeout = settings["responsetimeout"], deadlockDetector = relay.createDeadlockDetector(settings["deadlocksimilarity"]), stream = settings["stream"], maxChars = settings["maxchars"],
+                                    checkpointPath = relay.createCheckpointPath(settings["checkpoint"], f"{pairing['name1']}_{pairing['name2']}"))
+
+        if settings["resume"]:
+            conversation.resume()
+
+        turns = 0
+        while (maxTurns is None) or (turns < maxTurns):
+            conversation.relayTurn()
+            turns += 1
+
+    except ReplayFinished as e:
+        log_print(f"runWorker(): {e}")
+
+    finally:
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+# Runs all pairings in a pool of worker processes. A conversation that fails is logged and restarted (up to restarts times) without touching the others.
+# With a checkpoint directory, a restarted conversation carries on from its last checkpoint.
+def runPool(pairings, settings, processes, restarts = 0, maxTurns = None):
+
+    # spawn rather than fork so that no browser connections or locks are inherited by the workers.
+    with ProcessPoolExecutor(max_workers = processes, mp_context = multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(runWorker, pairing, index, settings, maxTurns): (pairing, index, 0) for index, pairing in enumerate(pairings)}
+
+        while futures:
+            future = next(as_completed(futures))
+            pairing, index, attempts = futures.pop(future)
+            name = f"{pairing['name1']}_{pairing['name2']}"
+
+            try:
+                future.result()
+                print(f"Conversation {name} finished.")
+
+            except Exception as e:
+                print(f"Conversation {name} stopped: {e}")
+
+                if attempts < restarts:
+                    print(f"Restarting conversation {name} (restart {attempts + 1} of {restarts}).")
+                    futures[pool.submit(runWorker, pairing, index, dict(settings, resume = True), maxTurns)] = (pairing, index, attempts + 1)
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--pairings", type=str, help="JSON file listing the conversations to run.", required=True, action = "store")
+    parser.add_argument("-n", "--processes", type=int, help="Number of worker processes. Default is one per conversation.", action="store")
+    parser.add_argument("-r", "--restarts", type=int, help="Number of times a crashed conversation is restarted. Default is 3.", default=3, action="store")
+    parser.add_argument("-l", "--setup", help="Add this to log each web agent's browser profile in once, then exit.", action="store_true")
+    parser.add_argument("-H", "--headless", help="Add this to run the browsers without windows and with background services off, to fit more conversations on one machine. The profiles must be logged in with --setup first.", action="store_true")
+    relay.addConversationArguments(parser)
+    args = parser.parse_args()
+
+    with open(args.pairings) as f:
+        pairings = json.load(f)
+
+    for pairing in pairings:
+        if "agents" in pairing:
+            print("Error: group conversations aren't supported by the worker pool, run them with orchestrator.py or main.py --group.")
+            return
+
+        for i in [1, 2]:
+            if pairing[f"type{i}"] not in agent_types:
+                print(f"Error: agent type {pairing[f'type{i}']} is invalid. Supported agent types: {agent_types}")
+                return
+
+            if agent_types[pairing[f"type{i}"]].needsBrowser and (f"url{i}" not in pairing):
+                print(f"Error: {pairing[f'name{i}']} is a web agent but has no url{i} in the pairings file.")
+                return
+
+    error = checkProfileDirs(pairings)
+    if error is not None:
+        print(error)
+        return
+
+    if not isValidTimezone(args.timezone):
+        print(f"Error: {args.timezone} is not a known timezone. Exiting.")
+        return
+
+    if args.resume and (args.checkpoint is None):
+        print("Error: --resume needs the --checkpoint directory to resume from. Exiting.")
+        return
+
+    if args.metricsport is not None:
+        print("Note: --metricsport is not supported by the worker pool since each worker has its own metrics. Use --tracefile instead.")
+
+    if args.setup:
+        setupProfiles(pairings)
+        return
+
+    settings = vars(args)
+    runPool(pairings, settings, args.processes or len(pairings), restarts = args.restarts)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,814 @@
+import argparse
+import http.client
+import json
+import queue
+import threading
+import time
+import zlib
+from collections import deque, OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from util import *
+import metrics
+
+"""
+Local inference server shared by custom agents. The model is loaded once, and prompts from every conversation go into one queue and are
+generated with continuous batching: each step of the scheduler produces one token for every running request, finished requests leave the
+batch straight away and waiting ones join it between steps, so a long reply never holds up a short one and the model always runs as full a batch as there is work for.
+
+Agents (servedAgent in modelagents.py) talk to it over HTTP on localhost through a pool of keep-alive connections:
+
+    python inference.py --backend stub --port 8100 --maxbatch 16
+    python inference.py --backend transformers --model Qwen/Qwen2.5-0.5B-Instruct --device cpu
+
+  POST /generate  {"messages": [{"role": "user", "content": "..."}], "maxNewTokens": 512, "session": "..."} -> {"text": "...", "tokens": n, "reusedTokens": n, "queueWait": seconds}
+                  Add "stream": true to get the text as server-sent events while it is generated; closing the connection cancels it.
+  POST /v1/chat/completions  the same in the format of the OpenAI chat completions API (messages, max_tokens, stream), for remote agents (see remote.py).
+  GET  /stats     tokens per second, queue wait and batch size so far, as JSON.
+  GET  /metrics   the same in Prometheus format (see metrics.py).
+
+Backends turn chat messages into token ids and produce the next token of a batch of sequences. StubBackend is deterministic and needs no model,
+with a per-step cost that barely grows with the batch like a real GPU, so batching can be tested and benchmarked anywhere (see benchmark/bench_inference.py).
+TransformersBackend runs a Hugging Face causal LM, and transformers/torch are only imported when it is used.
+
+Requests with the same session (optional) share a prefix cache: a conversation sends its whole history every turn (see context.py), and only the part
+that changed since its last request is run through the model.
+"""
+
+defaultPort = 8100
+
+# One prompt being generated.
+class GenerationRequest:
+    def __init__(self, messages, maxNewTokens, session = None):
+        self.messages = messages
+        self.maxNewTokens = maxNewTokens
+        self.session = session # requests of the same session (ie: one agent's conversation) reuse each other's prefix, see PrefixCache.
+        self.promptIds = None
+        self.outputIds = []
+        self.state = None # the backend's per-sequence state (ie: KV cache), None until the prompt has been run.
+        self.reusedTokens = 0 # prompt tokens taken from the prefix cache rather than run through the model.
+        self.text = None
+        self.error = None
+        self.submittedAt = time.perf_counter()
+        self.queueWait = None
+        self.cancelled = False
+        self.decode = None # the backend's decode(), set when the request is submitted.
+        self.updates = queue.SimpleQueue() # number of tokens generated so far after each step, then None once finished.
+        self.done = threading.Event()
+
+    # Blocks until generation has finished and returns the text.
+    def result(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Generation did not finish within {timeout} seconds.")
+
+        if self.error is not None:
+            raise self.error
+
+        return self.text
+
+    # Yields the text as it is generated, a piece at a time. Text is decoded in the caller's thread so streaming doesn't slow the scheduler down.
+    def stream(self):
+        sent = ""
+
+        while True:
+            count = self.updates.get()
+            text = self.result() if count is None else self.decode(self.outputIds[:count])
+
+            # Hold back text that is still changing, ie: a character split across tokens.
+            if text.startswith(sent) and not text.endswith("\ufffd"):
+                if len(text) > len(sent):
+                    yield text[len(sent):]
+                sent = text
+
+            if count is None:
+                return
+
+    # Stops generating at the next step. The request finishes with the text generated so far.
+    def cancel(self):
+        self.cancelled = True
+
+# Keeps the model state (ie: KV cache) of each session's last sequence, so the next request of the session only has to run its new tokens.
+# Least recently used sessions are dropped once there are more than maxSessions.
+class PrefixCache:
+    def __init__(self, maxSessions = 64):
+        self.maxSessions = maxSessions
+        self.sessions = OrderedDict() # session -> (ids, state)
+
+    # Returns how many leading tokens of ids are cached for session, and the cached state. Always leaves at least one token to run.
+    def lookup(self, session, ids):
+        if (session is None) or (session not in self.sessions):
+            return 0, None
+
+        self.sessions.move_to_end(session)
+        cachedIds, state = self.sessions[session]
+        length = 0
+        for a, b in zip(cachedIds, ids):
+            if a != b:
+                break
+            length += 1
+
+        return min(length, len(ids) - 1), state
+
+    def store(self, session, ids, state):
+        if session is None:
+            return
+
+        self.sessions[session] = (ids, state)
+        self.sessions.move_to_end(session)
+        while len(self.sessions) > self.maxSessions:
+            self.sessions.popitem(last = False)
+
+# Deterministic stand-in for a model: the reply depends only on the messages. Each step sleeps stepTime plus tokenTime per sequence in the batch,
+# plus prefillTime for every prompt token that isn't already in the prefix cache.
+class StubBackend:
+    vocabulary = ["the", "train", "goes", "fast", "and", "we", "love", "it", "very", "much", "track", "station", "ticket", "journey", "together", "always",
+                  "I", "think", "you", "are", "right", "about", "that", "what", "do", "like", "most", "tell", "me", "more", "really", "so"]
+    endToken = -1
+
+    def __init__(self, stepTime = 0.02, tokenTime = 0.001, prefillTime = 0.0002, minTokens = 8, maxTokens = 40):
+        self.stepTime = stepTime
+        self.tokenTime = tokenTime
+        self.prefillTime = prefillTime
+        self.minTokens = minTokens
+        self.maxTokens = maxTokens
+        self.prefixCache = PrefixCache()
+
+    def encode(self, messages):
+        text = " ".join(j["content"] for j in messages)
+        return [zlib.crc32(j.encode("utf-8")) % len(self.vocabulary) for j in text.split()]
+
+    def step(self, requests):
+        delay = self.stepTime + self.tokenTime * len(requests)
+
+        for request in requests:
+            if request.state is None:
+                request.reusedTokens, _ = self.prefixCache.lookup(request.session, request.promptIds)
+                request.state = True
+                delay += self.prefillTime * (len(request.promptIds) - request.reusedTokens)
+
+        time.sleep(delay)
+        return [self.nextToken(j) for j in requests]
+
+    def nextToken(self, request):
+        seed = zlib.crc32(bytes(j % 256 for j in request.promptIds[-16:]))
+        length = self.minTokens + seed % (self.maxTokens - self.minTokens + 1)
+
+        if len(request.outputIds) >= length:
+            return self.endToken
+
+        return zlib.crc32(f"{seed}:{len(request.outputIds)}".encode("utf-8")) % len(self.vocabulary)
+
+    def isEnd(self, token):
+        return token == self.endToken
+
+    def decode(self, ids):
+        return " ".join(self.vocabulary[j] for j in ids)
+
+    def release(self, request):
+        self.prefixCache.store(request.session, request.promptIds + request.outputIds, None)
+
+# A Hugging Face causal LM with a KV cache per sequence. A new request first runs its prompt on its own (prefill), starting from the KV cache of
+# its session's previous request for as many tokens as the two have in common, so a conversation's earlier turns aren't run through the model again.
+# After that, each step runs the newest token of every sequence in the batch at once, with the KV caches left-padded to the longest one.
+#
+# On CPU, threads and interopThreads set torch's intra-op and inter-op thread pools (torch's defaults when None: one intra-op thread per physical core),
+# and quantization can be "int8" (dynamic int8 Linear layers, built into torch) or "int4" (4-bit weights, needs optimum-quanto).
+class TransformersBackend:
+    quantizations = ["int8", "int4"]
+
+    def __init__(self, modelId, device = "cpu", temperature = 0.7, maxSessions = 64, threads = None, interopThreads = None, quantization = None):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        try:
+            from transformers import DynamicCache
+        except ImportError:
+            DynamicCache = None
+
+        if threads is not None:
+            torch.set_num_threads(threads)
+
+        # Can only be set before torch has run anything in parallel.
+        if interopThreads is not None:
+            try:
+                torch.set_num_interop_threads(interopThreads)
+            except RuntimeError as e:
+                log_print(f"TransformersBackend: could not set inter-op threads: {e}")
+
+        loadArguments = {"torch_dtype": torch.float32 if device == "cpu" else torch.float16, "low_cpu_mem_usage": True}
+        if quantization == "int4":
+            from transformers import QuantoConfig
+            loadArguments["quantization_config"] = QuantoConfig(weights = "int4")
+
+        self.torch = torch
+        self.DynamicCache = DynamicCache
+        self.device = device
+        self.temperature = temperature
+        self.tokenizer = AutoTokenizer.from_pretrained(modelId)
+        self.model = AutoModelForCausalLM.from_pretrained(modelId, **loadArguments).to(device)
+        self.model.eval()
+
+        if quantization == "int8":
+            torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype = torch.qint8, inplace = True)
+
+        endIds = getattr(self.model.generation_config, "eos_token_id", None)
+        self.endIds = {self.tokenizer.eos_token_id} | set(endIds if isinstance(endIds, list) else [endIds])
+        self.prefixCache = PrefixCache(maxSessions)
+
+    def encode(self, messages):
+        if self.tokenizer.chat_template is not None:
+            return self.tokenizer.apply_chat_template(messages, tokenize = True, add_generation_prompt = True)
+        return self.tokenizer.encode(" ".join(j["content"] for j in messages))
+
+    # Model caches are kept as tuples of (key, value) per layer, each [batch, heads, tokens, dim], so they can be sliced, padded and stacked.
+    def toModelCache(self, past):
+        if self.DynamicCache is not None:
+            return self.DynamicCache.from_legacy_cache(past)
+        return past
+
+    def fromModelCache(self, cache):
+        if hasattr(cache, "to_legacy_cache"):
+            return cache.to_legacy_cache()
+        return cache
+
+    def sample(self, logits):
+        if self.temperature > 0:
+            return self.torch.multinomial(self.torch.softmax(logits.float() / self.temperature, dim = -1), 1).squeeze(-1)
+        return logits.argmax(-1)
+
+    def prefill(self, request):
+        torch = self.torch
+        reused, past = self.prefixCache.lookup(request.session, request.promptIds)
+        if past is None:
+            reused = 0
+        else:
+            past = tuple((k[:, :, :reused], v[:, :, :reused]) for k, v in past)
+
+        newIds = request.promptIds[reused:]
+        ids = torch.tensor([newIds], dtype = torch.long, device = self.device)
+        mask = torch.ones((1, len(request.promptIds)), dtype = torch.long, device = self.device)
+        positions = torch.arange(reused, len(request.promptIds), device = self.device).unsqueeze(0)
+
+        with torch.inference_mode():
+            output = self.model(input_ids = ids, attention_mask = mask, position_ids = positions, past_key_values = None if past is None else self.toModelCache(past), use_cache = True)
+
+        request.reusedTokens = reused
+        request.state = self.fromModelCache(output.past_key_values)
+        return self.sample(output.logits[:, -1, :])[0].item()
+
+    def step(self, requests):
+        torch = self.torch
+        tokens = {}
+
+        running = []
+        for i, request in enumerate(requests):
+            if request.state is None:
+                tokens[i] = self.prefill(request)
+            else:
+                running.append(i)
+
+        if len(running) > 0:
+            lengths = [requests[i].state[0][0].shape[2] for i in running]
+            width = max(lengths)
+
+            past = []
+            for layer in range(len(requests[running[0]].state)):
+                keys = [torch.nn.functional.pad(requests[i].state[layer][0], (0, 0, width - n, 0)) for i, n in zip(running, lengths)]
+                values = [torch.nn.functional.pad(requests[i].state[layer][1], (0, 0, width - n, 0)) for i, n in zip(running, lengths)]
+                past.append((torch.cat(keys), torch.cat(values)))
+
+            ids = torch.tensor([[requests[i].outputIds[-1]] for i in running], dtype = torch.long, device = self.device)
+            mask = torch.zeros((len(running), width + 1), dtype = torch.long, device = self.device)
+            for row, n in enumerate(lengths):
+                mask[row, width - n:] = 1
+            positions = torch.tensor([[n] for n in lengths], dtype = torch.long, device = self.device)
+
+            with torch.inference_mode():
+                output = self.model(input_ids = ids, attention_mask = mask, position_ids = positions, past_key_values = self.toModelCache(tuple(past)), use_cache = True)
+
+            newPast = self.fromModelCache(output.past_key_values)
+            for row, (i, n) in enumerate(zip(running, lengths)):
+                requests[i].state = tuple((k[row:row + 1, :, width - n:], v[row:row + 1, :, width - n:]) for k, v in newPast)
+
+            for row, token in enumerate(self.sample(output.logits[:, -1, :]).tolist()):
+                tokens[running[row]] = token
+
+        return [tokens[i] for i in range(len(requests))]
+
+    def isEnd(self, token):
+        return token in self.endIds
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens = True).strip()
+
+    # Keeps the finished sequence's KV cache for the session's next request. The cache covers every token but the last generated one.
+    def release(self, request):
+        if request.state is None:
+            return
+
+        ids = request.promptIds + request.outputIds
+        self.prefixCache.store(request.session, ids[:request.state[0][0].shape[2]], request.state)
+
+backends = {"stub": StubBackend, "transformers": TransformersBackend}
+
+# Runs the continuous batching loop over a backend in a background thread.
+class InferenceEngine:
+    def __init__(self, backend, maxBatch = 8):
+        self.backend = backend
+        self.maxBatch = maxBatch
+        self.waiting = deque()
+        self.active = []
+        self.condition = threading.Condition()
+
+        # Totals for stats().
+        self.requests = 0
+        self.admitted = 0
+        self.tokens = 0
+        self.promptTokens = 0
+        self.reusedTokens = 0
+        self.steps = 0
+        self.busyTime = 0.0
+        self.queueWaitTotal = 0.0
+        self.queueWaitMax = 0.0
+
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def submit(self, messages, maxNewTokens = 512, session = None):
+        request = GenerationRequest(messages, maxNewTokens, session)
+        request.decode = self.backend.decode
+
+        with self.condition:
+            self.waiting.append(request)
+            self.condition.notify()
+
+        return request
+
+    def generate(self, messages, maxNewTokens = 512, session = None, timeout = None):
+        return self.submit(messages, maxNewTokens, session).result(timeout)
+
+    # Moves waiting requests into the batch while there is room. Blocks while there is nothing to do.
+    def admit(self):
+        admitted = []
+
+        with self.condition:
+            while (len(self.active) == 0) and (len(self.waiting) == 0):
+                self.condition.wait()
+
+            while (len(self.waiting) > 0) and (len(self.active) + len(admitted) < self.maxBatch):
+                request = self.waiting.popleft()
+                request.queueWait = time.perf_counter() - request.submittedAt
+                self.queueWaitTotal += request.queueWait
+                self.queueWaitMax = max(self.queueWaitMax, request.queueWait)
+                self.admitted += 1
+                admitted.append(request)
+
+        for request in admitted:
+            metrics.observe("inferenceQueueWait", request.queueWait)
+
+            try:
+                request.promptIds = self.backend.encode(request.messages)
+                self.active.append(request)
+            except Exception as e:
+                self.finish(request, e)
+
+    def finish(self, request, error = None):
+        if error is None:
+            request.text = self.backend.decode(request.outputIds)
+            self.backend.release(request)
+
+            with self.condition:
+                self.promptTokens += len(request.promptIds)
+                self.reusedTokens += request.reusedTokens
+
+        request.error = error
+        request.state = None
+        request.done.set()
+        request.updates.put(None)
+
+    def run(self):
+        while True:
+            self.admit()
+
+            for request in [j for j in self.active if j.cancelled]:
+                self.active.remove(request)
+                self.finish(request)
+
+                with self.condition:
+                    self.requests += 1
+
+            if len(self.active) == 0:
+                continue
+
+            start = time.perf_counter()
+
+            try:
+                with metrics.span("inferenceStep"):
+                    tokens = self.backend.step(self.active)
+
+            except Exception as e:
+                log_print(f"InferenceEngine: step failed for a batch of {len(self.active)}: {e}")
+                for request in self.active:
+                    self.finish(request, e)
+                self.active = []
+                continue
+
+            running = []
+            for request, token in zip(self.active, tokens):
+                if self.backend.isEnd(token):
+                    self.finish(request)
+                    continue
+
+                request.outputIds.append(token)
+                request.updates.put(len(request.outputIds))
+                if len(request.outputIds) >= request.maxNewTokens:
+                    self.finish(request)
+                else:
+                    running.append(request)
+
+            with self.condition:
+                self.requests += len(self.active) - len(running)
+                self.tokens += len(tokens)
+                self.steps += 1
+                self.busyTime += time.perf_counter() - start
+                self.active = running
+
+            metrics.increment("inference_tokens", len(tokens))
+
+    # tokensPerSecond is measured over the time spent generating, so idle time between requests doesn't lower it.
+    def stats(self):
+        with self.condition:
+            return {"requests": self.requests, "tokens": self.tokens, "steps": self.steps,
+                    "tokensPerSecond": self.tokens / self.busyTime if self.busyTime > 0 else 0.0,
+                    "meanBatchSize": self.tokens / self.steps if self.steps > 0 else 0.0,
+                    "meanQueueWait": self.queueWaitTotal / self.admitted if self.admitted > 0 else 0.0,
+                    "maxQueueWait": self.queueWaitMax, "waiting": len(self.waiting), "active": len(self.active),
+                    "promptTokens": self.promptTokens, "prefixReuse": self.reusedTokens / self.promptTokens if self.promptTokens > 0 else 0.0}
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep connections alive between requests.
+
+    def sendJson(self, status, body, contentType = "application/json"):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.sendJson(200, self.server.engine.stats())
+        elif self.path == "/metrics":
+            self.sendJson(200, metrics.prometheusText(), "text/plain; version=0.0.4")
+        else:
+            self.sendJson(404, {"error": "Expected /stats or /metrics"})
+
+    def do_POST(self):
+        if self.path == "/v1/chat/completions":
+            self.chatCompletions()
+            return
+
+        if self.path != "/generate":
+            self.sendJson(404, {"error": "Expected /generate or /v1/chat/completions"})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            request = self.server.engine.submit(body["messages"], int(body.get("maxNewTokens", 512)), body.get("session"))
+
+            if body.get("stream"):
+                self.sendStream(request)
+                return
+
+            text = request.result()
+
+        except (ValueError, KeyError, TypeError) as e:
+            self.sendJson(400, {"error": f"Bad request: {e}"})
+            return
+
+        except Exception as e:
+            self.sendJson(500, {"error": str(e)})
+            return
+
+        self.sendJson(200, {"text": text, "tokens": len(request.outputIds), "reusedTokens": request.reusedTokens, "queueWait": request.queueWait})
+
+    # The subset of the OpenAI chat completions API that remote agents use (see remote.py), so they can be run against this server.
+    def chatCompletions(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            request = self.server.engine.submit(body["messages"], int(body.get("max_tokens", 512)))
+            model = body.get("model", "local")
+
+            if body.get("stream"):
+                self.sendChatStream(request, model)
+                return
+
+            text = request.result()
+
+        except (ValueError, KeyError, TypeError) as e:
+            self.sendJson(400, {"error": {"message": f"Bad request: {e}"}})
+            return
+
+        except Exception as e:
+            self.sendJson(500, {"error": {"message": str(e)}})
+            return
+
+        self.sendJson(200, {"object": "chat.completion", "model": model, "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                            "usage": {"completion_tokens": len(request.outputIds)}})
+
+    # Same as sendStream() in the format of the chat completions API: chat.completion.chunk events, then "data: [DONE]".
+    def sendChatStream(self, request, model):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            try:
+                for piece in request.stream():
+                    self.writeEvent({"object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                self.writeEvent({"object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+
+            except Exception as e:
+                self.writeEvent({"error": {"message": str(e)}})
+
+            self.writeChunk(b"data: [DONE]\n\n")
+            self.writeChunk(b"")
+
+        except (BrokenPipeError, ConnectionResetError):
+            request.cancel()
+            self.close_connection = True
+
+    def writeChunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+    def writeEvent(self, event):
+        self.writeChunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+
+    # Sends the text as server-sent events while it is generated: {"text": piece} for each piece, then {"done": true, ...} or {"error": ...}.
+    # If the client disconnects (ie: it has stopped reading early), generation is cancelled.
+    def sendStream(self, request):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            try:
+                for piece in request.stream():
+                    self.writeEvent({"text": piece})
+                self.writeEvent({"done": True, "tokens": len(request.outputIds), "reusedTokens": request.reusedTokens, "queueWait": request.queueWait})
+
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+
+            except Exception as e:
+                self.writeEvent({"error": str(e)})
+
+            self.writeChunk(b"")
+
+        except (BrokenPipeError, ConnectionResetError):
+            request.cancel()
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+# Serves engine on host:port from a background thread and returns the server. port 0 picks a free port (see server.server_address).
+def startServer(engine, host = "127.0.0.1", port = defaultPort):
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.engine = engine
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+# Client for the server, safe to share between threads. Connections are kept alive and reused, up to poolSize idle ones.
+class InferenceClient:
+    def __init__(self, host = "127.0.0.1", port = defaultPort, poolSize = 8, timeout = 600):
+        self.host = host
+        self.port = port
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+
+    def getHeaders(self, body):
+        return {} if body is None else {"Content-Type": "application/json"}
+
+    # Sends a request and returns (connection, response) once the response headers have arrived.
+    def open(self, method, path, body = None):
+        payload = None if body is None else json.dumps(body).encode("utf-8")
+        headers = self.getHeaders(body)
+
+        # A pooled connection may have been closed by the server while idle, in which case the request is sent once more on a new one.
+        for attempt in range(2):
+            try:
+                connection = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self.connect()
+                reused = False
+
+            try:
+                connection.request(method, path, body = payload, headers = headers)
+                return connection, connection.getresponse()
+
+            except TimeoutError:
+                connection.close()
+                raise
+
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise ConnectionError(f"Inference server at {self.host}:{self.port} unreachable: {e}") from e
+
+    # Returns a connection whose response has been read in full to the pool.
+    def release(self, connection):
+        if self.idle.qsize() < self.poolSize:
+            self.idle.put(connection)
+        else:
+            connection.close()
+
+    def request(self, method, path, body = None):
+        connection, response = self.open(method, path, body)
+
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise ConnectionError(f"Inference server at {self.host}:{self.port} closed the connection: {e}") from e
+
+        self.release(connection)
+        result = json.loads(data)
+        if response.status != 200:
+            raise RuntimeError(f"Inference server error {response.status}: {result.get('error')}")
+
+        return result
+
+    def generate(self, messages, maxNewTokens = 512, session = None):
+        return self.request("POST", "/generate", {"messages": messages, "maxNewTokens": maxNewTokens, "session": session})["text"]
+
+    # Starts generating and returns an iterator over the text as it arrives. Closing the iterator early closes its connection, which cancels the generation.
+    def stream(self, messages, maxNewTokens = 512, session = None):
+        connection, response = self.open("POST", "/generate", {"messages": messages, "maxNewTokens": maxNewTokens, "session": session, "stream": True})
+
+        if response.status != 200:
+            data = response.read()
+            self.release(connection)
+            raise RuntimeError(f"Inference server error {response.status}: {json.loads(data).get('error')}")
+
+        return self.readEvents(connection, response)
+
+    def readEvents(self, connection, response):
+        finished = False
+
+        try:
+            while True:
+                line = response.readline()
+                if not line:
+                    raise ConnectionError(f"Inference server at {self.host}:{self.port} ended the stream early.")
+
+                if not line.startswith(b"data:"):
+                    continue
+
+                event = json.loads(line[5:])
+                if "error" in event:
+                    raise RuntimeError(f"Inference server error: {event['error']}")
+
+                if event.get("done"):
+                    finished = True
+                    return
+
+                yield event["text"]
+
+        finally:
+            if finished:
+                response.read()
+                self.release(connection)
+            else:
+                connection.close()
+
+    def stats(self):
+        return self.request("GET", "/stats")
+
+# Loads a backend and starts an engine for it in a background thread the first time it is asked for, so startup doesn't wait for the model.
+# warmUp() starts loading early (ie: while the browser tabs are being logged into), get() waits for it to finish.
+class LazyEngine:
+    def __init__(self, createBackend, maxBatch = 8):
+        self.createBackend = createBackend
+        self.maxBatch = maxBatch
+        self.engine = None
+        self.error = None
+        self.loader = None
+        self.lock = threading.Lock()
+
+    def warmUp(self):
+        with self.lock:
+            if self.loader is None:
+                self.loader = threading.Thread(target = self.load, daemon = True)
+                self.loader.start()
+
+    def load(self):
+        start = time.perf_counter()
+
+        try:
+            engine = InferenceEngine(self.createBackend(), maxBatch = self.maxBatch)
+
+            # One short generation so the first real message doesn't pay for first-run allocations.
+            engine.generate([{"role": "user", "content": "Hello."}], maxNewTokens = 1)
+            self.engine = engine
+            log_print(f"LazyEngine: model loaded and warmed up in {time.perf_counter() - start:.1f} seconds.")
+
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        self.warmUp()
+        self.loader.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.engine
+
+# Same interface as InferenceClient, for a model running in this process.
+class LocalClient:
+    def __init__(self, lazyEngine):
+        self.lazyEngine = lazyEngine
+
+    def generate(self, messages, maxNewTokens = 512, session = None):
+        return self.lazyEngine.get().generate(messages, maxNewTokens, session)
+
+    def stream(self, messages, maxNewTokens = 512, session = None):
+        return self.readStream(self.lazyEngine.get().submit(messages, maxNewTokens, session))
+
+    def readStream(self, request):
+        try:
+            yield from request.stream()
+        finally:
+            request.cancel()
+
+    def stats(self):
+        return self.lazyEngine.get().stats()
+
+localEngines = {}
+clients = {}
+clientsLock = threading.Lock()
+
+# One engine per model and settings, shared by every agent in the process. createBackend is only called (in the background) once the engine is needed.
+def getLocalEngine(key, createBackend):
+    with clientsLock:
+        if key not in localEngines:
+            localEngines[key] = LazyEngine(createBackend)
+        return localEngines[key]
+
+# One client (and connection pool) per server address, shared by every agent in the process.
+def getClient(address):
+    with clientsLock:
+        if address not in clients:
+            clients[address] = InferenceClient(*address)
+        return clients[address]
+
+# Parses "host:port" or "port".
+def parseAddress(text):
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--backend", type=str, help="Model backend: stub (deterministic, no model needed) or transformers. Default is stub.", default="stub", choices=list(backends), action="store")
+    parser.add_argument("-m", "--model", type=str, help="Hugging Face model id or path for the transformers backend.", action="store")
+    parser.add_argument("-d", "--device", type=str, help="Device for the transformers backend. Default is cpu.", default="cpu", action="store")
+    parser.add_argument("-j", "--threads", type=int, help="Intra-op threads for the transformers backend on CPU. Default is one per physical core.", action="store")
+    parser.add_argument("-z", "--interopthreads", type=int, help="Inter-op threads for the transformers backend on CPU. Default is torch's.", action="store")
+    parser.add_argument("-q", "--quantize", type=str, help="Quantize the model on CPU: int8 (built into torch) or int4 (needs optimum-quanto). Off by default.", choices=TransformersBackend.quantizations, action="store")
+    parser.add_argument("-n", "--maxbatch", type=int, help="Maximum number of requests generated together. Default is 8.", default=8, action="store")
+    parser.add_argument("-p", "--port", type=int, help=f"Port to listen on. Default is {defaultPort}.", default=defaultPort, action="store")
+    args = parser.parse_args()
+
+    if args.backend == "transformers":
+        if args.model is None:
+            print("Error: the transformers backend needs --model.")
+            return
+        backend = TransformersBackend(args.model, device = args.device, threads = args.threads, interopThreads = args.interopthreads, quantization = args.quantize)
+    else:
+        backend = StubBackend()
+
+    metrics.enable()
+    engine = InferenceEngine(backend, maxBatch = args.maxbatch)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), InferenceHandler)
+    server.daemon_threads = True
+    server.engine = engine
+    print(f"Inference server ({args.backend}) on http://127.0.0.1:{args.port}/generate, stats on /stats and /metrics")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
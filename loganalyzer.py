@@ -0,0 +1,211 @@
+import argparse
+import gzip
+import json
+import mmap
+import os
+import re
+from datetime import datetime
+from multiprocessing import Pool
+from pathlib import Path
+
+"""
+Reports statistics over conversation logs written by main.py (the "<timestamp> <Name>: <text>" format, including --SYSTEM-- lines and messages spanning multiple lines).
+Files are memory mapped and read as a stream of entries, so memory use doesn't depend on log size, and are spread across a process pool.
+
+    python loganalyzer.py sample_logs/ --processes 4
+    python loganalyzer.py "logs/*.txt" --json
+
+Rotated parts of a log (log.1.txt.gz, ..., see logwriter.py) are read like any other log file.
+
+Per agent it reports: number of messages, turn latency (time since the previous log entry, ie: how long the agent took to reply), message length,
+echo (word overlap with the message it was replying to) and self-repetition (word overlap with its own previous message). Overlap is Jaccard similarity of the word sets, 0 to 1.
+Per file it counts deadlock avoidance activations.
+"""
+
+entryStart = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?[+-]\d{2}:\d{2}) (.*)$')
+wordSplitter = re.compile(r"[a-z0-9']+")
+systemPrefix = "--SYSTEM--"
+deadlockMarker = "DEADLOCK AVOIDANCE ACTIVATED"
+
+# Yields the lines of a file through a memory map, without reading the whole file in. Rotated logs gzipped by logwriter.py are streamed through gzip instead.
+def iterLines(path):
+    if str(path).endswith(".gz"):
+        with gzip.open(path, "rt", encoding = "utf-8", errors = "replace") as f:
+            for line in f:
+                yield line.rstrip("\r\n")
+        return
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                yield line.decode("utf-8", errors = "replace").rstrip("\r\n")
+
+# Yields (timestamp, speaker, text) for each log entry, joining continuation lines onto the entry they belong to. speaker is None for --SYSTEM-- lines.
+def iterEntries(path):
+    current = None
+
+    for line in iterLines(path):
+        match = entryStart.match(line)
+
+        if match is None:
+            if current is not None:
+                current[2] += "\n" + line
+            continue
+
+        if current is not None:
+            yield tuple(current)
+
+        timestamp = datetime.fromisoformat(match.group(1))
+        body = match.group(2)
+
+        if body.startswith(systemPrefix):
+            current = [timestamp, None, body[len(systemPrefix):].strip()]
+        else:
+            speaker, _, text = body.partition(": ")
+            current = [timestamp, speaker, text]
+
+    if current is not None:
+        yield tuple(current)
+
+def wordSet(text):
+    return frozenset(wordSplitter.findall(text.lower()))
+
+def jaccard(a, b):
+    if len(a) == 0 and len(b) == 0:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+# Running totals for one agent. Only sums are kept so results from different files/processes can be merged.
+def newAgentStats():
+    return {"messages": 0, "latencyCount": 0, "latencySum": 0.0, "latencyMax": 0.0, "lengthSum": 0, "lengthMax": 0, "echoSum": 0.0, "echoCount": 0, "selfRepeatSum": 0.0, "selfRepeatCount": 0}
+
+# Streams one log file and returns its statistics.
+def analyzeFile(path):
+    agents = {}
+    deadlocks = 0
+    previousTime = None
+    previousWords = None
+    lastWordsBySpeaker = {}
+
+    for timestamp, speaker, text in iterEntries(path):
+
+        if speaker is None:
+            if deadlockMarker in text:
+                deadlocks += 1
+            previousTime = timestamp
+            continue
+
+        stats = agents.setdefault(speaker, newAgentStats())
+        words = wordSet(text)
+
+        stats["messages"] += 1
+        stats["lengthSum"] += len(text)
+        stats["lengthMax"] = max(stats["lengthMax"], len(text))
+
+        if previousTime is not None:
+            latency = (timestamp - previousTime).total_seconds()
+            stats["latencyCount"] += 1
+            stats["latencySum"] += latency
+            stats["latencyMax"] = max(stats["latencyMax"], latency)
+
+        if previousWords is not None:
+            stats["echoSum"] += jaccard(words, previousWords)
+            stats["echoCount"] += 1
+
+        if speaker in lastWordsBySpeaker:
+            stats["selfRepeatSum"] += jaccard(words, lastWordsBySpeaker[speaker])
+            stats["selfRepeatCount"] += 1
+
+        previousTime = timestamp
+        previousWords = words
+        lastWordsBySpeaker[speaker] = words
+
+    return {"file": str(path), "deadlocks": deadlocks, "agents": agents}
+
+# Merges per-file results into per-agent totals.
+def mergeResults(results):
+    totals = {"files": 0, "deadlocks": 0, "messages": 0, "agents": {}}
+
+    for result in results:
+        totals["files"] += 1
+        totals["deadlocks"] += result["deadlocks"]
+
+        for name, stats in result["agents"].items():
+            merged = totals["agents"].setdefault(name, newAgentStats())
+            totals["messages"] += stats["messages"]
+
+            for key, value in stats.items():
+                merged[key] = max(merged[key], value) if key.endswith("Max") else merged[key] + value
+
+    return totals
+
+# Turns the running totals into the averages that are reported.
+def summarize(totals):
+    agents = {}
+
+    for name, stats in sorted(totals["agents"].items()):
+        agents[name] = {
+            "messages": stats["messages"],
+            "meanLatency": stats["latencySum"] / stats["latencyCount"] if stats["latencyCount"] else None,
+            "maxLatency": stats["latencyMax"] if stats["latencyCount"] else None,
+            "meanLength": stats["lengthSum"] / stats["messages"],
+            "maxLength": stats["lengthMax"],
+            "echo": stats["echoSum"] / stats["echoCount"] if stats["echoCount"] else None,
+            "selfRepeat": stats["selfRepeatSum"] / stats["selfRepeatCount"] if stats["selfRepeatCount"] else None,
+        }
+
+    deadlocksPer100 = 100 * totals["deadlocks"] / totals["messages"] if totals["messages"] else 0.0
+    return {"files": totals["files"], "messages": totals["messages"], "deadlocks": totals["deadlocks"], "deadlocksPer100Messages": deadlocksPer100, "agents": agents}
+
+# Expands directories and glob patterns into a list of log files.
+def collectFiles(paths):
+    files = []
+
+    for path in paths:
+        p = Path(path)
+        if p.is_dir():
+            files.extend(sorted(j for j in p.iterdir() if j.name.endswith((".txt", ".txt.gz"))))
+        elif p.exists():
+            files.append(p)
+        else:
+            files.extend(sorted(Path().glob(path)))
+
+    return files
+
+def formatNumber(value):
+    return "-" if value is None else f"{value:.2f}"
+
+def printSummary(summary):
+    print(f"{summary['files']} files, {summary['messages']} messages, {summary['deadlocks']} deadlock avoidance activations ({summary['deadlocksPer100Messages']:.2f} per 100 messages)\n")
+    print(f"{'agent':<30} {'messages':>8} {'latency(s)':>10} {'max(s)':>8} {'length':>8} {'max':>6} {'echo':>6} {'repeat':>6}")
+
+    for name, stats in summary["agents"].items():
+        print(f"{name[:30]:<30} {stats['messages']:>8} {formatNumber(stats['meanLatency']):>10} {formatNumber(stats['maxLatency']):>8} {formatNumber(stats['meanLength']):>8} {stats['maxLength']:>6} {formatNumber(stats['echo']):>6} {formatNumber(stats['selfRepeat']):>6}")
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="Log files, directories of .txt logs (and rotated .txt.gz parts), or glob patterns.")
+    parser.add_argument("-n", "--processes", type=int, help="Number of worker processes. Default is the number of cores.", action="store")
+    parser.add_argument("-j", "--json", help="Add this to print the summary as JSON.", action="store_true")
+    args = parser.parse_args()
+
+    files = collectFiles(args.paths)
+
+    if len(files) == 0:
+        print("Error: No log files found.")
+        return
+
+    with Pool(processes = args.processes) as pool:
+        summary = summarize(mergeResults(pool.imap_unordered(analyzeFile, files, chunksize = 4)))
+
+    if args.json:
+        print(json.dumps(summary, indent = 2))
+    else:
+        printSummary(summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import atexit
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone as fixedTimezone
+
+# Returns the tzinfo for an IANA timezone name (ie: "Europe/London"). UTC doesn't need the timezone database, which Windows only has with "pip install tzdata".
+def getTimezone(name):
+    if name == "UTC":
+        return fixedTimezone.utc
+
+    from zoneinfo import ZoneInfo # only loaded for other timezones, it is slow to import.
+    return ZoneInfo(name)
+
+def isValidTimezone(name):
+    try:
+        getTimezone(name)
+        return True
+    except (KeyError, ValueError): # ZoneInfoNotFoundError is a KeyError.
+        return False
+
+# Buffered conversation log. Lines are queued in memory and written by a background thread every flushInterval seconds (fsynced every fsyncInterval seconds),
+# instead of opening and closing the log file for every message. Alongside the human readable log (same "<timestamp> <text>" format as before) it writes a
+# JSONL file with one record per line, holding the text plus whatever fields the caller passes (ie: turn, agent, platform, latency, event).
+# When maxBytes is set, a log that grows past it is rotated to <name>.<n>.txt (gzipped to <name>.<n>.txt.gz if compress is set) and a new one is started,
+# so log.1.txt.gz, log.2.txt.gz, ... then log.txt hold the conversation in order (see rotatedParts()).
+class ConversationLog:
+    def __init__(self, logfile, timezone = 'UTC', jsonl = True, flushInterval = 1.0, fsyncInterval = 10.0, maxBytes = None, compress = True):
+        self.logfile = logfile
+        self.jsonlfile = os.path.splitext(logfile)[0] + ".jsonl" if jsonl else None
+        self.timezone = getTimezone(timezone)
+        self.flushInterval = flushInterval
+        self.fsyncInterval = fsyncInterval
+        self.maxBytes = maxBytes
+        self.compress = compress
+
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.files = {}
+        self.lastFsync = time.monotonic()
+        self.rotations = 0
+
+        self.thread = threading.Thread(target = self.flushLoop, daemon = True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Same signature as the old addlog(), with optional structured fields for the JSONL record.
+    def __call__(self, inString, **fields):
+        now = datetime.now(self.timezone)
+        with self.lock:
+            self.buffer.append((now, inString, fields))
+
+    def flushLoop(self):
+        while not self.stopEvent.wait(self.flushInterval):
+            self.flush()
+
+    def getFile(self, path):
+        if path not in self.files:
+            self.files[path] = open(path, "a+")
+        return self.files[path]
+
+    # Writes out everything buffered so far.
+    def flush(self, fsync = False):
+        with self.lock:
+            pending = self.buffer
+            self.buffer = []
+
+        if len(pending) > 0:
+            text = self.getFile(self.logfile)
+            text.write("".join(f"{now} {inString}\n" for now, inString, _ in pending))
+
+            if self.jsonlfile is not None:
+                records = self.getFile(self.jsonlfile)
+                records.write("".join(json.dumps({"time": now.isoformat(), "text": inString, **fields}) + "\n" for now, inString, fields in pending))
+
+        for f in self.files.values():
+            f.flush()
+
+        if fsync or (time.monotonic() - self.lastFsync >= self.fsyncInterval):
+            for f in self.files.values():
+                os.fsync(f.fileno())
+            self.lastFsync = time.monotonic()
+
+        if (self.maxBytes is not None) and (self.logfile in self.files) and (self.files[self.logfile].tell() >= self.maxBytes):
+            self.rotate()
+
+    # Closes the current files and moves them aside as <name>.<n><extension>[.gz].
+    def rotate(self):
+        self.rotations += 1
+
+        for path, f in list(self.files.items()):
+            f.close()
+            stem, extension = os.path.splitext(path)
+            rotated = f"{stem}.{self.rotations}{extension}"
+            os.replace(path, rotated)
+
+            if self.compress:
+                import gzip # only loaded once a log is rotated.
+                with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+
+        self.files = {}
+
+    # Stops the background thread and flushes whatever is left. Safe to call more than once.
+    def close(self):
+        if self.stopEvent.is_set():
+            return
+
+        self.stopEvent.set()
+        self.thread.join()
+        self.flush(fsync = True)
+
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+# The files holding the log at path in order: its rotated parts (see ConversationLog.rotate()), oldest first, then the log itself if it exists.
+def rotatedParts(path):
+    stem, extension = os.path.splitext(path)
+    parts = []
+
+    for n in itertools.count(1):
+        part = next((j for j in [f"{stem}.{n}{extension}.gz", f"{stem}.{n}{extension}"] if os.path.exists(j)), None)
+        if part is None:
+            break
+        parts.append(part)
+
+    if os.path.exists(path) or not parts:
+        parts.append(path)
+
+    return parts
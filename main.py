@@ -1,59 +1,318 @@
 import time
-from datetime import datetime
 import sys
 import os
 from pathlib import Path
-import pytz
-import random
 import argparse
-import unicodedata
-from selenium import webdriver
+import json
 
 from util import *
 from Agent import *
+from conversation import Conversation
+from logwriter import ConversationLog, isValidTimezone
+import metrics
+from responsecache import ResponseCache, CachedAgent
+from checkpoint import checkpointPath
 
 # User Fields. The program will read these in as global variables.
 
 topic = "stuff" # Initial topic to start the conversation, is seeded into initial messages.
 
-pytz_timezone = 'UTC' # used to get correct timezone in logs, change this to your local timezone if you want them to show your local time instead of UTC.
+log_timezone = 'UTC' # IANA timezone name (ie: 'Europe/London'), used to get correct timezone in logs, change this to your local timezone if you want them to show your local time instead of UTC.
 chromedriver_executable_path = 'C:/chromedriver-win64/chromedriver.exe' # path to the .exe on Windows, path to containing folder on Linux.
 
 # Antideadlock measures (see readme). Yet to come up with clever antideadlock strategy, so just seed with reminder to continue conversation when limit hit...
 deadLockLimit = 25 # after this number of messages, inject deadlock avoidance prompt.
-messageCounter = 0 # counts messages, resets after deadlock avoidance triggered.
 deadlock_avoidance_prompt = f"Let's talk about something else." # This is used to (hopefully) move along the conversation when deadlock avoidance is triggered.
 
+responseTimeout = 60 # maximum number of seconds to wait for a web agent to finish replying before moving on.
+
+cacheSize = 512 # default size limit of the --cache directory, in MB.
+
+# With --blockresources, requests matching these patterns are blocked (see createDriver()): images, fonts, media and analytics aren't needed to read and send messages.
+blockedUrlPatterns = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico", "*.woff", "*.woff2", "*.ttf", "*.otf", "*.mp4", "*.webm", "*.mp3", "*.m3u8",
+                      "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*facebook.net*", "*segment.io*", "*amplitude.com*", "*mixpanel.com*", "*hotjar.com*", "*sentry.io*"]
+
+# Chrome switches for --headless (see createDriver()): no window, no images, no audio and no background services.
+lowFootprintSwitches = ["--headless=new", "--window-size=1280,800", "--blink-settings=imagesEnabled=false", "--mute-audio", "--disable-extensions", "--disable-background-networking",
+                        "--disable-component-update", "--disable-default-apps", "--disable-sync", "--no-first-run", "--disable-dev-shm-usage"]
+
+debuggingPort = 9222 # with --checkpoint, Chrome listens for debugger connections here and is left open if the relay crashes, so --resume can reattach to its tabs.
+
+logMaxBytes = None # rotate (and gzip) the log once it grows past this many bytes, also set with --logmaxsize. None never rotates.
+
+windowCacheFile = str(Path(os.path.dirname(sys.argv[0])).resolve()) + "/window_cache.json" # remembers which chat URL belongs to which agent, so tabs are found right away on restart.
+
+# Creates the log for a conversation (see logwriter.py). Logs to directory script was run from, as a text log plus a .jsonl file of structured records.
+# maxSize (in MB, see --logmaxsize) overrides logMaxBytes.
+def createLogger(names, timezone, maxSize = None):
+    logfile = str(Path(os.path.dirname(sys.argv[0])).resolve()) + f"/log_{'_'.join(names)}_{time.time()}.txt"
+    return ConversationLog(logfile, timezone, maxBytes = logMaxBytes if maxSize is None else maxSize * 1024 * 1024)
+
+# Returns True if something is listening on port on this machine, ie: a Chrome left open by a previous run.
+def isListening(port):
+    import socket # only needed with --checkpoint.
+
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout = 0.5).close()
+        return True
+    except OSError:
+        return False
+
+# Starts Chrome. If profileDir is given, Chrome uses it as its user data directory so cookies (ie: logins) persist between runs.
+# A profile directory can only be used by one running Chrome at a time.
+# If debuggingPort is given, Chrome accepts debugger connections on it and stays open when the relay exits. With attach, a Chrome already listening there
+# is connected to instead of starting a new one, tabs and all.
+# headless runs Chrome without a window and with lowFootprintSwitches, which needs a profile that is already logged in (see driverpool.py --setup).
+# blockResources blocks blockedUrlPatterns through the DevTools protocol, for the first tab. Tabs opened later are blocked with blockResourcesInTabs().
+def createDriver(profileDir = None, debuggingPort = None, attach = False, headless = False, blockResources = False):
+    from selenium import webdriver # not imported at the top, so runs with only model agents never load Selenium.
+
+    cService = webdriver.ChromeService(executable_path=chromedriver_executable_path)
+    options = webdriver.ChromeOptions()
+
+    if (debuggingPort is not None) and attach and isListening(debuggingPort):
+        log_print(f"createDriver(): Reattaching to the Chrome listening on port {debuggingPort}.")
+        options.debugger_address = f"127.0.0.1:{debuggingPort}"
+        driver = webdriver.Chrome(service = cService, options = options)
+
+    else:
+        if profileDir is not None:
+            options.add_argument(f"--user-data-dir={Path(profileDir).resolve()}")
+
+        if debuggingPort is not None:
+            options.add_argument(f"--remote-debugging-port={debuggingPort}")
+            options.add_experimental_option("detach", True)
+
+        if headless:
+            for switch in lowFootprintSwitches:
+                options.add_argument(switch)
+
+        driver = webdriver.Chrome(service = cService, options = options)
+
+    if blockResources:
+        blockResourcesInTab(driver)
+
+    return driver
+
+# Blocks blockedUrlPatterns in the tab the driver is switched to, from its next request on (ie: for the rest of the chat and after reloads).
+def blockResourcesInTab(driver):
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blockedUrlPatterns})
+
+# Blocks blockedUrlPatterns in each of windows (tab handles, None is skipped), ie: the chat tabs the user opened after the browser started.
+def blockResourcesInTabs(driver, windows):
+    for window in windows:
+        if window is not None:
+            driver.switch_to.window(window)
+            blockResourcesInTab(driver)
+
+# Arguments shared by main.py and the scripts that run several conversations (orchestrator.py, driverpool.py).
+def addConversationArguments(parser):
+    parser.add_argument("-v", "--verbose", help="Add this to print debug messages so you can see what the script is doing.", action="store_true")
+    parser.add_argument("-e", "--deadlockavoidance", help="Add this if you want to perform deadlock avoidance.", action="store_true")
+    parser.add_argument("-f", "--deadlockthreshold", type=int, help="The number of messages to wait for before triggering deadlock avoidance.", default=deadLockLimit, action="store")
+    parser.add_argument("-s", "--deadlocksimilarity", type=float, help=deadlockSimilarityHelp, action="store")
+    parser.add_argument("-w", "--responsetimeout", type=int, help="The maximum number of seconds to wait for a web agent to finish replying. Default is 60.", default=responseTimeout, action="store")
+    parser.add_argument("-t", "--timezone", type=str, help="The IANA timezone (ie: Europe/London) you wish the log timestamp to conform to. Default is UTC.", default=log_timezone, action="store")
+    parser.add_argument("-m", "--metricsport", type=int, help=metricsPortHelp, action="store")
+    parser.add_argument("-k", "--tracefile", type=str, help=traceFileHelp, action="store")
+    parser.add_argument("-i", "--inferenceserver", type=str, help=inferenceServerHelp, action="store")
+    parser.add_argument("-x", "--stream", help=streamHelp, action="store_true")
+    parser.add_argument("-y", "--maxchars", type=int, help=maxCharsHelp, action="store")
+    parser.add_argument("-o", "--cpumodel", type=str, help=cpuModelHelp, action="store")
+    parser.add_argument("-j", "--threads", type=int, help=threadsHelp, action="store")
+    parser.add_argument("-z", "--interopthreads", type=int, help=interopThreadsHelp, action="store")
+    parser.add_argument("-q", "--quantize", type=str, help=quantizeHelp, choices=["int8", "int4"], action="store")
+    parser.add_argument("-g", "--cache", type=str, help=cacheHelp, action="store")
+    parser.add_argument("-u", "--cachesize", type=int, help=cacheSizeHelp, default=cacheSize, action="store")
+    parser.add_argument("-C", "--checkpoint", type=str, help=checkpointHelp, action="store")
+    parser.add_argument("-R", "--resume", help=resumeHelp, action="store_true")
+    parser.add_argument("-B", "--blockresources", help=blockResourcesHelp, action="store_true")
+    parser.add_argument("-D", "--maxdomnodes", type=int, help=maxDomNodesHelp, action="store")
+    parser.add_argument("-U", "--remoteurl", type=str, help=remoteUrlHelp, action="store")
+    parser.add_argument("-M", "--remotemodel", type=str, help=remoteModelHelp, action="store")
+    parser.add_argument("-N", "--remoteconcurrency", type=int, help=remoteConcurrencyHelp, action="store")
+    parser.add_argument("-T", "--remotetimeout", type=int, help=remoteTimeoutHelp, action="store")
+    parser.add_argument("-L", "--logmaxsize", type=int, help=logMaxSizeHelp, action="store")
+
+metricsPortHelp = "Serve per-stage timings and retry counts on http://127.0.0.1:<port>/metrics (Prometheus format) and /trace (Chrome trace). Off by default."
+traceFileHelp = "Write a Chrome trace (chrome://tracing) of every stage of every turn to this file on exit. Off by default."
+inferenceServerHelp = "host:port of the inference server used by \"served\" agents (see inference.py). Default is 127.0.0.1:8100."
+streamHelp = "Add this to relay custom agents' replies while they are being generated: a web agent's textbox is filled in as the reply arrives."
+maxCharsHelp = "With --stream, end custom agents' replies at the first sentence end after this many characters. Off by default."
+cpuModelHelp = "Hugging Face model id or path for \"cpu\" agents. Default is Qwen/Qwen2.5-0.5B-Instruct."
+threadsHelp = "Intra-op threads for \"cpu\" agents' model. Default is one per physical core."
+interopThreadsHelp = "Inter-op threads for \"cpu\" agents' model. Default is torch's."
+quantizeHelp = "Quantize \"cpu\" agents' model: int8 (built into torch) or int4 (needs optimum-quanto). Off by default."
+cacheHelp = "Directory of a cache of agents' replies (see responsecache.py). An agent given a conversation it has seen before replies from the cache instead of the site or model. Off by default."
+cacheSizeHelp = "Size limit of the --cache directory in MB, least recently used replies are deleted past it. Default is 512."
+replayHelp = "Log for \"replay\" agents to play back: each one replies with the messages its name spoke in the log, in order."
+checkpointHelp = "Directory to save each conversation's state to after every message, so it can be resumed after a crash with --resume. Off by default."
+resumeHelp = "Add this to carry on conversations from their checkpoints in the --checkpoint directory, reattaching to the browser if it was left open."
+blockResourcesHelp = "Add this to block images, fonts, media and analytics in the browser (see blockedUrlPatterns), which the chats don't need."
+maxDomNodesHelp = "Reload a web agent's tab once its page has more than this many elements, so a long chat doesn't keep growing the browser's memory. Off by default."
+remoteUrlHelp = "Base URL of the OpenAI-compatible API used by \"remote\" agents, ie: https://api.openai.com/v1. The API key is read from $OPENAI_API_KEY. Default is http://127.0.0.1:8100/v1."
+remoteModelHelp = "Model name sent to the API by \"remote\" agents. Default is the endpoint's own."
+remoteConcurrencyHelp = "Maximum number of requests \"remote\" agents have in flight at once. Default is 8."
+remoteTimeoutHelp = "Seconds \"remote\" agents wait for a reply before retrying. Default is 120."
+logMaxSizeHelp = "Rotate a conversation's log once it grows past this many MB, gzipping the old part (log.1.txt.gz, ...). loganalyzer.py and replay agents read the parts. Off by default."
+groupHelp = "JSON file describing a group conversation between any number of agents, instead of --name1/--type1/--name2/--type2. See orchestrator.py for the format."
+deadlockSimilarityHelp = "Trigger deadlock avoidance when messages repeat recent ones by at least this similarity (between 0 and 1, ie: 0.5) instead of after a fixed number of messages. Turns on --deadlockavoidance. Requires numpy."
+
+# Applies the custom agent arguments, given as a dict (ie: vars(args)): the inference server for "served" agents, the model settings for "cpu" agents and the endpoint for "remote" agents.
+# Types that aren't used aren't imported to do so (see AgentTypes.configure()).
+def configureCustomAgents(settings):
+    if settings["inferenceserver"] is not None:
+        from inference import parseAddress # only needed by served agents.
+        agent_types.configure("served", serverAddress = parseAddress(settings["inferenceserver"]))
+
+    if settings["cpumodel"] is not None:
+        agent_types.configure("cpu", modelId = settings["cpumodel"])
+
+    agent_types.configure("cpu", threads = settings["threads"], interopThreads = settings["interopthreads"], quantization = settings["quantize"])
+
+    if settings["remoteurl"] is not None:
+        agent_types.configure("remote", baseUrl = settings["remoteurl"])
+
+    agent_types.configure("remote", modelId = settings["remotemodel"])
+
+    if settings["remoteconcurrency"] is not None:
+        agent_types.configure("remote", maxConcurrent = settings["remoteconcurrency"])
+
+    if settings["remotetimeout"] is not None:
+        agent_types.configure("remote", requestTimeout = settings["remotetimeout"])
+
+# Applies the web agent arguments, given as a dict (ie: vars(args)).
+def configureWebAgents(settings):
+    Agent.maxDomNodes = settings["maxdomnodes"]
+
+# Starts loading models for the agent types in use in the background, so they are ready by the time the browser tabs are.
+def warmUpAgents(agentTypes):
+    for agentType in set(agentTypes):
+        agent_types[agentType].warmUp()
+
+# Creates an agent of type agentType called name. replayLog sets the log a "replay" agent plays back. With a cache (see createResponseCache()), the agent replies from it when it can.
+def createAgent(agentType, name, driver, window, cache = None, replayLog = None):
+    agent = agent_types[agentType](name, driver, window)
+
+    if (replayLog is not None) and (agentType == "replay"):
+        agent.setLog(replayLog)
+
+    if cache is not None:
+        agent = CachedAgent(agent, cache)
+
+    return agent
+
+# Returns the response cache in directory, limited to sizeMB, or None if directory is None.
+def createResponseCache(directory, sizeMB):
+    if directory is None:
+        return None
+    return ResponseCache(directory, sizeMB * 1024 * 1024)
+
+# Returns the checkpoint file of the conversation called name (see Conversation.getName()) in directory, or None if directory is None.
+def createCheckpointPath(directory, name):
+    if directory is None:
+        return None
+
+    Path(directory).mkdir(parents = True, exist_ok = True)
+    return checkpointPath(directory, name)
+
+# Returns a deadlock detector for one conversation, or None to use the fixed message threshold. numpy is only imported when this is used.
+def createDeadlockDetector(similarity):
+    if similarity is None:
+        return None
+
+    from deadlock import DeadlockDetector
+    return DeadlockDetector(threshold = similarity)
+
+# Reads the URL -> [name, type] mapping saved by findWindows(). Missing or unreadable caches are treated as empty.
+def loadWindowCache(cachePath):
+    try:
+        with open(cachePath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Returns the handle (tab identifier) for each (name, type) in agents, or None if no tab was found for that agent (always None for custom agents).
+# Selenium has an annoying problem where it can't tell tab position (ie: first tab) and the tab position doesn't necessarily correspond to the order in the retrieved list.
+# We get around this by asking each tab whether it is on the agent's platform and shows the exact agent name at the start of some text outside the chat messages (see findAgentNamesScript).
+# Tabs whose URL was matched on a previous run are recognized from the cache without looking at the page, so restarts reconnect right away.
+# We get around duplicates (ie: character.ai donald trump talking to character.ai donald trump) by never assigning a handle twice.
+def findWindows(driver, agents, cachePath = None):
+    cachePath = cachePath or windowCacheFile
+    cache = loadWindowCache(cachePath)
+    windows = [None] * len(agents)
+
+    for handle in driver.window_handles:
+        unassigned = [i for i, (name, agentType) in enumerate(agents) if (windows[i] is None) and agent_types[agentType].needsBrowser]
+        if len(unassigned) == 0:
+            break
+
+        driver.switch_to.window(handle)
+        url = driver.current_url
+
+        matches = [i for i in unassigned if cache.get(url) == list(agents[i])]
+        if len(matches) == 0:
+            found = driver.execute_script(findAgentNamesScript, [agent_types[agents[i][1]].getWindowSearchSpec(agents[i][0]) for i in unassigned])
+            matches = [i for i, isMatch in zip(unassigned, found) if isMatch]
+
+        if len(matches) > 0:
+            windows[matches[0]] = handle
+            cache[url] = list(agents[matches[0]])
+
+    try:
+        with open(cachePath, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        log_print(f"findWindows(): Could not save window cache to {cachePath}.")
+
+    return windows
+
 def main():
 
     # Retrieve global variables.
     global topic
-    global pytz_timezone
+    global log_timezone
     global chromedriver_executable_path
     global deadLockLimit
-    global messageCounter
     global deadlock_avoidance_prompt
+    global responseTimeout
     global verbosity
 
     # Parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("-a", "--name1", type=str, help="The name of the first agent.", required=True, action = "store")
-    parser.add_argument("-b", "--type1", type=str, help="The type of the first agent. Currently supported types: character.ai", required=True, action = "store")
-    parser.add_argument("-c", "--name2", type=str, help="The name of the second agent.", required=True, action = "store")
-    parser.add_argument("-d", "--type2", type=str, help="The type of the second agent. Currently supported types: character.ai", required=True, action = "store")
-    parser.add_argument("-v", "--verbose", help="Add this to print debug messages so you can see what the script is doing.", action="store_true")
-    parser.add_argument("-e", "--deadlockavoidance", help="Add this if you want to perform deadlock avoidance.", action="store_true")
-    parser.add_argument("-f", "--deadlockthreshold", type=int, help="The number of messages to wait for before triggering deadlock avoidance.", action="store")
-    parser.add_argument("-t", "--timezone", type=str, help="The pytz timezone you wish the log timestamp to conform to. Default is UTC.", action="store")
+    parser.add_argument("-a", "--name1", type=str, help="The name of the first agent.", action = "store")
+    parser.add_argument("-b", "--type1", type=str, help="The type of the first agent. Currently supported types: character.ai", action = "store")
+    parser.add_argument("-c", "--name2", type=str, help="The name of the second agent.", action = "store")
+    parser.add_argument("-d", "--type2", type=str, help="The type of the second agent. Currently supported types: character.ai", action = "store")
+    parser.add_argument("-r", "--replay", type=str, help=replayHelp, action="store")
+    parser.add_argument("-p", "--group", type=str, help=groupHelp, action="store")
+    addConversationArguments(parser)
     args = parser.parse_args()
 
+    group = None
+    if args.group is not None:
+        with open(args.group) as f:
+            group = json.load(f)
+
+    elif None in [args.name1, args.type1, args.name2, args.type2]:
+        parser.error("--name1, --type1, --name2 and --type2 are required unless --group is given.")
+
     # Sanity check
-    if args.type1 not in agent_types: 
+    if group is not None:
+        from orchestrator import checkPairings # imported here since orchestrator.py imports this file.
+
+        error = checkPairings([group])
+        if error is not None:
+            print(error)
+            return
+
+    elif args.type1 not in agent_types: 
         print(f"Error: {args.name1}'s agent type {args.type1} is invalid. Supported agent types: {agent_types}")
         return
     
-    if args.type2 not in agent_types:
-        print(f"Error: {args.name1}'s agent type {args.type1} is invalid. Supported agent types: {agent_types}")
+    elif args.type2 not in agent_types:
+        print(f"Error: {args.name2}'s agent type {args.type2} is invalid. Supported agent types: {agent_types}")
         return
     
     # Set custom deadlock avoidance message threshold if specified.
@@ -66,47 +325,89 @@ def main():
             print(f"Error: Deadlock message threshold must be higher than 0. Entered threshold: {args.deadlockthreshold}. Exiting.")
             return
 
+    if (args.deadlocksimilarity is not None) and not (0 < args.deadlocksimilarity <= 1):
+        print(f"Error: Deadlock similarity must be between 0 and 1. Entered similarity: {args.deadlocksimilarity}. Exiting.")
+        return
+
+    # Set custom response timeout if specified.
+    if args.responsetimeout is not None:
+
+        if args.responsetimeout > 0:
+            responseTimeout = args.responsetimeout
+
+        else:
+            print(f"Error: Response timeout must be higher than 0. Entered timeout: {args.responsetimeout}. Exiting.")
+            return
+
+    if (args.logmaxsize is not None) and (args.logmaxsize <= 0):
+        print(f"Error: Log size limit must be higher than 0. Entered size: {args.logmaxsize}. Exiting.")
+        return
+
     # Set custom time zone if specified.
     if args.timezone is not None:
 
-        if args.timezone in pytz.all_timezones:
-            pytz_timezone = args.timezone
+        if isValidTimezone(args.timezone):
+            log_timezone = args.timezone
 
         else:
-            print(f"Error: {args.timezone} is not in the list of pytz timezones. Exiting.")
+            print(f"Error: {args.timezone} is not a known timezone. Exiting.")
             return
 
+    if args.resume and (args.checkpoint is None):
+        print("Error: --resume needs the --checkpoint directory to resume from. Exiting.")
+        return
+
+    if ("replay" in [args.type1, args.type2]) and (args.replay is None):
+        print("Error: \"replay\" agents need a log to play back, use --replay. Exiting.")
+        return
+
+    metrics.configure(args.metricsport, args.tracefile)
+    configureCustomAgents(vars(args))
+    configureWebAgents(vars(args))
+    replayAgent.logFile = args.replay
+
     # Set verbode logging if enabled.
     if args.verbose:
         verbosity = True
 
-    logfile = str(Path(os.path.dirname(sys.argv[0])).resolve()) + f"/log_{args.name1}_{args.name2}_{time.time()}.txt"
+    # A group conversation is run by the orchestrator's scheduler, which sends each message to all the other agents at once (see orchestrator.py).
+    if group is not None:
+        from orchestrator import runPairings
 
-    # for log prints. Logs to directory script was run from.
-    def addlog(inString):
-        with open(logfile, "a+") as f:
-            f.write(str(datetime.now(pytz.timezone(pytz_timezone))) + " " + inString + "\n")
+        args.deadlockthreshold = deadLockLimit
+        args.responsetimeout = responseTimeout
+        args.timezone = log_timezone
+        runPairings([group], args)
+        return
+
+    warmUpAgents([args.type1, args.type2])
+
+    addlog = createLogger([args.name1, args.name2], log_timezone, args.logmaxsize)
     
     # chop down the number of browser tabs based on number of custom agents involved, which don't need browser tabs. We will not spin up a browser at all if there are 2 of them.
-    numCustomAgents = int((args.type1 == "custom")) + int((args.type2 == "custom"))
-    cService = None
+    numCustomAgents = int(not agent_types[args.type1].needsBrowser) + int(not agent_types[args.type2].needsBrowser)
     driver = None
 
     if numCustomAgents < 2:
-        cService = webdriver.ChromeService(executable_path=chromedriver_executable_path)
-        driver = webdriver.Chrome(service = cService)
+        driver = createDriver(debuggingPort = None if args.checkpoint is None else debuggingPort, attach = args.resume, blockResources = args.blockresources)
 
-    # get handle (tab identifier) for each agent
+    # get handle (tab identifier) for each agent. When resuming in a browser left open by the previous run, the tabs are recognized right away (see findWindows()).
     window1 = None
     window2 = None
     handles = None
-    while True and (numCustomAgents < 2):
+    reattached = False
+
+    if args.resume and (driver is not None):
+        window1, window2 = findWindows(driver, [(args.name1, args.type1), (args.name2, args.type2)])
+        reattached = ((window1 is not None) or not agent_types[args.type1].needsBrowser) and ((window2 is not None) or not agent_types[args.type2].needsBrowser)
+
+    while (numCustomAgents < 2) and not reattached:
 
         if numCustomAgents == 0:
             _ = input(f"Press Enter when you have authenticated into your {args.type1} account and opened the chat for {args.name1} in one tab, and you have authenticated into your {args.type2} account and opened the chat for {args.name2} in another tab")
 
         else:
-            if args.type1 == "custom":
+            if not agent_types[args.type1].needsBrowser:
                 _ = input(f"Press Enter when you have authenticated into your {args.type2} account and opened the chat for {args.name2} in a single tab")
             else:
                 _ = input(f"Press Enter when you have authenticated into your {args.type1} account and opened the chat for {args.name1} in a single tab")
@@ -116,102 +417,39 @@ def main():
         if len(handles) != 2 - numCustomAgents:
             print(f"\nError: Did not detect {2 - numCustomAgents} open tabs in your browser. There must only be {2 - numCustomAgents}. Please try again.\n")
 
-        # Selenium has an annoying problem where it can't tell tab position (ie: first tab) and the tab position doesn't necessarily correspond to the order in the retrieved list.
-        # We get around this by looking in the entire page for the exact agent name preceded by "<" under the assumption this will not occur in the conversation and will only be present within the agent's page code.
-        # We get around duplicates (ie: character.ai donald trump talking to character.ai donald trump) with the second if condition. Not foolproof, will likely fail cross-platform if names are identical.
-        # TODO: find better way of doing this that doesn't introduce more possible failure points.
         else:
-            for handle in handles:
-                driver.switch_to.window(handle)
-                if f">{args.name1}" in driver.page_source:
-                    if (window1 is None) and (window2 != handle):
-                        window1 = handle
-                if f">{args.name2}" in driver.page_source:
-                    if (window2 is None) and (window1 != handle):
-                        window2 = handle
+            window1, window2 = findWindows(driver, [(args.name1, args.type1), (args.name2, args.type2)])
             break
     
     # sanity check for tabs.
-    if (window1 is None) and (args.type1 != "custom"):
+    if (window1 is None) and agent_types[args.type1].needsBrowser:
         print(f"Could not load handle for {args.name1}. This may be because their name wasn't entered exactly as it is shown in the website.")
         return
     
-    if (window2 is None) and (args.type2 != "custom"):
+    if (window2 is None) and agent_types[args.type2].needsBrowser:
         print(f"Could not load handle for {args.name2}. This may be because their name wasn't entered exactly as it is shown in the website.")
         return
     
+    if args.blockresources and (driver is not None):
+        blockResourcesInTabs(driver, [window1, window2])
+
     # configure agents
-    agent1 = None
-    agent2 = None
-    for elem in agent_types.keys():
-        if args.type1 == elem:
-            agent1 = agent_types[elem](args.name1, driver, window1)
-
-        if args.type2 == elem:
-            agent2 = agent_types[elem](args.name2, driver, window2)
-    
-    agents = [agent1, agent2]
-
-    while True:
-
-        # Main loop: For each agent, retrieve its latest message and send it to the other one.
-        self = None
-        other = None
-        for agent in agents:
-            self = agent
-            for elem in agents:
-                if elem != agent:
-                    other = elem
-                    break
-            
-            # get latest message. The regex invoked by stripHtmlTags should clear most HTML tags from the chat.
-            latestOutput = stripHtmlTags(self.getLatestMessage(retries = 5, timeToWaitBetweenRetries = 5)) 
-            
-            # this converts unicode chars to UTF-8. Replika once added an emoji into the text body that broke the program because the emoji was unicode.
-            latestOutput = unicodedata.normalize('NFKD', latestOutput).encode('utf-8', 'ignore').decode('utf-8')
-
-            # I found that the AIs sometimes wouldn't know who the other was (ie: if they didn't mention it during greeting), so agent name seeded during first greeting.
-            # Also add topic prompt.
-            if self.getCurrentMessage() == "":
-                log_print(f"In introduction stage, seeding greeting with agent name {self} and topic prompt.")
-                latestOutput += f". I am {self.getName()}. Let's talk about {topic}."
-            
-            # I found that multiple character.ai AIs could get "deadlocked" (talking about the same thing over and over) after a certain amount of time, so we can seed conversation with prompt after certain number of messages.
-            if args.deadlockavoidance:
-                if messageCounter >= deadLockLimit:
-                    log_print(f"Automated deadlock avoidance activated, resetting message counter and seeding prompt.")
-                    latestOutput = f"{deadlock_avoidance_prompt}"
-                    messageCounter = 0
-                    addlog("--SYSTEM-- DEADLOCK AVOIDANCE ACTIVATED")
-
-            log_print(f"Updating {self.getName()}'s latest message and relaying to {other.getName()}...")
-
-            # if a response gets flagged and isn't entered (happened when Donald Trump was talking about the wall, lol), we switch to deadlock avoidance messages.
-            if other.getCurrentMessage() == latestOutput:
-                log_print(f"Error, response was not created, seeding with topic  prompt")
-                latestOutput = f"I am {self.getName()}. Let's talk about {topic}."
-
-            self.setCurrentMessage(latestOutput)
-            print(f"{self.getName()} entered message: '{latestOutput}'")   
-            addlog(f"{self.getName()}: {latestOutput}")
-
-            other.sendMessage(latestOutput, retries = 5, timeToWaitBetweenRetries = 5)
-            
-            """
-            If we are running a custom agent, there is no need to have a a hardcoded wait for a web response as we are assuming either:
-               1. The custom agent is being run locally and will block until a response is received
-               2. The custom agent is being run remotely but its code is designed to block until a response is received and will handle timeouts, etc. on its own.
-
-            Consequently, we only use a wait timer between message sending if the agent is run in the browser through selenium.
-            """
-            if other.getType() != 'custom':
-                timeToSleep = 20 + random.uniform(0,2)
-                print(f"Message sent. Waiting {timeToSleep} seconds for response...")
-                time.sleep(timeToSleep)
-
-            if args.deadlockavoidance:
-                messageCounter += 1
-                log_print(f"{messageCounter} messages sent. {deadLockLimit - messageCounter} until we seed conversation to try to avoid deadlock.")
+    cache = createResponseCache(args.cache, args.cachesize)
+    conversationName = f"{args.name1}_{args.name2}"
+    agent1 = createAgent(args.type1, args.name1, driver, window1, cache)
+    agent2 = createAgent(args.type2, args.name2, driver, window2, cache)
+
+    conversation = Conversation([agent1, agent2], topic, addlog, deadlockAvoidance = args.deadlockavoidance, deadLockLimit = deadLockLimit, deadlockPrompt = deadlock_avoidance_prompt, responseTimeout = responseTimeout, deadlockDetector = createDeadlockDetector(args.deadlocksimilarity), stream = args.stream, maxChars = args.maxchars, checkpointPath = createCheckpointPath(args.checkpoint, conversationName))
+
+    if args.resume and not conversation.resume(reattached):
+        print(f"No checkpoint for {conversationName} in {args.checkpoint}, starting a new conversation.")
+
+    # Main loop: For each agent, retrieve its latest message and send it to the other one. Runs until stopped, or until a replay agent's log runs out.
+    try:
+        while True:
+            conversation.relayTurn()
+    except ReplayFinished as e:
+        print(f"Replay finished: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
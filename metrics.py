@@ -0,0 +1,186 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+"""
+In-process tracing and metrics for the relay loop. Code is instrumented with span("name", label = value) blocks, the @traced decorator on agent
+methods, and increment() for counters such as retries. Every span's timing is aggregated per (name, labels) and the most recent spans are kept
+as trace events. The aggregates are served in Prometheus text format on /metrics and the events as a Chrome trace (chrome://tracing, Perfetto)
+on /trace, or dumped to a file at exit.
+
+Everything is off until enable() is called (see configure()). While off, span() returns a shared do-nothing object and increment() returns straight away.
+"""
+
+enabled = False
+maxTraceEvents = 100000 # most recent spans kept for the Chrome trace.
+
+lock = threading.Lock()
+spanStats = {} # (name, labels) -> [count, sum, max] in seconds.
+counters = {} # (name, labels) -> value.
+traceEvents = deque(maxlen = maxTraceEvents)
+startTime = time.perf_counter()
+
+def enable():
+    global enabled
+    enabled = True
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+class Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        record(self.name, self.labels, self.start, time.perf_counter() - self.start)
+        return False
+
+def record(name, labels, start, duration):
+    key = (name, labelKey(labels))
+
+    with lock:
+        stats = spanStats.get(key)
+        if stats is None:
+            spanStats[key] = [1, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+        traceEvents.append({"name": name, "ph": "X", "ts": (start - startTime) * 1e6, "dur": duration * 1e6, "pid": os.getpid(), "tid": threading.get_ident(), "args": {k: str(v) for k, v in labels.items()}})
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+noSpan = NoSpan()
+
+# Times the block it wraps, ie: with span("sendMessage", platform = "Replika"): ...
+def span(name, **labels):
+    if not enabled:
+        return noSpan
+    return Span(name, labels)
+
+# Records a duration measured elsewhere (ie: time a request spent queued) as a span of that length ending now.
+def observe(name, seconds, **labels):
+    if not enabled:
+        return
+    record(name, labels, time.perf_counter() - seconds, seconds)
+
+def increment(name, value = 1, **labels):
+    if not enabled:
+        return
+
+    key = (name, labelKey(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+# Decorator for Agent methods: times each call as a span labelled with the agent's platform and name.
+def traced(name):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not enabled:
+                return method(self, *args, **kwargs)
+            with Span(name, {"platform": self.type, "agent": self.name}):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def formatLabels(labels):
+    return ",".join(f'{k}="{escapeLabel(v)}"' for k, v in labels)
+
+# Prometheus text exposition format.
+def prometheusText():
+    lines = []
+
+    with lock:
+        stats = list(spanStats.items())
+        counts = list(counters.items())
+
+    lines.append("# TYPE relay_span_seconds summary")
+    for (name, labels), (count, total, _) in stats:
+        labelText = formatLabels((("span", name),) + labels)
+        lines.append(f"relay_span_seconds_count{{{labelText}}} {count}")
+        lines.append(f"relay_span_seconds_sum{{{labelText}}} {total:.6f}")
+
+    lines.append("# TYPE relay_span_max_seconds gauge")
+    for (name, labels), (_, _, longest) in stats:
+        lines.append(f"relay_span_max_seconds{{{formatLabels((('span', name),) + labels)}}} {longest:.6f}")
+
+    byName = {}
+    for (name, labels), value in counts:
+        byName.setdefault(name, []).append((labels, value))
+
+    for name, series in byName.items():
+        lines.append(f"# TYPE relay_{name}_total counter")
+        for labels, value in series:
+            lines.append(f"relay_{name}_total{{{formatLabels(labels)}}} {value}")
+
+    return "\n".join(lines) + "\n"
+
+def chromeTrace():
+    with lock:
+        return {"traceEvents": list(traceEvents), "displayTimeUnit": "ms"}
+
+def dumpTrace(path):
+    with open(path, "w") as f:
+        json.dump(chromeTrace(), f)
+
+# Serves /metrics and /trace on localhost from a background thread. http.server is only imported here, since most runs don't serve metrics.
+def startServer(port, host = "127.0.0.1"):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = prometheusText().encode("utf-8")
+                contentType = "text/plain; version=0.0.4"
+            elif self.path == "/trace":
+                body = json.dumps(chromeTrace()).encode("utf-8")
+                contentType = "application/json"
+            else:
+                self.send_error(404, "Expected /metrics or /trace")
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+# Turns on metrics if a port and/or trace file is given: serves the endpoint on port, and writes the Chrome trace to traceFile at exit.
+def configure(port = None, traceFile = None):
+    if port is None and traceFile is None:
+        return
+
+    enable()
+
+    if port is not None:
+        startServer(port)
+        print(f"Metrics on http://127.0.0.1:{port}/metrics, trace on http://127.0.0.1:{port}/trace")
+
+    if traceFile is not None:
+        atexit.register(dumpTrace, traceFile)
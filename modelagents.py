@@ -0,0 +1,106 @@
+import os
+import uuid
+
+import metrics
+from retry import retryCall
+import inference
+import remote
+from Agent import customAgent
+
+"""
+Custom agents backed by a model: in the shared inference server ("served"), on CPU in this process ("cpu") or behind an OpenAI-compatible API ("remote").
+Agent.py's agent_types only imports this file the first time one of these types is looked up, so other runs don't load inference.py or remote.py.
+"""
+
+# A custom agent whose model runs in the shared inference server (see inference.py), so many conversations use one copy of the model and are batched together.
+# Start the server first, ie: python inference.py --backend transformers --model <model id>
+class servedAgent(customAgent):
+
+    serverAddress = ("127.0.0.1", inference.defaultPort) # set with --inferenceserver.
+    maxNewTokens = 512
+
+    def __init__(self, name, driver, window):
+        super().__init__(name, driver, window)
+        self.client = self.createClient()
+        self.session = uuid.uuid4().hex # lets the server reuse the KV cache of this agent's previous turns.
+
+    def createClient(self):
+        return inference.getClient(self.serverAddress)
+
+    # The session is kept, so a server that is still running can reuse the KV cache from before the crash.
+    def getState(self):
+        return dict(super().getState(), session = self.session)
+
+    def setState(self, state):
+        super().setState(state)
+        self.session = state["session"]
+
+    # Sends the whole conversation so far and blocks until the server has generated the reply. Retried (see retry.py) if the server can't be reached.
+    @metrics.traced("sendMessage")
+    def sendMessage(self, message, retryPolicy = None):
+        self.context.add("user", message)
+
+        try:
+            reply = retryCall(lambda: self.client.generate(self.context.messages(), self.maxNewTokens, self.session), "sendMessage", self.type, self.name, retryPolicy)
+        except Exception:
+            self.context.removeLast()
+            raise
+
+        self.context.add("assistant", reply)
+        self.currentMessage = reply
+
+    # Yields the reply as the server generates it. If the caller stops early, the server stops generating and the reply is what was yielded so far.
+    def streamMessage(self, message, retryPolicy = None):
+        self.context.add("user", message)
+        reply = ""
+        pieces = None
+
+        try:
+            pieces = retryCall(lambda: self.client.stream(self.context.messages(), self.maxNewTokens, self.session), "streamMessage", self.type, self.name, retryPolicy)
+            for piece in pieces:
+                reply += piece
+                yield piece
+
+        finally:
+            if pieces is not None:
+                pieces.close()
+
+            if reply == "":
+                self.context.removeLast()
+            else:
+                self.context.add("assistant", reply)
+                self.currentMessage = reply
+
+# Same as servedAgent, with the model running on CPU in this process instead of in a server. Agents with the same settings share one model and are batched together.
+# The model (and torch and transformers) is only loaded when it is first needed, or in the background from startup if warmUp() is called.
+class cpuAgent(servedAgent):
+
+    modelId = "Qwen/Qwen2.5-0.5B-Instruct" # set with --cpumodel.
+    threads = None # intra-op threads, set with --threads. None for one per physical core.
+    interopThreads = None # set with --interopthreads.
+    quantization = None # None, "int8" or "int4", set with --quantize.
+
+    @classmethod
+    def getEngine(cls):
+        settings = (cls.modelId, cls.threads, cls.interopThreads, cls.quantization)
+        return inference.getLocalEngine(settings, lambda: inference.TransformersBackend(cls.modelId, device = "cpu", threads = cls.threads, interopThreads = cls.interopThreads, quantization = cls.quantization))
+
+    @classmethod
+    def warmUp(cls):
+        cls.getEngine().warmUp()
+
+    def createClient(self):
+        return inference.LocalClient(self.getEngine())
+
+# A custom agent whose model is behind an OpenAI-compatible chat completions endpoint (see remote.py). Agents using the same endpoint share its connections,
+# and at most maxConcurrent of their requests are in flight at once. The API key is read from the environment variable apiKeyVariable, if it is set.
+class remoteAgent(servedAgent):
+
+    baseUrl = f"http://127.0.0.1:{inference.defaultPort}/v1" # set with --remoteurl.
+    modelId = None # set with --remotemodel. None lets the endpoint choose.
+    apiKeyVariable = "OPENAI_API_KEY"
+    maxConcurrent = 8 # set with --remoteconcurrency.
+    requestTimeout = 120 # seconds, set with --remotetimeout.
+
+    def createClient(self):
+        return remote.getRemoteClient(self.baseUrl, self.modelId, os.environ.get(self.apiKeyVariable), self.maxConcurrent, self.requestTimeout)
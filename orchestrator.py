@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import functools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import util
+from util import *
+from Agent import *
+from conversation import Conversation, GroupConversation, limitStream
+from logwriter import isValidTimezone
+import metrics
+from retry import RetryError, setWaitHook
+import main as relay
+
+# Runs many conversations in one process. Each conversation's turns are coroutines and every blocking agent call runs in a thread, so while one
+# conversation waits for a reply the others keep going. Calls on agents without a browser (ie: custom agents) share a bounded thread pool.
+# A Selenium driver has shared state (the tab it is switched to), so every call on a web agent holds a lock for its driver. Waiting for replies is done
+# by polling between awaits rather than inside a thread, so the lock is only held per scrape.
+class ConversationOrchestrator:
+    def __init__(self, maxWorkers = 8, pollInterval = 0.5, settleTime = 2):
+        self.executor = ThreadPoolExecutor(max_workers = maxWorkers)
+        self.pollInterval = pollInterval
+        self.settleTime = settleTime
+        self.locks = {}
+        self.driverLocks = {}
+        self.agentExecutors = {}
+
+    # Agents without a driver each get a lock, so their calls run one at a time.
+    def getLock(self, agent):
+        if id(agent) not in self.locks:
+            self.locks[id(agent)] = asyncio.Lock()
+        return self.locks[id(agent)]
+
+    # Agents sharing a driver share a lock. It is taken by the thread running the call rather than by the coroutine awaiting it (see callWithDriver()),
+    # so whoever holds it is always running and the others can't be stuck waiting on a call that has no thread yet.
+    def getDriverLock(self, agent):
+        if id(agent.driver) not in self.driverLocks:
+            self.driverLocks[id(agent.driver)] = threading.Lock()
+        return self.driverLocks[id(agent.driver)]
+
+    # Each web agent's calls run in a thread of its own, so calls waiting for the driver or for a retry don't take threads from the shared pool.
+    def getAgentExecutor(self, agent):
+        if id(agent) not in self.agentExecutors:
+            self.agentExecutors[id(agent)] = ThreadPoolExecutor(max_workers = 1)
+        return self.agentExecutors[id(agent)]
+
+    # Runs a blocking agent method in a thread: in the shared pool for agents without a driver, in the agent's own thread holding its driver's lock for web agents.
+    async def call(self, agent, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        if agent.driver is None:
+            async with self.getLock(agent):
+                return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+        return await loop.run_in_executor(self.getAgentExecutor(agent), functools.partial(callWithDriver, self.getDriverLock(agent), agent, method, *args, **kwargs))
+
+    # Async equivalent of Agent.waitForResponse().
+    async def waitForResponse(self, agent, timeout):
+        watcher = StableTextWatcher([agent.lastSentMessage], self.settleTime)
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            try:
+                text = await self.call(agent, pollUnreadMessage, agent)
+            except Exception:
+                text = None
+
+            if watcher.update(text):
+                return True
+
+            await asyncio.sleep(self.pollInterval)
+
+        return False
+
+    # Same stages as Conversation.relayTurn(), with the blocking calls awaited.
+    async def relayTurn(self, conversation):
+        with metrics.span("turn", conversation = conversation.getName()):
+            try:
+                await self.relayTurnStages(conversation)
+            except RetryError as e:
+                conversation.pauseTurn(e)
+
+    async def relayTurnStages(self, conversation):
+        speaker, listener = conversation.currentPair()
+
+        if conversation.stage is None:
+            latestOutput = await self.call(speaker, speaker.getLatestMessage)
+            conversation.holdPrepared(conversation.prepareMessage(speaker, listener, latestOutput))
+
+        if conversation.stage == "prepared":
+            conversation.markSent(listener)
+
+            if conversation.stream and not listener.needsBrowser:
+                await self.streamReply(conversation, listener, conversation.preparedMessage)
+            else:
+                await self.call(listener, listener.sendMessage, conversation.preparedMessage)
+
+            conversation.acknowledgeSent()
+
+        if not listener.hasReply():
+            if not await self.waitForResponse(listener, conversation.responseTimeout):
+                log_print(f"{listener.getName()} did not finish replying within {conversation.responseTimeout} seconds, continuing anyway.")
+
+        conversation.finishTurn()
+
+    # Same as Conversation.streamReply(), taking the locks a piece at a time so other conversations can use the next listener's driver in between.
+    async def streamReply(self, conversation, listener, message):
+        pieces = limitStream(listener.streamMessage(message), conversation.maxChars)
+        target = conversation.nextListener()
+
+        try:
+            if target.needsBrowser:
+                await self.call(target, target.startStreamedInput)
+
+            while True:
+                piece = await self.call(listener, next, pieces, None)
+                if piece is None:
+                    break
+
+                if target.needsBrowser:
+                    await self.call(target, target.typeChunk, piece)
+        finally:
+            await self.call(listener, pieces.close)
+
+    # Relays turns until maxTurns is reached, or forever if it is None, or until a replay agent's log runs out.
+    async def runConversation(self, conversation, maxTurns = None):
+        turns = 0
+        try:
+            if isinstance(conversation, GroupConversation):
+                await self.runGroup(conversation, maxTurns)
+                return
+
+            while (maxTurns is None) or (turns < maxTurns):
+                await self.relayTurn(conversation)
+                turns += 1
+        except ReplayFinished as e:
+            print(f"Conversation {conversation.getName()} finished: {e}")
+
+    # Runs a GroupConversation: each reply is sent to all the other agents at once, and the next speaker is whichever agent's reply is ready first.
+    # Agents whose reply is ready are put on the ready queue by their delivery task, errors other than running out of retries are put there too.
+    async def runGroup(self, conversation, maxTurns = None):
+        ready = asyncio.Queue()
+        tasks = set()
+
+        def deliver(agent, message = None):
+            task = asyncio.create_task(self.deliverGroupMessage(conversation, agent, message, ready))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # After a restart, agents that were already sent their message are only waited on, the ones whose message wasn't sent yet are sent it again,
+        # and the others are sent what is in their inbox. A new conversation starts with the first agent's greeting.
+        for agent in conversation.busyAgents():
+            deliver(agent)
+
+        for agent, message in conversation.pendingDeliveries():
+            deliver(agent, message)
+
+        for agent in conversation.waitingAgents():
+            deliver(agent, conversation.takeInbox(agent))
+
+        if len(tasks) == 0:
+            ready.put_nowait(conversation.agents[0])
+
+        turns = 0
+        while (maxTurns is None) or (turns < maxTurns):
+            speaker = await ready.get()
+            if isinstance(speaker, Exception):
+                raise speaker
+
+            with metrics.span("turn", conversation = conversation.getName()):
+                try:
+                    message = await self.call(speaker, speaker.getLatestMessage)
+                except RetryError as e:
+                    conversation.pauseTurn(e)
+                    ready.put_nowait(speaker)
+                    continue
+
+                message = conversation.prepareMessage(speaker, None, message)
+                listeners = conversation.broadcast(speaker, message)
+                if conversation.finishReply(speaker):
+                    listeners.append(speaker)
+
+                for listener in listeners:
+                    deliver(listener, conversation.takeInbox(listener))
+
+            turns += 1
+
+        for task in tasks:
+            task.cancel()
+
+    # Sends message to one agent of a group and puts the agent on the ready queue once its reply is there. With no message, only waits for the reply.
+    async def deliverGroupMessage(self, conversation, agent, message, ready):
+        try:
+            while message is not None:
+                try:
+                    conversation.markSent(agent)
+                    await self.call(agent, agent.sendMessage, message)
+                    conversation.acknowledgeDelivery(agent)
+                    break
+                except RetryError as e:
+                    conversation.pauseTurn(e)
+
+            if not agent.hasReply():
+                if not await self.waitForResponse(agent, conversation.responseTimeout):
+                    log_print(f"{agent.getName()} did not finish replying within {conversation.responseTimeout} seconds, continuing anyway.")
+
+            ready.put_nowait(agent)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ready.put_nowait(e)
+
+    # Runs all conversations concurrently. A conversation that raises is reported and stopped without affecting the others.
+    async def run(self, conversations, maxTurns = None):
+        results = await asyncio.gather(*[self.runConversation(j, maxTurns) for j in conversations], return_exceptions = True)
+
+        for conversation, result in zip(conversations, results):
+            if isinstance(result, Exception):
+                print(f"Conversation {conversation.getName()} stopped: {result}")
+
+        self.executor.shutdown(wait = False)
+        for executor in self.agentExecutors.values():
+            executor.shutdown(wait = False)
+
+# Calls method holding the driver's lock. Runs in the agent's thread. The lock is let go while the method waits to retry (see retry.pause()), so a retrying
+# or paused agent doesn't hold up the other agents on the same driver, and once it has the lock again the driver is switched back to the agent's tab.
+def callWithDriver(lock, agent, method, *args, **kwargs):
+    def wait(seconds):
+        lock.release()
+        try:
+            time.sleep(seconds)
+        finally:
+            lock.acquire()
+        agent.focus()
+
+    with lock:
+        setWaitHook(wait)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            setWaitHook(None)
+
+# Switches to the agent's tab and reads its latest message if it hasn't been consumed yet. Runs inside the thread pool.
+def pollUnreadMessage(agent):
+    agent.focus()
+    return agent.scrapeUnreadMessage()
+
+"""
+Pairings file format: a JSON list with one object per conversation, ie:
+
+    [{"name1": "Jack", "type1": "character.ai", "name2": "Jill", "type2": "Replika", "topic": "trains"}, ...]
+
+topic is optional and defaults to the topic in main.py. "replay" agents need the log they play back as "replay" (see Agent.py).
+A group conversation lists its agents instead, each with a name and type (and replay for replay agents):
+
+    {"agents": [{"name": "Jack", "type": "character.ai"}, {"name": "Jill", "type": "Replika"}, {"name": "Llama", "type": "cpu"}], "topic": "trains"}
+"""
+
+# The (name, type, replay log) of each agent in a pairing.
+def pairingAgents(pairing):
+    if "agents" in pairing:
+        return [(j["name"], j["type"], j.get("replay", pairing.get("replay"))) for j in pairing["agents"]]
+    return [(pairing[f"name{i}"], pairing[f"type{i}"], pairing.get("replay")) for i in [1, 2]]
+
+# Checks the agent types of the pairings. Returns an error message, or None if they are all valid.
+def checkPairings(pairings):
+    for pairing in pairings:
+        for name, agentType, replayLog in pairingAgents(pairing):
+            if agentType not in agent_types:
+                return f"Error: agent type {agentType} is invalid. Supported agent types: {agent_types}"
+
+    return None
+
+# Sets up the agents and conversations of pairings and runs them until they finish. args are the arguments added by relay.addConversationArguments().
+def runPairings(pairings, args, maxWorkers = 8):
+    relay.warmUpAgents([agentType for pairing in pairings for name, agentType, replayLog in pairingAgents(pairing)])
+
+    # All web agents share one browser, with one tab per web agent.
+    webAgents = [(name, agentType) for pairing in pairings for name, agentType, replayLog in pairingAgents(pairing) if agent_types[agentType].needsBrowser]
+    driver = None
+    windows = []
+    reattached = False
+
+    if len(webAgents) > 0:
+        driver = relay.createDriver(debuggingPort = None if args.checkpoint is None else relay.debuggingPort, attach = args.resume, blockResources = args.blockresources)
+
+        # When resuming in a browser left open by the previous run, the tabs are recognized without asking.
+        if args.resume:
+            windows = relay.findWindows(driver, webAgents)
+            reattached = None not in windows
+
+        if not reattached:
+            _ = input(f"Press Enter when you have authenticated into your accounts and opened one chat tab for each of: {', '.join(j[0] for j in webAgents)}")
+            windows = relay.findWindows(driver, webAgents)
+
+        for (name, _), window in zip(webAgents, windows):
+            if window is None:
+                print(f"Could not load handle for {name}. This may be because their name wasn't entered exactly as it is shown in the website.")
+                return
+
+        if args.blockresources:
+            relay.blockResourcesInTabs(driver, windows)
+
+    cache = relay.createResponseCache(args.cache, args.cachesize)
+    conversations = []
+    windows = iter(windows)
+    for pairing in pairings:
+        agents = []
+        for name, agentType, replayLog in pairingAgents(pairing):
+            window = next(windows) if agent_types[agentType].needsBrowser else None
+            agents.append(relay.createAgent(agentType, name, driver, window, cache, replayLog))
+
+        names = [agent.getName() for agent in agents]
+        kind = GroupConversation if "agents" in pairing else Conversation
+        addlog = relay.createLogger(names, args.timezone, args.logmaxsize)
+        conversation = kind(agents, pairing.get("topic", relay.topic), addlog, deadlockAvoidance = args.deadlockavoidance, deadLockLimit = args.deadlockthreshold, deadlockPrompt = relay.deadlock_avoidance_prompt, responseTimeout = args.responsetimeout, deadlockDetector = relay.createDeadlockDetector(args.deadlocksimilarity), stream = args.stream, maxChars = args.maxchars,
+                            checkpointPath = relay.createCheckpointPath(args.checkpoint, "_".join(names)))
+
+        if args.resume:
+            conversation.resume(reattached)
+
+        conversations.append(conversation)
+
+    asyncio.run(ConversationOrchestrator(maxWorkers = maxWorkers).run(conversations))
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--pairings", type=str, help="JSON file listing the conversations to run.", required=True, action = "store")
+    parser.add_argument("-n", "--workers", type=int, help="Maximum number of blocking calls on agents without a browser (ie: custom agents) to run at once. Default is 8.", default=8, action="store")
+    relay.addConversationArguments(parser)
+    args = parser.parse_args()
+
+    with open(args.pairings) as f:
+        pairings = json.load(f)
+
+    error = checkPairings(pairings)
+    if error is not None:
+        print(error)
+        return
+
+    if not isValidTimezone(args.timezone):
+        print(f"Error: {args.timezone} is not a known timezone. Exiting.")
+        return
+
+    if args.resume and (args.checkpoint is None):
+        print("Error: --resume needs the --checkpoint directory to resume from. Exiting.")
+        return
+
+    if args.verbose:
+        util.verbosity = True
+
+    metrics.configure(args.metricsport, args.tracefile)
+    relay.configureCustomAgents(vars(args))
+    relay.configureWebAgents(vars(args))
+    runPairings(pairings, args, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+from util import *
+import metrics
+from inference import InferenceClient
+
+"""
+Client for remote models behind an OpenAI-compatible chat completions endpoint (OpenAI, vLLM, llama.cpp server, Ollama, ...), used by remoteAgent in modelagents.py.
+
+Every agent using the same endpoint shares one client: its connections are kept alive and reused (see InferenceClient), so a turn doesn't pay for a new
+TCP and TLS handshake. At most maxConcurrent requests are in flight at once and the rest wait their turn, so many conversations don't swamp the endpoint.
+Each request has a deadline of timeout seconds, including reading a streamed reply. Replies can be streamed as server-sent events.
+
+The local inference server serves the same API, so remote agents can be tried without an account:
+
+    python inference.py --backend stub
+    python main.py --name1 "Jack" --type1 remote --name2 "Jill" --type2 remote --remoteurl http://127.0.0.1:8100/v1
+"""
+
+# An iterator over a streamed reply that gives back its slot (see OpenAIClient.maxConcurrent) once it is finished or closed.
+class RemoteStream:
+    def __init__(self, pieces, release):
+        self.pieces = pieces
+        self.releaseSlot = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.pieces)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self.pieces.close()
+
+        if self.releaseSlot is not None:
+            self.releaseSlot()
+            self.releaseSlot = None
+
+class OpenAIClient(InferenceClient):
+    def __init__(self, baseUrl, model = None, apiKey = None, maxConcurrent = 8, timeout = 120, temperature = None):
+        url = urlsplit(baseUrl)
+        self.secure = url.scheme == "https"
+        super().__init__(url.hostname, url.port or (443 if self.secure else 80), poolSize = maxConcurrent, timeout = timeout)
+        self.path = url.path.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.apiKey = apiKey
+        self.temperature = temperature
+        self.slots = threading.BoundedSemaphore(maxConcurrent)
+
+    def connect(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, self.port, timeout = self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+
+    def getHeaders(self, body):
+        headers = super().getHeaders(body)
+        if self.apiKey is not None:
+            headers["Authorization"] = f"Bearer {self.apiKey}"
+        return headers
+
+    def createBody(self, messages, maxNewTokens, stream):
+        body = {"messages": messages, "max_tokens": maxNewTokens, "stream": stream}
+
+        if self.model is not None:
+            body["model"] = self.model
+        if self.temperature is not None:
+            body["temperature"] = self.temperature
+
+        return body
+
+    # Waits for one of the maxConcurrent slots. Time spent waiting doesn't count towards the request's timeout.
+    def acquireSlot(self):
+        with metrics.span("remoteSlotWait", host = self.host):
+            self.slots.acquire()
+
+    # session is accepted for compatibility with InferenceClient, remote endpoints keep no state between requests.
+    def generate(self, messages, maxNewTokens = 512, session = None):
+        self.acquireSlot()
+
+        try:
+            with metrics.span("remoteRequest", host = self.host):
+                result = self.request("POST", self.path, self.createBody(messages, maxNewTokens, False))
+        except RuntimeError as e:
+            raise RuntimeError(f"Remote model at {self.host}: {e}") from e
+        finally:
+            self.slots.release()
+
+        return result["choices"][0]["message"]["content"] or ""
+
+    # Starts generating and returns an iterator over the text as it arrives. Closing it early closes its connection, which stops the generation.
+    def stream(self, messages, maxNewTokens = 512, session = None):
+        self.acquireSlot()
+
+        try:
+            connection, response = self.open("POST", self.path, self.createBody(messages, maxNewTokens, True))
+
+            if response.status != 200:
+                data = response.read()
+                self.release(connection)
+                raise RuntimeError(f"Remote model at {self.host} error {response.status}: {data[:500].decode('utf-8', errors = 'replace')}")
+
+        except BaseException:
+            self.slots.release()
+            raise
+
+        return RemoteStream(self.readEvents(connection, response), self.slots.release)
+
+    # Reads chat.completion.chunk events until "data: [DONE]", yielding the content of each. Raises TimeoutError past the request's deadline.
+    def readEvents(self, connection, response):
+        deadline = time.monotonic() + self.timeout
+        finished = False
+
+        try:
+            while True:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Remote model at {self.host}: reply took longer than {self.timeout} seconds.")
+
+                line = response.readline()
+                if not line:
+                    raise ConnectionError(f"Remote model at {self.host} ended the stream early.")
+
+                if not line.startswith(b"data:"):
+                    continue
+
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    finished = True
+                    return
+
+                event = json.loads(data)
+                if "error" in event:
+                    raise RuntimeError(f"Remote model at {self.host} error: {event['error']}")
+
+                if event.get("choices"):
+                    piece = event["choices"][0].get("delta", {}).get("content")
+                    if piece:
+                        yield piece
+
+        finally:
+            if finished:
+                response.read()
+                self.release(connection)
+            else:
+                connection.close()
+
+clients = {}
+clientsLock = threading.Lock()
+
+# One client (and connection pool) per endpoint and settings, shared by every agent in the process.
+def getRemoteClient(baseUrl, model = None, apiKey = None, maxConcurrent = 8, timeout = 120, temperature = None):
+    key = (baseUrl, model, apiKey, maxConcurrent, timeout, temperature)
+
+    with clientsLock:
+        if key not in clients:
+            clients[key] = OpenAIClient(baseUrl, model, apiKey, maxConcurrent, timeout, temperature)
+        return clients[key]
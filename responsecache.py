@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from util import *
+import metrics
+
+"""
+On-disk cache of agent replies, so rerunning an experiment doesn't have to go to the site or the model again for turns it has already seen.
+
+A reply is stored under the SHA-256 of the agent's identity (type, name and model, if any) and every message the agent has been sent so far, so the
+same agent given the same conversation gets the same reply back. Each reply is a file in the cache directory. When the directory grows past maxBytes,
+the least recently used replies are deleted (use is tracked with the files' modification times, so it carries over between runs).
+
+CachedAgent wraps any agent. As long as every reply is in the cache, the agent itself is never called. After the first miss, every message goes
+to the real agent so it has the conversation from then on, and its replies are added to the cache.
+"""
+
+class ResponseCache:
+    def __init__(self, directory, maxBytes = 512 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents = True, exist_ok = True)
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+
+        # key -> size in bytes, least recently used first. Other processes sharing the directory aren't seen, so eviction there is approximate.
+        self.entries = OrderedDict()
+        files = sorted(self.directory.glob("*.txt"), key = lambda j: j.stat().st_mtime)
+        for path in files:
+            self.entries[path.stem] = path.stat().st_size
+        self.total = sum(self.entries.values())
+
+    @staticmethod
+    def makeKey(identity, messages):
+        import hashlib # only loaded when --cache is used.
+        return hashlib.sha256(json.dumps([identity, messages]).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.txt"
+
+    def get(self, key):
+        try:
+            text = self.path(key).read_text(encoding = "utf-8")
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            metrics.increment("cache_misses")
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+        metrics.increment("cache_hits")
+        return text
+
+    def put(self, key, text):
+        path = self.path(key)
+        data = text.encode("utf-8")
+
+        # Written to a temporary file and renamed, so a reader never sees half a reply.
+        temporary = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        temporary.write_bytes(data)
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.total += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+
+            while (self.total > self.maxBytes) and (len(self.entries) > 1):
+                oldKey, size = self.entries.popitem(last = False)
+                self.total -= size
+
+                try:
+                    self.path(oldKey).unlink()
+                except FileNotFoundError:
+                    pass
+
+# Serves an agent's replies from a ResponseCache when it can, see above. Everything else is passed through to the agent.
+class CachedAgent:
+    def __init__(self, agent, cache):
+        self.agent = agent
+        self.cache = cache
+        self.identity = [agent.getType(), agent.getName(), getattr(agent, "modelId", None)]
+        self.received = [] # every message sent to the agent so far.
+        self.cachedReply = None # the reply to the last message sent, when it came from the cache.
+        self.live = False # True once a reply has had to come from the agent.
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def key(self):
+        return self.cache.makeKey(self.identity, self.received)
+
+    # Looks up the reply to the conversation so far, unless the agent has gone live. Returns None on a miss.
+    def lookup(self):
+        if self.live:
+            return None
+
+        reply = self.cache.get(self.key())
+        if reply is None:
+            log_print(f"CachedAgent: no cached reply for {self.agent.getName()} after {len(self.received)} messages, using the agent from now on.")
+            self.live = True
+
+        return reply
+
+    def getLatestMessage(self, **kwargs):
+        reply = self.cachedReply if self.cachedReply is not None else self.lookup()
+        self.cachedReply = None
+
+        if reply is None:
+            reply = self.agent.getLatestMessage(**kwargs)
+            self.cache.put(self.key(), reply)
+
+        # Agents without a browser keep their reply as their current message, which tells Conversation.prepareMessage() the greeting is done.
+        elif not self.agent.needsBrowser:
+            self.agent.setCurrentMessage(reply)
+
+        return reply
+
+    # On a hit the agent isn't sent the message. Agents that keep their own history (see context.py) are given the turn anyway, in case they go live later.
+    def sendMessage(self, message, **kwargs):
+        self.received.append(message)
+        self.cachedReply = self.lookup()
+
+        if self.cachedReply is None:
+            self.agent.sendMessage(message, **kwargs)
+        elif hasattr(self.agent, "context"):
+            self.agent.context.add("user", message)
+            self.agent.context.add("assistant", self.cachedReply)
+
+    def streamMessage(self, message, **kwargs):
+        self.received.append(message)
+        self.cachedReply = self.lookup()
+
+        if self.cachedReply is None:
+            yield from self.agent.streamMessage(message, **kwargs)
+        else:
+            yield self.cachedReply
+
+    def getState(self):
+        return dict(self.agent.getState(), cache = {"received": self.received, "cachedReply": self.cachedReply, "live": self.live})
+
+    def setState(self, state):
+        self.agent.setState(state)
+        self.received = state["cache"]["received"]
+        self.cachedReply = state["cache"]["cachedReply"]
+        self.live = state["cache"]["live"]
+
+    def hasReply(self):
+        return (self.cachedReply is not None) or self.agent.hasReply()
+
+    def waitForResponse(self, timeout = 60, **kwargs):
+        if self.cachedReply is not None:
+            return True
+        return self.agent.waitForResponse(timeout = timeout, **kwargs)
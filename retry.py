@@ -0,0 +1,182 @@
+import random
+import threading
+import time
+
+from util import *
+import metrics
+
+"""
+Shared retry handling for agent operations.
+
+RetryPolicy decides how often and how long to wait between attempts: exponential backoff with decorrelated jitter
+(each wait is random between baseDelay and three times the previous wait, capped at maxDelay), limited by a number of retries and an overall deadline.
+
+Exceptions are classified before retrying: errors meaning the browser or tab is gone (or a programming error or missing module) are fatal and raised straight away,
+everything else (element not there yet, stale element, message not ready, ...) is retried.
+
+Each platform has a CircuitBreaker. When operations on a platform keep running out of retries, the breaker opens and further calls on that platform
+wait out a cooldown before trying again (pausing the agent instead of hammering a failing site), after which a single trial call decides whether it closes again.
+A failure only counts once its RetryError escapes the agent (see RetryError.recordFailure()), so a caller that falls back on something else, ie: a web
+agent carrying on with the latest message when no new one appeared, doesn't open the breaker.
+
+Waits (backoff and open breakers) go through pause(), which a thread can hand to a hook of its own, ie: so the orchestrator lets go of the driver while waiting.
+"""
+
+# Raised by an operation when what it is waiting for isn't there yet. Always retryable.
+class NotReadyError(Exception):
+    pass
+
+# Raised when an operation ran out of retries or hit its deadline on retryable errors.
+class RetryError(Exception):
+    def __init__(self, message, platform = None):
+        super().__init__(message)
+        self.platform = platform
+
+    # Counts the failure against the platform's circuit breaker. Called where the error ends a turn (see Conversation.pauseTurn()).
+    def recordFailure(self):
+        if self.platform is not None:
+            getCircuitBreaker(self.platform).recordFailure()
+
+waitHooks = threading.local()
+
+# Sets how retryCall() waits in the calling thread: hook(seconds) instead of time.sleep(seconds). None goes back to time.sleep.
+def setWaitHook(hook):
+    waitHooks.hook = hook
+
+def pause(seconds):
+    hook = getattr(waitHooks, "hook", None)
+    if hook is None:
+        time.sleep(seconds)
+    else:
+        hook(seconds)
+
+# Selenium exceptions that mean the session, browser or tab is gone, so retrying can't help. Matched by name so Selenium doesn't have to be imported here.
+fatalExceptionNames = {"NoSuchWindowException", "InvalidSessionIdException", "SessionNotCreatedException", "NoSuchDriverException", "InvalidArgumentException"}
+fatalMessageFragments = ["disconnected", "not reachable", "invalid session id", "no such window", "target window already closed"]
+programmingErrors = (TypeError, AttributeError, NameError, KeyError, AssertionError, ImportError)
+
+def isRetryable(e):
+    if isinstance(e, (NotReadyError, TimeoutError, ConnectionError)):
+        return True
+
+    if isinstance(e, programmingErrors):
+        return False
+
+    if type(e).__name__ in fatalExceptionNames:
+        return False
+
+    message = str(e).lower()
+    return not any(j in message for j in fatalMessageFragments)
+
+class RetryPolicy:
+    def __init__(self, retries = 5, baseDelay = 0.5, maxDelay = 10, deadline = 60):
+        self.retries = retries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.deadline = deadline # seconds for the whole operation, including waits. None for no deadline.
+
+    # Decorrelated jitter: next wait is random between baseDelay and 3x the previous wait.
+    def nextDelay(self, previousDelay):
+        return min(self.maxDelay, random.uniform(self.baseDelay, max(self.baseDelay, previousDelay * 3)))
+
+defaultRetryPolicy = RetryPolicy()
+
+class CircuitBreaker:
+    def __init__(self, name, failureThreshold = 2, cooldown = 60, pollInterval = 1):
+        self.name = name
+        self.failureThreshold = failureThreshold # consecutive failed operations before the breaker opens.
+        self.cooldown = cooldown
+        self.pollInterval = pollInterval # how often callers waiting on another caller's trial call check whether it has finished.
+        self.failures = 0
+        self.openedAt = None
+        self.trialRunning = False
+        self.lock = threading.Lock()
+
+    # Blocks while the breaker is open. Once the cooldown has passed, the first caller through makes the trial call and True is returned to it,
+    # the others keep waiting until the trial closes the breaker (see recordSuccess()) or ends without doing so (see endTrial()).
+    def waitUntilClosed(self):
+        paused = False
+
+        while True:
+            with self.lock:
+                if self.openedAt is None:
+                    return False
+
+                remaining = self.openedAt + self.cooldown - time.monotonic()
+                if (remaining <= 0) and not self.trialRunning:
+                    self.trialRunning = True
+                    return True
+
+            if not paused:
+                log_print(f"Circuit breaker for {self.name} is open after repeated failures, pausing for {max(remaining, 0):.1f} seconds.")
+                metrics.increment("circuit_pauses", platform = self.name)
+                paused = True
+
+            pause(remaining if remaining > 0 else self.pollInterval)
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trialRunning = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failureThreshold:
+                self.openedAt = time.monotonic()
+
+    # Called when a trial call ends without succeeding. If its failure escapes, recordFailure() restarts the cooldown, otherwise the next caller gets a trial.
+    def endTrial(self):
+        with self.lock:
+            self.trialRunning = False
+
+circuitBreakers = {}
+circuitBreakersLock = threading.Lock()
+
+def getCircuitBreaker(platform):
+    with circuitBreakersLock:
+        if platform not in circuitBreakers:
+            circuitBreakers[platform] = CircuitBreaker(platform)
+        return circuitBreakers[platform]
+
+# Calls operation() until it succeeds, following the policy. method, platform and name identify the operation in logs and metrics.
+# Raises fatal errors straight away and RetryError once retries or the deadline run out. Neither counts against the circuit breaker by itself.
+def retryCall(operation, method, platform, name, policy = None):
+    policy = policy or defaultRetryPolicy
+    breaker = getCircuitBreaker(platform)
+    deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+    delay = policy.baseDelay
+    trial = False
+
+    try:
+        for i in range(0, policy.retries + 1):
+            if not trial:
+                trial = breaker.waitUntilClosed()
+
+            try:
+                result = operation()
+                breaker.recordSuccess()
+                trial = False
+                return result
+
+            except Exception as e:
+                if not isRetryable(e):
+                    raise
+
+                log_print(f"{method}() for {platform} agent {name}: {e}")
+                lastError = e
+
+            delay = policy.nextDelay(delay)
+            if (i == policy.retries) or ((deadline is not None) and (time.monotonic() + delay > deadline)):
+                break
+
+            log_print(f"{method}() for {platform} agent {name}: Retry {i + 1}. Waiting {delay:.2f} seconds.")
+            metrics.increment("retries", method = method, platform = platform)
+            pause(delay)
+
+    finally:
+        if trial:
+            breaker.endTrial()
+
+    raise RetryError(f"{method}() for {platform} agent {name}: Gave up after {i + 1} attempts. Last error: {lastError}", platform) from lastError
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from orchestrator import ConversationOrchestrator
+import retry
+
+# Stands in for a Selenium driver: remembers which tab it is on and checks that only one thread uses it at a time.
+class FakeDriver:
+    def __init__(self):
+        self.current = None
+        self.inUse = threading.Lock()
+
+class FakeAgent:
+    def __init__(self, name, driver = None):
+        self.name = name
+        self.driver = driver
+        self.window = name if driver is not None else None
+
+    def focus(self):
+        if self.driver is not None:
+            self.driver.current = self.window
+
+    # Uses the driver, optionally waits to retry (as retryCall() does) and then uses it again. Returns the tab it ended up on.
+    def operate(self, wait = 0):
+        self.focus()
+        self.useDriver()
+        if wait > 0:
+            retry.pause(wait)
+            self.useDriver()
+        return self.driver.current if self.driver is not None else self.name
+
+    def useDriver(self):
+        if self.driver is not None:
+            assert self.driver.inUse.acquire(blocking = False), "two threads used the driver at once"
+            time.sleep(0.01)
+            self.driver.inUse.release()
+
+def runCalls(orchestrator, calls, timeout = 10):
+    async def run():
+        return await asyncio.wait_for(asyncio.gather(*[orchestrator.call(agent, agent.operate, *args) for agent, args in calls]), timeout)
+    return asyncio.run(run())
+
+# More agents retrying on one driver than there are threads in the shared pool used to deadlock.
+def test_more_waiting_callers_on_one_driver_than_workers():
+    driver = FakeDriver()
+    agents = [FakeAgent(f"agent{i}", driver) for i in range(5)]
+    results = runCalls(ConversationOrchestrator(maxWorkers = 2), [(agent, (0.05,)) for agent in agents])
+
+    # Each agent is switched back to its own tab after waiting.
+    assert results == [agent.name for agent in agents]
+
+def test_driver_is_let_go_while_waiting():
+    driver = FakeDriver()
+    slow = FakeAgent("slow", driver)
+    fast = FakeAgent("fast", driver)
+    finished = []
+
+    async def run():
+        orchestrator = ConversationOrchestrator()
+
+        async def timed(agent, wait):
+            await orchestrator.call(agent, agent.operate, wait)
+            finished.append(agent.name)
+
+        await asyncio.wait_for(asyncio.gather(timed(slow, 0.5), timed(fast, 0)), 10)
+
+    asyncio.run(run())
+    assert finished == ["fast", "slow"]
+
+def test_waiting_web_agents_leave_the_pool_to_custom_agents():
+    driver = FakeDriver()
+    web = [FakeAgent(f"web{i}", driver) for i in range(3)]
+    custom = FakeAgent("custom")
+
+    async def run():
+        orchestrator = ConversationOrchestrator(maxWorkers = 1)
+        waiting = asyncio.gather(*[orchestrator.call(agent, agent.operate, 1) for agent in web])
+        await asyncio.sleep(0.1)
+
+        start = time.monotonic()
+        await asyncio.wait_for(orchestrator.call(custom, custom.operate), 10)
+        elapsed = time.monotonic() - start
+        await waiting
+        return elapsed
+
+    assert asyncio.run(run()) < 0.5
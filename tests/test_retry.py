@@ -0,0 +1,96 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import pytest
+
+import retry
+from retry import CircuitBreaker, NotReadyError, RetryError, RetryPolicy, retryCall
+
+quickPolicy = RetryPolicy(retries = 2, baseDelay = 0.01, maxDelay = 0.01, deadline = None)
+
+@pytest.fixture(autouse = True)
+def freshBreakers():
+    retry.circuitBreakers.clear()
+    yield
+    retry.circuitBreakers.clear()
+
+def failing():
+    raise NotReadyError("not there yet")
+
+def test_retries_until_success():
+    attempts = []
+
+    def operation():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise NotReadyError("not there yet")
+        return "done"
+
+    assert retryCall(operation, "op", "test", "agent", quickPolicy) == "done"
+    assert len(attempts) == 3
+
+def test_fatal_errors_are_not_retried():
+    attempts = []
+
+    def operation():
+        attempts.append(1)
+        raise TypeError("bug")
+
+    with pytest.raises(TypeError):
+        retryCall(operation, "op", "test", "agent", quickPolicy)
+    assert len(attempts) == 1
+
+# A RetryError the caller swallows doesn't count against the breaker, one that ends a turn does.
+def test_only_recorded_failures_open_the_breaker():
+    for _ in range(3):
+        with pytest.raises(RetryError):
+            retryCall(failing, "op", "test", "agent", quickPolicy)
+    assert retry.getCircuitBreaker("test").openedAt is None
+
+    for _ in range(2):
+        with pytest.raises(RetryError) as error:
+            retryCall(failing, "op", "test", "agent", quickPolicy)
+        error.value.recordFailure()
+    assert retry.getCircuitBreaker("test").openedAt is not None
+
+# Once the cooldown has passed, one caller makes the trial call while the others wait for its outcome.
+def test_one_trial_call_after_cooldown():
+    breaker = CircuitBreaker("test", failureThreshold = 1, cooldown = 0.1, pollInterval = 0.01)
+    retry.circuitBreakers["test"] = breaker
+    breaker.recordFailure()
+    calls = []
+
+    def operation():
+        start = time.monotonic()
+        time.sleep(0.05)
+        calls.append((start, time.monotonic()))
+
+    threads = [threading.Thread(target = retryCall, args = (operation, "op", "test", "agent", quickPolicy)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The other callers only start once the trial call has closed the breaker.
+    calls.sort()
+    assert len(calls) == 4
+    assert all(calls[0][1] <= start for start, _ in calls[1:])
+    assert breaker.openedAt is None
+
+# A failed trial call reopens the breaker for another cooldown.
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker("test", failureThreshold = 1, cooldown = 0.05, pollInterval = 0.01)
+    retry.circuitBreakers["test"] = breaker
+    breaker.recordFailure()
+    openedAt = breaker.openedAt
+
+    with pytest.raises(RetryError) as error:
+        retryCall(failing, "op", "test", "agent", quickPolicy)
+    error.value.recordFailure()
+
+    assert breaker.openedAt > openedAt
+    assert not breaker.trialRunning
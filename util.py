@@ -1,6 +1,5 @@
 import re
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
+import time
 
 # web scraping helper methods.
 htmltagStripper = re.compile('<.*?>')
@@ -23,6 +22,8 @@ def retrieveTargetElement(nodes, searchAtt, searchString, siblings = False):
                 elemList = [j]
                 curElement = j
 
+                from selenium.webdriver.common.by import By # imported here so runs without web agents don't load Selenium.
+
                 # get successive siblings until there aren't any more (exception will be thrown)
                 exitFlag = True
                 while exitFlag:
@@ -67,16 +68,172 @@ def retrieveTargetElements(nodes, searchAtt, searchString):
         
     return out
 
-# Non-JS code to fill a textarea.       
+# In-browser message extraction. Each script runs in a single execute_script() round trip and returns {count, paragraphs}: the number of messages currently on the page
+# and the latest message's paragraphs as a list of plain strings (null if there is none), instead of one WebDriver call per element/attribute/sibling.
+# The count lets agents keep a cursor of what they have already consumed rather than comparing message text.
+
+# character.ai: first p element whose node attribute contains '[object Object]', plus all following p siblings (multi paragraph answers).
+# Each run of sibling paragraphs counts as one message.
+characteraiLatestMessageScript = """
+var nodes = document.getElementsByTagName('p');
+var count = 0;
+var out = null;
+for (var i = 0; i < nodes.length; i++) {
+    var p = nodes[i];
+    var att = (p.node !== undefined && p.node !== null) ? String(p.node) : p.getAttribute('node');
+    if (att === null || att.indexOf('[object Object]') === -1) {
+        continue;
+    }
+    var prev = p.previousElementSibling;
+    if (prev === null || prev.tagName !== p.tagName) {
+        count++;
+    }
+    if (out === null) {
+        out = [p.innerHTML];
+        for (var sib = p.nextElementSibling; sib !== null; sib = sib.nextElementSibling) {
+            if (sib.tagName === p.tagName) {
+                out.push(sib.innerHTML);
+            }
+        }
+    }
+}
+return {count: count, paragraphs: out};
+"""
+
+# Replika: innermost span of the last chat message div.
+replikaLatestMessageScript = """
+var messages = document.querySelectorAll("div[data-testid='chat-message-text']");
+if (messages.length === 0) {
+    return {count: 0, paragraphs: null};
+}
+var span = messages[messages.length - 1].querySelector('span');
+span = span && span.querySelector('span');
+return {count: messages.length, paragraphs: span ? [span.innerHTML] : null};
+"""
+
+# Tab identification: for each candidate {name, urlPattern, messageSelector}, is this tab the candidate's platform (location contains urlPattern) and does a text node start with the
+# agent's name outside of the chat messages? Walks the text nodes in the browser and returns one boolean per candidate, instead of sending the whole serialized page back to Python.
+findAgentNamesScript = """
+var candidates = arguments[0];
+var out = [];
+for (var i = 0; i < candidates.length; i++) {
+    out.push(false);
+}
+var walker = document.createTreeWalker(document.documentElement, NodeFilter.SHOW_TEXT);
+for (var node = walker.nextNode(); node !== null; node = walker.nextNode()) {
+    for (var i = 0; i < candidates.length; i++) {
+        var c = candidates[i];
+        if (out[i] || location.href.indexOf(c.urlPattern) === -1 || node.nodeValue.indexOf(c.name) !== 0) {
+            continue;
+        }
+        if (c.messageSelector && node.parentElement && node.parentElement.closest(c.messageSelector)) {
+            continue;
+        }
+        out[i] = true;
+    }
+}
+return out;
+"""
+
+# Number of elements on the page, see Agent.trimPage().
+domNodeCountScript = "return document.getElementsByTagName('*').length;"
+
+# Runs an extraction script and joins the paragraphs into one message. Returns (message count, latest message). Raises an exception if no message was found.
+def extractLatestMessage(driver, script):
+    result = driver.execute_script(script)
+    paragraphs = result["paragraphs"]
+
+    if not paragraphs:
+        raise Exception("extractLatestMessage(): No message found on page.")
+
+    if len(paragraphs) == 1:
+        return result["count"], paragraphs[0]
+
+    return result["count"], "".join(j + " " for j in paragraphs)
+
+# Non-JS code to fill a textarea, one keystroke at a time.
 def fillTextBox(node, message):
+    from selenium.webdriver.common.keys import Keys
+
     node.send_keys(Keys.TAB)
     node.clear()
     node.send_keys(message)   
 
+# Sets a textarea's text in one execute_script() round trip, however long it is, and returns the text now in it for validation.
+# The value is set through the prototype's setter rather than node.value, which React overrides, so the site's input handlers see the change when the input event fires.
+# With append, the text is added to what is already there (see Agent.typeChunk()).
+injectTextScript = """
+var node = arguments[0];
+var text = arguments[2] ? node.value + arguments[1] : arguments[1];
+var setter = Object.getOwnPropertyDescriptor(HTMLTextAreaElement.prototype, 'value').set;
+node.focus();
+setter.call(node, text);
+node.dispatchEvent(new Event('input', {bubbles: true}));
+node.dispatchEvent(new Event('change', {bubbles: true}));
+return node.value;
+"""
+
+# JS code to fill a textarea (see injectTextScript). Returns the text in the textarea afterwards.
+def injectText(driver, node, message, append = False):
+    return driver.execute_script(injectTextScript, node, message, append)
+
+# Compares two scraped/sent messages, ignoring HTML tags, entities (the scripts return innerHTML, so a sent "&" comes back as "&amp;") and surrounding whitespace.
+def sameMessage(a, b):
+    if a is None or b is None:
+        return a is b
+    return messageText(a) == messageText(b)
+
+# Tracks successive reads of a chat message and reports when something new (not None and not in staleTexts) has stayed unchanged for settleTime seconds,
+# ie: a chat reply that has stopped streaming in. Texts are compared as plain text (see messageText()).
+class StableTextWatcher:
+    def __init__(self, staleTexts, settleTime = 2):
+        self.stale = [messageText(j) for j in staleTexts if j is not None]
+        self.settleTime = settleTime
+        self.lastText = None
+        self.lastChange = None
+
+    # Feed the latest read (or None if the read failed). Returns True once the text has settled.
+    def update(self, text):
+        text = None if text is None else messageText(text)
+        now = time.monotonic()
+
+        if text and (text not in self.stale):
+            if text != self.lastText:
+                self.lastText = text
+                self.lastChange = now
+
+            elif now - self.lastChange >= self.settleTime:
+                return True
+
+        return False
+
+# Polls readText() until the text it returns has settled (see StableTextWatcher). Returns True once it has, False if timeout seconds pass first.
+def waitForStableText(readText, staleTexts, timeout = 60, pollInterval = 0.5, settleTime = 2):
+    watcher = StableTextWatcher(staleTexts, settleTime)
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            text = readText()
+        except Exception:
+            text = None
+
+        if watcher.update(text):
+            return True
+
+        time.sleep(pollInterval)
+
+    return False
+
 def stripHtmlTags(inString):
   outString = re.sub(htmltagStripper, '', inString)
   return outString
 
+# The plain text of a scraped message: HTML tags stripped, entities decoded (non-breaking spaces as plain spaces) and surrounding whitespace removed.
+def messageText(inString):
+    import html # only loaded once messages are relayed.
+    return html.unescape(stripHtmlTags(inString)).replace("\xa0", " ").strip()
+
 # other helper methods
 def log_print(inString):
     if verbosity:
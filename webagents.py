@@ -0,0 +1,27 @@
+from Agent import Agent
+from util import characteraiLatestMessageScript, replikaLatestMessageScript
+
+"""
+Agents that chat through a site in a Chrome tab. Everything they do is shared in Agent, so each only declares how to find its tab, messages and textbox.
+Kept out of Agent.py's agent_types table until one of these types is looked up, so runs with only model agents don't load them.
+"""
+
+class characteraiAgent(Agent):
+    urlPattern = "character.ai"
+    messageSelector = "p"
+    textboxAttribute = "placeholder"
+    textboxValue = "Message"
+    latestMessageScript = characteraiLatestMessageScript
+
+    def __init__(self, name, driver, window):
+        super().__init__("character.ai", name, driver, window)
+
+class replikaAgent(Agent):
+    urlPattern = "replika"
+    messageSelector = "div[data-testid='chat-message-text']"
+    textboxAttribute = "id"
+    textboxValue = "send-message-textarea"
+    latestMessageScript = replikaLatestMessageScript
+
+    def __init__(self, name, driver, window):
+        super().__init__("Replika", name, driver, window)